@@ -22,7 +22,7 @@ from raven.contrib.flask import Sentry
 
 from app import celery_config
 from app.constants import OPENRECORDS_DL_EMAIL
-from app.lib import NYCHolidays, jinja_filters
+from app.lib import NYCHolidays, jinja_filters, query_counter
 from config import Config, config
 from elasticsearch import Elasticsearch
 
@@ -45,6 +45,10 @@ upload_redis = redis.StrictRedis(
     db=Config.UPLOAD_REDIS_DB, host=Config.REDIS_HOST, port=Config.REDIS_PORT)
 email_redis = redis.StrictRedis(
     db=Config.EMAIL_REDIS_DB, host=Config.REDIS_HOST, port=Config.REDIS_PORT)
+fragment_redis = redis.StrictRedis(
+    db=Config.FRAGMENT_REDIS_DB, host=Config.REDIS_HOST, port=Config.REDIS_PORT)
+pdf_redis = redis.StrictRedis(
+    db=Config.PDF_REDIS_DB, host=Config.REDIS_HOST, port=Config.REDIS_PORT)
 
 holidays = NYCHolidays(years=[year for year in range(Config.APP_LAUNCH_DATE.year, date.today().year + 5)])
 calendar = Calendar(
@@ -102,6 +106,7 @@ def create_app(config_name='default'):
 
     bootstrap.init_app(app)
     db.init_app(app)
+    query_counter.init_app(app)
     csrf.init_app(app)
     moment.init_app(app)
     login_manager.init_app(app)
@@ -173,6 +178,11 @@ def create_app(config_name='default'):
             if not flask_request.cookies.get('authorized_maintainer', None):
                 return abort(503)
 
+    @app.before_request
+    def clear_permissions_cache():
+        from app.lib.permission_utils import clear_permissions_cache
+        clear_permissions_cache()
+
     if app.config['USE_MFA']:
         @app.before_request
         def check_valid_login():
@@ -22,11 +22,6 @@ beat_schedule = {
         'schedule': crontab(minute='0', hour='7', day_of_week='1-5')
         # 'schedule': 60.0
     },
-    # Every January 1st
-    'update_next_request_number': {
-        'task': 'app.jobs.update_next_request_number',
-        'schedule': crontab(minute='0', hour='0', day_of_month='1', month_of_year='1')
-    },
     # Every X minutes
     'clear_expired_session_ids': {
         'task': 'app.jobs.clear_expired_session_ids',
@@ -11,6 +11,8 @@ LATEX_TEMPLATE_CONFIG = {
     'autoescape': False
 }
 
+MAX_ENVELOPE_BATCH_SIZE = 500  # envelopes compiled into one PDF
+
 
 class EnvelopeDict(dict):
     """
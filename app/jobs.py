@@ -7,7 +7,7 @@ from flask import (current_app, render_template)
 from psycopg2 import OperationalError
 from sqlalchemy.exc import SQLAlchemyError
 
-from app import calendar, db, store
+from app import calendar, store
 from app.constants import OPENRECORDS_DL_EMAIL, request_status
 from app.constants.event_type import EMAIL_NOTIFICATION_SENT, REQ_STATUS_CHANGED
 from app.constants.response_privacy import PRIVATE
@@ -125,10 +125,9 @@ def _update_request_statuses():
         user_emails = list(set(admin.notification_email or admin.email for admin
                                in Agencies.query.filter_by(ein=agency_ein).one().administrators))
 
-        send_email(
-            STATUSES_EMAIL_SUBJECT,
-            to=user_emails,
-            template=STATUSES_EMAIL_TEMPLATE,
+        # rendered once for both the message and the Emails record
+        body = render_template(
+            STATUSES_EMAIL_TEMPLATE + ".html",
             requests_overdue=agency_requests_overdue,
             acknowledgments_overdue=agency_acknowledgments_overdue,
             requests_due_soon=agency_requests_due_soon,
@@ -141,15 +140,15 @@ def _update_request_statuses():
             cc=None,
             bcc=None,
             subject=STATUSES_EMAIL_SUBJECT,
-            body=render_template(
-                STATUSES_EMAIL_TEMPLATE + ".html",
-                requests_overdue=agency_requests_overdue,
-                acknowledgments_overdue=agency_acknowledgments_overdue,
-                requests_due_soon=agency_requests_due_soon,
-                acknowledgments_due_soon=agency_acknowledgments_due_soon
-            )
+            body=body
         )
         create_object(email)
+        send_email(
+            STATUSES_EMAIL_SUBJECT,
+            to=user_emails,
+            email_content=body,
+            email_id=email.id
+        )
         create_object(
             Events(
                 request.id,
@@ -163,21 +162,6 @@ def _update_request_statuses():
         )
 
 
-@app.task(autoretry_for=(OperationalError, SQLAlchemyError,), retry_kwargs={'max_retries': 5}, retry_backoff=True)
-def update_next_request_number():
-    """
-    Celery task to automatically update the next request number of each agency to 1
-    :return:
-    """
-    try:
-        for agency in Agencies.query.all():
-            agency.next_request_number = 1
-            db.session.add(agency)
-        db.session.commit()
-    except SQLAlchemyError:
-        db.session.rollback()
-
-
 @app.task(autoretry_for=(OperationalError, SQLAlchemyError,), retry_kwargs={'max_retries': 5}, retry_backoff=True)
 def clear_expired_session_ids():
     """
@@ -14,33 +14,252 @@
         DEFAULT_MAIL_SENDER: 'Records Admin <openrecords@records.nyc.gov>'
 
 """
+import json
 import os
+import smtplib
+import tempfile
+from uuid import uuid4
+
 from flask import current_app, render_template
 from flask_mail import Message
 
-from app import mail, celery, sentry
+from app import mail, celery, email_redis, sentry
 from app.lib.file_utils import os_get_mime_type
+from app.lib.storage import get_storage
 from app.models import (
     Agencies,
+    Emails,
     Requests,
 )
 
+EMAIL_OUTBOX_KEY = 'email_outbox'
+EMAIL_OUTBOX_PROCESSING_KEY = 'email_outbox_processing'  # messages being sent, removed once sent or retried
+EMAIL_OUTBOX_LOCK_KEY = 'email_outbox_lock'
+EMAIL_OUTBOX_LOCK_TIMEOUT = 300  # seconds
+EMAIL_RETRY_DELAY = 30  # seconds, doubled after each failed attempt
+EMAIL_EXPIRY = 604800  # 1 week, long enough for every retry
+EMAIL_ATTACHMENT_DIRECTORY = 'email_attachments'  # within UPLOAD_DIRECTORY
+
 
 @celery.task(serializer='pickle')
 def send_async_email(msg):
+    # messages queued before emails were stored by id
+    queue_email(msg)
+
+
+def get_email_key(email_key_id):
+    return '|'.join(('email', email_key_id))
+
+
+def store_email(msg, email_id=None):
+    """
+    Stores a message so it can be sent by id: the envelope (and html, unless it is the body of
+    an Emails row) in redis and any attachments in file storage.
+
+    :param msg: flask_mail.Message
+    :param email_id: id of the Emails row the html was recorded in, if any
+    :return: id of the stored message
+    """
+    email_key_id = uuid4().hex
+    record = {
+        'subject': msg.subject,
+        'sender': msg.sender,
+        'recipients': msg.recipients,
+        'cc': msg.cc,
+        'bcc': msg.bcc,
+        'reply_to': msg.reply_to,
+        'body': msg.body,
+        'html': None if email_id is not None else msg.html,
+        'email_id': email_id,
+        'attachments': [],
+    }
+    if msg.attachments:
+        storage = get_storage()
+        for i, attachment in enumerate(msg.attachments):
+            path = os.path.join(current_app.config['UPLOAD_DIRECTORY'],
+                                EMAIL_ATTACHMENT_DIRECTORY, email_key_id, str(i))
+            fd, local_path = tempfile.mkstemp()
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(attachment.data)
+            storage.put(local_path, path)
+            record['attachments'].append({
+                'path': path,
+                'filename': attachment.filename,
+                'content_type': attachment.content_type,
+                'disposition': attachment.disposition,
+                'headers': attachment.headers,
+            })
+    email_redis.set(get_email_key(email_key_id), json.dumps(record), ex=EMAIL_EXPIRY)
+    return email_key_id
+
+
+def load_email(email_key_id):
+    """
+    Rebuilds a message stored by store_email.
+
+    :param email_key_id: id of the stored message
+    :return: flask_mail.Message, or None if the message is no longer stored
+    """
+    record = email_redis.get(get_email_key(email_key_id))
+    if record is None:
+        return None
+    record = json.loads(record)
+    msg = Message(record['subject'],
+                  sender=record['sender'],
+                  recipients=record['recipients'],
+                  cc=record['cc'],
+                  bcc=record['bcc'],
+                  reply_to=record['reply_to'],
+                  body=record['body'],
+                  html=record['html'])
+    if record['email_id'] is not None:
+        msg.html = Emails.query.filter_by(id=record['email_id']).one().body
+    if record['attachments']:
+        storage = get_storage()
+        for attachment in record['attachments']:
+            msg.attach(attachment['filename'],
+                       attachment['content_type'],
+                       b''.join(storage.stream(attachment['path'])),
+                       attachment['disposition'],
+                       headers=attachment['headers'])
+    return msg
+
+
+def discard_email(email_key_id):
+    """
+    Removes a stored message and its attachments.
+
+    :param email_key_id: id of the stored message
+    """
+    key = get_email_key(email_key_id)
+    record = email_redis.get(key)
+    if record is None:
+        return
+    attachments = json.loads(record)['attachments']
+    if attachments:
+        storage = get_storage()
+        for attachment in attachments:
+            try:
+                storage.delete(attachment['path'])
+            except Exception:
+                current_app.logger.exception("Failed to delete email attachment {}".format(attachment['path']))
+    email_redis.delete(key)
+
+
+def queue_email(msg, email_id=None):
+    """
+    Stores a message and adds it to the outbox; queued messages are sent in batches by send_queued_emails.
+
+    :param msg: flask_mail.Message
+    :param email_id: id of the Emails row the html was recorded in, if any
+    """
+    _queue_email_key(store_email(msg, email_id))
+
+
+def _outbox_item(item):
+    return json.dumps({'id': item['id'], 'attempts': item['attempts']})
+
+
+def _queue_email_key(email_key_id, attempts=0):
+    # pushed on the left and taken from the right (see send_queued_emails), so messages are sent in order
+    email_redis.lpush(EMAIL_OUTBOX_KEY, _outbox_item({'id': email_key_id, 'attempts': attempts}))
+    send_queued_emails.delay()
+
+
+@celery.task
+def retry_email(email_key_id, attempts):
+    _queue_email_key(email_key_id, attempts)
+
+
+@celery.task
+def send_queued_emails():
+    """
+    Sends queued messages, up to MAIL_BATCH_SIZE per SMTP connection, until the outbox is empty.
+    Only one worker drains the outbox at a time.
+
+    Messages are moved to a processing list while they are sent and only removed from it once they
+    have been sent or scheduled for a retry, so the messages of a worker that stops mid-batch are
+    sent by the next one.
+    """
+    lock = email_redis.lock(EMAIL_OUTBOX_LOCK_KEY, timeout=EMAIL_OUTBOX_LOCK_TIMEOUT)
+    if not lock.acquire(blocking=False):
+        return  # the worker holding the lock will send the queued messages
     try:
-        mail.send(msg)
+        batch_size = current_app.config['MAIL_BATCH_SIZE']
+        while True:
+            # left over by a worker that stopped before finishing its batch
+            items = email_redis.lrange(EMAIL_OUTBOX_PROCESSING_KEY, 0, -1)
+            while len(items) < batch_size:
+                item = email_redis.rpoplpush(EMAIL_OUTBOX_KEY, EMAIL_OUTBOX_PROCESSING_KEY)
+                if item is None:
+                    break
+                items.append(item)
+            if not items:
+                break
+            deliver_emails([json.loads(item) for item in items])
+            lock.extend(EMAIL_OUTBOX_LOCK_TIMEOUT)
+    finally:
+        lock.release()
+    # messages queued after the last batch was taken but before the lock was released
+    if email_redis.llen(EMAIL_OUTBOX_KEY):
+        send_queued_emails.delay()
+
+
+def deliver_emails(items):
+    """
+    Sends stored messages over a single SMTP connection (reconnecting if the server drops it).
+    A message that cannot be sent is retried later, up to MAIL_MAX_RETRIES times.
+
+    :param items: list of {'id': id of the stored message, 'attempts': int}
+    :return: number of messages sent
+    """
+    sent = 0
+    remaining = list(items)
+    try:
+        with mail.connect() as connection:
+            while remaining:
+                item = remaining[0]
+                try:
+                    msg = load_email(item['id'])
+                    if msg is not None:
+                        try:
+                            connection.send(msg)
+                        except smtplib.SMTPServerDisconnected:
+                            # reconnect and try the message again
+                            connection.host = connection.configure_host()
+                            connection.send(msg)
+                        sent += 1
+                except Exception as e:
+                    _email_failed(item, e)
+                else:
+                    discard_email(item['id'])
+                email_redis.lrem(EMAIL_OUTBOX_PROCESSING_KEY, 1, _outbox_item(item))
+                remaining.pop(0)
     except Exception as e:
+        # could not connect (or reconnect) to the server
+        for item in remaining:
+            _email_failed(item, e)
+            email_redis.lrem(EMAIL_OUTBOX_PROCESSING_KEY, 1, _outbox_item(item))
+    return sent
+
+
+def _email_failed(item, error):
+    attempts = item['attempts'] + 1
+    if attempts <= current_app.config['MAIL_MAX_RETRIES']:
+        retry_email.apply_async((item['id'], attempts), countdown=EMAIL_RETRY_DELAY * 2 ** (attempts - 1))
+    else:
         sentry.captureException()
-        current_app.logger.exception("Failed to Send Email {} : {}".format(msg, e))
+        current_app.logger.exception("Failed to Send Email {} : {}".format(item['id'], error))
+        discard_email(item['id'])
 
 
 def send_contact_email(subject, recipients, body, sender):
     msg = Message(subject, recipients, body, sender=sender)
-    send_async_email.delay(msg)
+    queue_email(msg)
 
 
-def send_email(subject, to=list(), cc=list(), bcc=list(), reply_to='', template=None, email_content=None, **kwargs):
+def send_email(subject, to=list(), cc=list(), bcc=list(), reply_to='', template=None, email_content=None,
+               email_id=None, **kwargs):
     """Function that sends asynchronous emails for the application.
     Takes in arguments from the frontend.
 
@@ -52,6 +271,7 @@ def send_email(subject, to=list(), cc=list(), bcc=list(), reply_to='', template=
         subject: Subject of the email
         template: HTML and TXT template of the email content
         email_content: string of HTML email content that can be used as a message template
+        email_id: id of the Emails row email_content was recorded in (the message is sent with the row's body)
         kwargs: Additional arguments the function may take in (ie: Message content)
     """
     assert to or cc or bcc
@@ -82,7 +302,7 @@ def send_email(subject, to=list(), cc=list(), bcc=list(), reply_to='', template=
         content_id = image['content_id']
         msg.attach(filename, mimetype, open(image_path, 'rb').read(),
                    'inline', headers=[['Content-ID', '<{}>'.format(content_id)], ])
-    send_async_email.delay(msg)
+    queue_email(msg, email_id)
 
 
 def get_assigned_users_emails(request_id: str):
@@ -6,15 +6,20 @@
     Switches file-handling interface between sftp and os depending on configuration.
 
 """
+import errno
 import os
 import magic
+import binascii
+import fcntl
 import hashlib
 import paramiko
-import shutil
-from tempfile import TemporaryFile
+import requests
+import socket
+import threading
+import time
 from functools import wraps
 from contextlib import contextmanager
-from flask import current_app, send_from_directory, redirect
+from flask import current_app
 from app import sentry
 from azure.storage.blob import (generate_blob_sas,
                                 BlobSasPermissions,
@@ -22,27 +27,41 @@ from azure.storage.blob import (generate_blob_sas,
                                 BlobClient,
                                 ContainerClient
                                 )
+from azure.core.pipeline.transport import RequestsTransport
 from datetime import datetime, timedelta
 
-TRANSFER_SIZE_LIMIT = 512000  # 512 kb
+INGEST_BLOCK_SIZE = 1048576  # 1 mb
+SERVING_CACHE_LOCK_DIRNAME = '.locks'
+SERVING_CACHE_LOCK_STRIPES = 64
+SERVING_CACHE_PARTIAL_SUFFIX = '.part'
+SERVING_CACHE_EVICTED_FILENAME = 'evicted'  # within SERVING_CACHE_LOCK_DIRNAME, touched on every eviction
+SERVING_CACHE_EVICT_INTERVAL = 60  # seconds between walks of the serving cache
+AZURE_COPY_POLL_INTERVAL = 0.5  # seconds, doubled after each poll
+AZURE_COPY_MAX_POLL_INTERVAL = 5
+# errors of a lost SFTP connection, after which a call is retried on a new connection
+SFTP_CONNECTION_ERRORS = (paramiko.SSHException, EOFError, ConnectionError, socket.timeout)
 
 
-class MaxTransferSizeExceededException(Exception):
+class SFTPCredentialsException(Exception):
     pass
 
 
-class SFTPCredentialsException(Exception):
-    pass
+class ChecksumMismatchException(Exception):
+    def __init__(self, path, expected_hash, actual_hash):
+        super(ChecksumMismatchException, self).__init__(
+            "Checksum of '{}' is {}, expected {}".format(path, actual_hash, expected_hash))
 
 
-@contextmanager
-def sftp_ctx():
+class AzureCopyFailedException(Exception):
+    def __init__(self, current_blob_name, new_blob_name, status):
+        super(AzureCopyFailedException, self).__init__(
+            "Copy of blob '{}' to '{}' did not complete: {}".format(current_blob_name, new_blob_name, status))
+
+
+def _sftp_connect():
     """
-    Context manager that provides an SFTP client object
-    (an SFTP session across an open SSH Transport)
+    Opens an SSH Transport to the SFTP server and starts an SFTP session on it.
     """
-    transport = paramiko.Transport((current_app.config['SFTP_HOSTNAME'],
-                                    int(current_app.config['SFTP_PORT'])))
     authentication_kwarg = {}
     if current_app.config['SFTP_PASSWORD']:
         authentication_kwarg['password'] = current_app.config['SFTP_PASSWORD']
@@ -51,42 +70,170 @@ def sftp_ctx():
     else:
         raise SFTPCredentialsException
 
-    transport.connect(username=current_app.config['SFTP_USERNAME'], **authentication_kwarg)
-    sftp = paramiko.SFTPClient.from_transport(transport)
+    transport = paramiko.Transport((current_app.config['SFTP_HOSTNAME'],
+                                    int(current_app.config['SFTP_PORT'])))
+    try:
+        transport.connect(username=current_app.config['SFTP_USERNAME'], **authentication_kwarg)
+        return paramiko.SFTPClient.from_transport(transport)
+    except Exception:
+        transport.close()
+        raise
+
+
+def _sftp_close(sftp):
+    transport = sftp.get_channel().get_transport()
+    try:
+        sftp.close()
+    finally:
+        transport.close()
+
+
+def _sftp_is_active(sftp):
+    channel = sftp.get_channel()
+    return channel is not None and not channel.closed and channel.get_transport().is_active()
+
+
+class SFTPConnectionPool(object):
+    """
+    Pool of open SFTP sessions, so file operations reuse an authenticated SSH Transport
+    instead of performing a handshake each time.
+
+    Sessions idle for longer than 'idle_timeout' seconds are closed; sessions idle for
+    longer than 'health_check_interval' seconds are checked with a round-trip before reuse.
+    The pool is emptied (without closing the parent's sockets) after a fork, so each
+    worker process keeps its own sessions.
+    """
+
+    def __init__(self, connect, max_size, idle_timeout, health_check_interval=30):
+        self._connect = connect
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self._idle = []  # (sftp, time released), most recently used last
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def acquire(self):
+        now = time.time()
+        with self._lock:
+            if self._pid != os.getpid():
+                self._idle = []
+                self._pid = os.getpid()
+            expired = [sftp for sftp, released in self._idle if now - released > self.idle_timeout]
+            self._idle = [(sftp, released) for sftp, released in self._idle if now - released <= self.idle_timeout]
+        for sftp in expired:
+            self._discard(sftp)
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                sftp, released = self._idle.pop()
+            if self._is_healthy(sftp, now - released):
+                return sftp
+            self._discard(sftp)
+        return self._connect()
+
+    def release(self, sftp, discard=False):
+        if not discard and _sftp_is_active(sftp):
+            with self._lock:
+                if self._pid == os.getpid() and len(self._idle) < self.max_size:
+                    self._idle.append((sftp, time.time()))
+                    return
+        self._discard(sftp)
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for sftp, _ in idle:
+            self._discard(sftp)
+
+    def _is_healthy(self, sftp, idle_for):
+        if not _sftp_is_active(sftp):
+            return False
+        if idle_for > self.health_check_interval:
+            try:
+                sftp.normalize('.')
+            except (IOError, OSError, EOFError, paramiko.SSHException):
+                return False
+        return True
+
+    @staticmethod
+    def _discard(sftp):
+        try:
+            _sftp_close(sftp)
+        except Exception:
+            pass
+
+
+_sftp_pool = None
+_magic_handles = {}
+_magic_handles_lock = threading.Lock()
+
+
+def get_sftp_pool():
+    global _sftp_pool
+    if _sftp_pool is None:
+        _sftp_pool = SFTPConnectionPool(
+            _sftp_connect,
+            max_size=current_app.config['SFTP_POOL_SIZE'],
+            idle_timeout=current_app.config['SFTP_POOL_IDLE_TIMEOUT'])
+    return _sftp_pool
+
+
+@contextmanager
+def sftp_ctx():
+    """
+    Context manager that provides an SFTP client object
+    (an SFTP session across an open SSH Transport)
+
+    Sessions are borrowed from the worker's SFTPConnectionPool and
+    returned to it afterwards, unless the connection was lost.
+    """
+    pool = get_sftp_pool()
+    sftp = pool.acquire()
+    discard = False
     try:
         yield sftp
     except Exception as e:
+        discard = not _sftp_is_active(sftp)
         sentry.captureException()
-        raise paramiko.SFTPError("Exception occurred with SFTP: {}".format(e))
+        raise paramiko.SFTPError("Exception occurred with SFTP: {}".format(e)) from e
     finally:
-        sftp.close()
-        transport.close()
+        pool.release(sftp, discard)
 
 
-def _sftp_switch(sftp_func):
+def _sftp_switch(sftp_func, retry=True):
     """
     Check if app is using SFTP and, if so, connect to SFTP server
     and call passed function (sftp_func) with connected client,
     otherwise call decorated function (which should be using
     the os library to accomplish the same file-related action).
+
+    If a pooled connection turns out to have been dropped (the call
+    failed with one of SFTP_CONNECTION_ERRORS), the call is retried
+    once on a new connection.
+
+    :param retry: whether sftp_func can safely be called again;
+        False for calls that change the remote filesystem, which
+        may have taken effect before the connection was lost
     """
     def decorator(os_func):
         @wraps(os_func)
         def wrapper(*args, **kwargs):
             if current_app.config['USE_SFTP']:
-                with sftp_ctx() as sftp:
-                    return sftp_func(sftp, *args, **kwargs)
+                for attempt in range(2 if retry else 1):
+                    try:
+                        with sftp_ctx() as sftp:
+                            return sftp_func(sftp, *args, **kwargs)
+                    except paramiko.SFTPError as e:
+                        if attempt or not retry or not isinstance(e.__cause__, SFTP_CONNECTION_ERRORS):
+                            raise
             else:
                 return os_func(*args, **kwargs)
         return wrapper
     return decorator
 
 
-def _raise_if_too_big(bytes_transferred, _):
-    if bytes_transferred >= TRANSFER_SIZE_LIMIT:
-        raise MaxTransferSizeExceededException
-
-
 def _sftp_get_size(sftp, path):
     return sftp.stat(path).st_size
 
@@ -95,9 +242,10 @@ def _sftp_exists(sftp, path):
     try:
         sftp.stat(path)
         return True
-    except IOError:
-        sentry.captureException()
-        return False
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return False
+        raise
 
 
 def _sftp_mkdir(sftp, path):
@@ -132,50 +280,172 @@ def _sftp_move(sftp, localpath, remotepath):
     os.remove(localpath)
 
 
-def _sftp_get_mime_type(sftp, path):
-    with TemporaryFile() as tmp:
-        try:
-            sftp.getfo(path, tmp, _raise_if_too_big)
-        except MaxTransferSizeExceededException:
-            sentry.captureException()
-        tmp.seek(0)
-        if current_app.config['MAGIC_FILE']:
-            # Check using custom mime database file
-            m = magic.Magic(
-                magic_file=current_app.config['MAGIC_FILE'],
-                mime=True)
-            mime_type = m.from_buffer(tmp.read())
-        else:
-            mime_type = magic.from_buffer(tmp.read(), mime=True)
-    return mime_type
+def _sftp_read_header(fp):
+    fp.seek(0)
+    return read_mime_header(fp)
 
 
-def _sftp_get_hash(sftp, path):
+def _sftp_hash_file(fp):
+    """
+    Returns the sha1 hash of an open remote file, computed by the server if it
+    supports the 'check-file' extension, otherwise by a pipelined read in blocks.
+    """
+    try:
+        return binascii.hexlify(fp.check('sha1')).decode()
+    except (IOError, paramiko.SSHException):
+        pass
+    fp.seek(0)
+    fp.prefetch()
     sha1 = hashlib.sha1()
-    with TemporaryFile() as tmp:
-        sftp.getfo(path, tmp)
-        tmp.seek(0)
-        sha1.update(tmp.read())
+    for block in iter(lambda: fp.read(INGEST_BLOCK_SIZE), b''):
+        sha1.update(block)
     return sha1.hexdigest()
 
 
-def _sftp_send_file(sftp, directory, filename, **kwargs):
-    localpath = _get_file_serving_path(directory, filename)
-    if not os.path.exists(localpath):
-        sftp.get(os.path.join(directory, filename), localpath)
-    return send_from_directory(*os.path.split(localpath), **kwargs)
+def _sftp_get_mime_type(sftp, path):
+    with sftp.open(path, 'rb') as fp:
+        return get_mime_type_from_buffer(_sftp_read_header(fp))
+
+
+def _sftp_get_hash(sftp, path):
+    with sftp.open(path, 'rb') as fp:
+        return _sftp_hash_file(fp)
+
+
+def _sftp_get_file_metadata(sftp, path):
+    with sftp.open(path, 'rb') as fp:
+        size = fp.stat().st_size
+        mime_type = get_mime_type_from_buffer(_sftp_read_header(fp))
+        return size, mime_type, _sftp_hash_file(fp)
+
+
+def _sftp_get_cached_file(sftp, remote_path, localpath, file_hash=None):
+    """
+    Returns the path of a local copy of a remote file, downloading it into the
+    serving cache (UPLOAD_SERVING_DIRECTORY) unless it is already there.
+
+    Concurrent downloads of the same file are de-duplicated with a file lock,
+    downloads are checked against 'file_hash' (the sha1 stored for the file),
+    and the least recently served files are evicted once the cache grows
+    past SFTP_SERVING_CACHE_SIZE bytes.
+    """
+    if _touch(localpath):
+        return localpath
+    with _serving_cache_lock(localpath):
+        # another worker may have downloaded the file while we waited
+        if _touch(localpath):
+            return localpath
+        partial_path = localpath + SERVING_CACHE_PARTIAL_SUFFIX
+        sha1 = hashlib.sha1()
+        try:
+            with sftp.open(remote_path, 'rb') as src, open(partial_path, 'wb') as dst:
+                src.prefetch()
+                for block in iter(lambda: src.read(INGEST_BLOCK_SIZE), b''):
+                    dst.write(block)
+                    sha1.update(block)
+            if file_hash is not None and sha1.hexdigest() != file_hash:
+                raise ChecksumMismatchException(remote_path, file_hash, sha1.hexdigest())
+            os.rename(partial_path, localpath)
+        finally:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+    _evict_serving_cache(current_app.config['SFTP_SERVING_CACHE_SIZE'], keep=localpath)
+    return localpath
+
+
+def _touch(path):
+    """
+    Marks a cached file as recently served. Returns False if the file is not cached.
+    """
+    try:
+        os.utime(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+@contextmanager
+def _serving_cache_lock(localpath):
+    """
+    Exclusive lock for downloading 'localpath'.
+    Paths share a fixed number of lock files, so lock files never accumulate.
+    """
+    lock_directory = os.path.join(current_app.config['UPLOAD_SERVING_DIRECTORY'], SERVING_CACHE_LOCK_DIRNAME)
+    os.makedirs(lock_directory, exist_ok=True)
+    stripe = int(hashlib.sha1(localpath.encode()).hexdigest(), 16) % SERVING_CACHE_LOCK_STRIPES
+    with open(os.path.join(lock_directory, str(stripe)), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _evict_serving_cache(max_size, keep=None):
+    """
+    Removes the least recently served files until the serving cache holds at most 'max_size' bytes.
 
+    Walking the cache is only done once every SERVING_CACHE_EVICT_INTERVAL seconds, by whichever
+    process gets there first, so the cache may exceed 'max_size' by what is downloaded in between.
 
-def _get_file_serving_path(directory, filename):
+    :param keep: path of a file that must not be evicted (i.e. the one about to be served)
+    """
+    lock_directory = os.path.join(current_app.config['UPLOAD_SERVING_DIRECTORY'], SERVING_CACHE_LOCK_DIRNAME)
+    os.makedirs(lock_directory, exist_ok=True)
+    evicted = os.path.join(lock_directory, SERVING_CACHE_EVICTED_FILENAME)
+    try:
+        if time.time() - os.path.getmtime(evicted) < SERVING_CACHE_EVICT_INTERVAL:
+            return
+    except FileNotFoundError:
+        pass
+    with open(evicted, 'a') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return  # another process is evicting
+        try:
+            os.utime(evicted)
+            _evict_least_recently_served(max_size, keep)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _evict_least_recently_served(max_size, keep):
+    entries = []
+    for root, dirs, files in os.walk(current_app.config['UPLOAD_SERVING_DIRECTORY']):
+        if SERVING_CACHE_LOCK_DIRNAME in dirs:
+            dirs.remove(SERVING_CACHE_LOCK_DIRNAME)
+        for name in files:
+            if name.endswith(SERVING_CACHE_PARTIAL_SUFFIX):
+                continue
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def _get_file_serving_path(directory, filename, file_hash=None):
     """
     Returns the upload serving directory path for a file determined by supplied directory and filename.
+    Copies of different versions of a file (identified by 'file_hash') are kept apart.
     """
     request_id_folder = os.path.basename(directory)
-    localpath = os.path.join(current_app.config['UPLOAD_SERVING_DIRECTORY'], request_id_folder)
-    if not os.path.exists(localpath):
-        os.mkdir(localpath)
-    path = os.path.join(request_id_folder, filename)
-    return os.path.join(current_app.config['UPLOAD_SERVING_DIRECTORY'], path)
+    localpath = os.path.join(current_app.config['UPLOAD_SERVING_DIRECTORY'], request_id_folder, file_hash or '')
+    os.makedirs(localpath, exist_ok=True)
+    return os.path.join(localpath, filename)
 
 
 @_sftp_switch(_sftp_get_size)
@@ -188,7 +458,7 @@ def exists(path):
     return os.path.exists(path)
 
 
-@_sftp_switch(_sftp_mkdir)
+@_sftp_switch(_sftp_mkdir, retry=False)
 def mkdir(path):
     os.mkdir(path)
 
@@ -198,17 +468,17 @@ def makedirs(path, **kwargs):
     os.makedirs(path, **kwargs)
 
 
-@_sftp_switch(_sftp_remove)
+@_sftp_switch(_sftp_remove, retry=False)
 def remove(path):
     os.remove(path)
 
 
-@_sftp_switch(_sftp_rename)
+@_sftp_switch(_sftp_rename, retry=False)
 def rename(oldpath, newpath):
     os.rename(oldpath, newpath)
 
 
-@_sftp_switch(_sftp_move)
+@_sftp_switch(_sftp_move, retry=False)
 def move(oldpath, newpath):
     """
     Use this instead of 'rename' if, when using sftp, 'oldpath'
@@ -222,16 +492,38 @@ def get_mime_type(path):
     return os_get_mime_type(path)
 
 
+def get_magic(magic_file=None):
+    """
+    Returns this process's mime type detector for the magic database 'magic_file'
+    (the default database if None), compiling the database on first use.
+    Handles are shared by threads; python-magic serializes calls on a handle.
+    """
+    key = (os.getpid(), magic_file)
+    handle = _magic_handles.get(key)
+    if handle is None:
+        with _magic_handles_lock:
+            handle = _magic_handles.get(key)
+            if handle is None:
+                handle = _magic_handles[key] = magic.Magic(magic_file=magic_file, mime=True)
+    return handle
+
+
+def read_mime_header(fp):
+    """
+    Reads the leading bytes of a file needed to detect its mime type (MIME_SNIFF_BYTES).
+    """
+    return fp.read(current_app.config['MIME_SNIFF_BYTES'])
+
+
 def os_get_mime_type(path):
-    if current_app.config['MAGIC_FILE']:
-        # Check using custom mime database file
-        m = magic.Magic(
-            magic_file=current_app.config['MAGIC_FILE'],
-            mime=True)
-        mime_type = m.from_file(path)
-    else:
-        mime_type = magic.from_file(path, mime=True)
-    return mime_type
+    with open(path, 'rb') as fp:
+        return get_mime_type_from_buffer(read_mime_header(fp))
+
+
+def get_mime_type_from_buffer(buffer):
+    # Check using custom mime database file if there is one
+    return get_magic(current_app.config['MAGIC_FILE'] or None).from_buffer(
+        buffer[:current_app.config['MIME_SNIFF_BYTES']])
 
 
 @_sftp_switch(_sftp_get_hash)
@@ -246,33 +538,123 @@ def get_hash(path):
 def os_get_hash(path):
     sha1 = hashlib.sha1()
     with open(path, 'rb') as fp:
-        sha1.update(fp.read())
+        for block in iter(lambda: fp.read(INGEST_BLOCK_SIZE), b''):
+            sha1.update(block)
     return sha1.hexdigest()
 
 
-@_sftp_switch(_sftp_send_file)
-def send_file(directory, filename, **kwargs):
-    path = _get_file_serving_path(directory, filename)
-    # Move file to data directory if volume storage enabled
-    if current_app.config['USE_VOLUME_STORAGE']:
-        shutil.copy(os.path.join(directory, filename), path)
-    # Serve file from Azure if Azure storage is enabled
-    elif current_app.config['USE_AZURE_STORAGE']:
-        blob_url = azure_generate_blob_url(os.path.join(directory, filename))
-        return redirect(blob_url)
-    return send_from_directory(*os.path.split(path), **kwargs)
+class FileIngest(object):
+    """
+    Computes the size, mime type, and sha1 hash of a file in a single pass,
+    as its contents are written or read block by block.
+
+    Only the first MIME_SNIFF_BYTES bytes are kept (for the mime type);
+    the file is never held in memory as a whole.
+    """
+
+    def __init__(self):
+        self.size = 0
+        self._sha1 = hashlib.sha1()
+        self._header = b''
+        self._header_size = current_app.config['MIME_SNIFF_BYTES']
+
+    def update(self, block):
+        self.size += len(block)
+        self._sha1.update(block)
+        if len(self._header) < self._header_size:
+            self._header += block[:self._header_size - len(self._header)]
+
+    @property
+    def mime_type(self):
+        return get_mime_type_from_buffer(self._header)
+
+    @property
+    def hash(self):
+        return self._sha1.hexdigest()
+
+    @property
+    def metadata(self):
+        """
+        (size, mime type, hash), as expected by app.lib.redis_utils.redis_set_file_metadata
+        """
+        return self.size, self.mime_type, self.hash
+
+
+def ingest_copy(src, dst):
+    """
+    Copies the contents of file object 'src' to file object 'dst' block by block.
+
+    :return: FileIngest of the copied contents
+    """
+    ingest = FileIngest()
+    for block in iter(lambda: src.read(INGEST_BLOCK_SIZE), b''):
+        dst.write(block)
+        ingest.update(block)
+    return ingest
+
+
+@_sftp_switch(_sftp_get_file_metadata)
+def get_file_metadata(path):
+    """
+    Returns a tuple containing a file's
+        ( size (int), mime type (str), and hash (str) ).
+    """
+    return os_get_file_metadata(path)
+
+
+def os_get_file_metadata(path):
+    ingest = FileIngest()
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(INGEST_BLOCK_SIZE), b''):
+            ingest.update(block)
+    return ingest.metadata
+
+
+_azure_container_client = None
+_azure_container_client_pid = None
+
+
+def get_azure_container_client():
+    """
+    Returns the worker's ContainerClient for AZURE_STORAGE_CONTAINER.
+
+    The client (and its HTTP connection pool) is created once per process
+    and shared by every blob operation.
+    """
+    global _azure_container_client, _azure_container_client_pid
+    if _azure_container_client is None or _azure_container_client_pid != os.getpid():
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=current_app.config['AZURE_STORAGE_CONNECTION_POOL_SIZE'])
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        blob_service_client = BlobServiceClient.from_connection_string(
+            current_app.config['AZURE_STORAGE_CONNECTION_STRING'],
+            max_block_size=current_app.config['AZURE_STORAGE_MAX_BLOCK_SIZE'],
+            max_single_put_size=current_app.config['AZURE_STORAGE_MAX_BLOCK_SIZE'],
+            transport=RequestsTransport(session=session, session_owner=False))
+        _azure_container_client = blob_service_client.get_container_client(
+            current_app.config['AZURE_STORAGE_CONTAINER'])
+        _azure_container_client_pid = os.getpid()
+    return _azure_container_client
 
 
 def create_azure_blob_client(blob_name):
-    connection_string = os.getenv('AZURE_STORAGE_CONNECTION_STRING')
-    blob_service_client = BlobServiceClient.from_connection_string(connection_string)
-    return blob_service_client.get_blob_client(container=current_app.config['AZURE_STORAGE_CONTAINER'], blob=blob_name)
+    return get_azure_container_client().get_blob_client(blob_name)
 
 
 def azure_upload(source_path, blob_name):
+    """
+    Uploads a file to Azure, in blocks of AZURE_STORAGE_MAX_BLOCK_SIZE sent
+    AZURE_STORAGE_MAX_CONCURRENCY at a time, and removes the local copy.
+    """
     blob_client = create_azure_blob_client(blob_name)
     with open(source_path, 'rb') as data:
-        blob_client.upload_blob(data, overwrite=True)
+        blob_client.upload_blob(data,
+                                length=os.path.getsize(source_path),
+                                overwrite=True,
+                                max_concurrency=current_app.config['AZURE_STORAGE_MAX_CONCURRENCY'])
     os.remove(source_path)
 
 
@@ -305,6 +687,22 @@ def azure_delete(blob_name):
 
 
 def azure_copy(current_blob_name, new_blob_name):
+    """
+    Copies a blob and waits for the (server-side) copy to complete,
+    so the source can safely be deleted afterwards.
+    """
     blob_client = create_azure_blob_client(new_blob_name)
     url = azure_generate_blob_url(current_blob_name)
-    blob_client.start_copy_from_url(url)
+    copy = blob_client.start_copy_from_url(url)
+    status = copy['copy_status']
+    delay = AZURE_COPY_POLL_INTERVAL
+    deadline = time.time() + current_app.config['AZURE_STORAGE_COPY_TIMEOUT']
+    while status == 'pending':
+        if time.time() > deadline:
+            blob_client.abort_copy(copy['copy_id'])
+            raise AzureCopyFailedException(current_blob_name, new_blob_name, 'timed out')
+        time.sleep(delay)
+        delay = min(delay * 2, AZURE_COPY_MAX_POLL_INTERVAL)
+        status = blob_client.get_blob_properties().copy.status
+    if status != 'success':
+        raise AzureCopyFailedException(current_blob_name, new_blob_name, status)
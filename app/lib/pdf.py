@@ -1,50 +1,117 @@
-from flask import current_app
-from flask_weasyprint import render_pdf, HTML
-import jinja2
+import hashlib
+import io
+import os
 import subprocess
+import threading
+import time
+from contextlib import nullcontext
+from tempfile import TemporaryDirectory
 
-import os
-from tempfile import gettempdir, _get_candidate_names
+import jinja2
+from flask import current_app, has_request_context, jsonify, request as flask_request, send_file
+from flask_weasyprint import CSS, HTML
+from weasyprint.text.fonts import FontConfiguration
+from markupsafe import escape
 
+from app import celery, pdf_redis, sentry
 from app.constants.pdf import LATEX_TEMPLATE_CONFIG
 from app.lib.utils import PDFCreationException
 
+LATEX_BEGIN_DOCUMENT = '\\begin{document}'
+LATEX_END_DOCUMENT = '\\end{document}'
+PDF_PENDING = 'pending'
+PDF_FAILED = 'failed'
+PDF_INVALID = 'invalid'  # the document could not be generated from what was requested
+PDF_FAILURE_EXPIRY = 60  # seconds before a document that failed to compile is tried again
+PDF_POLL_INTERVAL = 2  # seconds a client waits before asking for a pending PDF again
+LATEX_FORMAT_FAILURE_EXPIRY = 3600  # seconds before a preamble that could not be dumped is dumped again
+
+_weasyprint_configs = {}
+_weasyprint_configs_lock = threading.Lock()
+
 
 class LatexCompiler:
     """
     Generates a PDF from a LaTeX file.
 
+    With a format directory, each distinct preamble (everything before \\begin{document}) is
+    dumped once into a format file (using the mylatexformat package) which later compiles load
+    instead of processing the document class and packages again.
+
     Slightly modified from: https://github.com/AKuederle/flask-template-master/
     """
-    LATEX_COMMAND = 'pdflatex -interaction=nonstopmode'
+    LATEX_COMMAND = 'pdflatex -interaction=nonstopmode -halt-on-error'
+    FORMAT_COMMAND = 'pdflatex -ini -interaction=nonstopmode -halt-on-error'
     FILE_EXTENSION = 'pdf'
 
-    _OUT_DIR = gettempdir()
-
-    def __init__(self, latex_command=None):
+    def __init__(self, latex_command=None, format_directory=None, timeout=None):
         self.LATEX_COMMAND = latex_command or self.LATEX_COMMAND
-        self._TEMP_OUT_NAME = next(_get_candidate_names())
+        self.format_directory = format_directory
+        self.timeout = timeout
+
+    def _run(self, command, cwd):
+        env = None
+        if self.format_directory:
+            # the trailing separator keeps TeX's default format search path
+            env = dict(os.environ, TEXFORMATS=self.format_directory + os.pathsep)
+        try:
+            proc = subprocess.run(command, cwd=cwd, env=env, timeout=self.timeout,
+                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except subprocess.TimeoutExpired as e:
+            raise PDFCreationException(status_code=-1, stdout=e.stdout or b'', stderr=b'Timed out')
+        if proc.returncode != 0:
+            raise PDFCreationException(status_code=proc.returncode, stdout=proc.stdout, stderr=proc.stderr)
+
+    def _get_format(self, document):
+        """
+        Returns the name of the format file preloading the document's preamble, building it if needed.
+
+        :param document: LaTeX formatted document (UTF-8 Formatted String)
+        :return: name of the format, or None if the document is compiled without one
+        """
+        if not self.format_directory or LATEX_BEGIN_DOCUMENT not in document:
+            return None
+        preamble = document[:document.index(LATEX_BEGIN_DOCUMENT)]
+        name = hashlib.sha256(preamble.encode('utf-8')).hexdigest()
+        path = os.path.join(self.format_directory, name + '.fmt')
+        if os.path.exists(path):
+            return name
+        failed_path = os.path.join(self.format_directory, name + '.failed')
+        try:
+            if time.time() - os.path.getmtime(failed_path) < LATEX_FORMAT_FAILURE_EXPIRY:
+                return None  # the preamble cannot be dumped, don't try again on every compile
+        except FileNotFoundError:
+            pass
+
+        os.makedirs(self.format_directory, exist_ok=True)
+        with TemporaryDirectory(dir=self.format_directory) as out_dir:
+            with open(os.path.join(out_dir, 'preamble.tex'), 'wb') as f:
+                f.write((preamble + LATEX_BEGIN_DOCUMENT + '\n' + LATEX_END_DOCUMENT + '\n').encode('utf-8'))
+            try:
+                self._run([*self.FORMAT_COMMAND.split(' '), '-jobname=' + name,
+                           '&pdflatex', 'mylatexformat.ltx', 'preamble.tex'], out_dir)
+            except PDFCreationException as e:
+                current_app.logger.exception("Failed to build LaTeX format {}".format(name))
+                if e.status_code > 0:
+                    # pdflatex rejected the preamble; a timeout or a killed process may succeed next time
+                    open(failed_path, 'w').close()
+                return None
+            # moved into place whole, so concurrent compiles never load a partial format
+            os.replace(os.path.join(out_dir, name + '.fmt'), path)
+        return name
 
     def _create_file(self, document):
-        temp_file = os.path.join(self._OUT_DIR, self._TEMP_OUT_NAME)
-        temp_tex = temp_file + '.tex'
-        with open(temp_tex, 'wb') as f:
-            f.write(document.encode('utf-8'))
-        proc = subprocess.Popen([*self.LATEX_COMMAND.split(' '), temp_tex], cwd=self._OUT_DIR, stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE)
-        return_code = proc.wait()
-        out, err = proc.communicate()
-        if return_code != 0:
-            raise PDFCreationException(status_code=return_code, stdout=out, stderr=err)  # TODO: Make this a proper error
-
-        data = None
-        with open('{filename}.{extension}'.format(filename=temp_file, extension=self.FILE_EXTENSION), 'rb') as f:
-            data = f.read()
-
-        os.remove('{filename}.{extension}'.format(filename=temp_file, extension=self.FILE_EXTENSION))
-        os.remove(temp_tex)
-
-        return data
+        with TemporaryDirectory() as out_dir:
+            with open(os.path.join(out_dir, 'document.tex'), 'wb') as f:
+                f.write(document.encode('utf-8'))
+            command = self.LATEX_COMMAND.split(' ')
+            format_name = self._get_format(document)
+            if format_name is not None:
+                command.append('-fmt=' + format_name)
+            self._run([*command, 'document.tex'], out_dir)
+
+            with open(os.path.join(out_dir, 'document.' + self.FILE_EXTENSION), 'rb') as f:
+                return f.read()
 
     def compile(self, document):
         """
@@ -56,28 +123,216 @@ class LatexCompiler:
         return file
 
 
+def hash_document(document):
+    return hashlib.sha256(document.encode('utf-8')).hexdigest()
+
+
+def get_pdf_key(document_hash):
+    return '|'.join(('pdf', document_hash))
+
+
+def get_pdf_status_key(document_hash):
+    return '|'.join(('pdf', 'status', document_hash))
+
+
+def get_cached_pdf(document_hash):
+    """
+    Returns the cached PDF of a document, or None if it has not been generated.
+
+    :param document_hash: hash of the document (see hash_document)
+    """
+    return pdf_redis.get(get_pdf_key(document_hash))
+
+
+def get_pdf_status(document_hash):
+    """
+    Returns PDF_PENDING while a document's PDF is being generated, PDF_FAILED (or PDF_INVALID) if
+    generating it failed recently, or None.
+    """
+    status = pdf_redis.get(get_pdf_status_key(document_hash))
+    return status.decode() if status is not None else None
+
+
+def cache_pdf(document_hash, pdf):
+    pipe = pdf_redis.pipeline()
+    pipe.set(get_pdf_key(document_hash), pdf, ex=current_app.config['PDF_CACHE_EXPIRY'])
+    pipe.delete(get_pdf_status_key(document_hash))
+    pipe.execute()
+
+
+def pdf_failed(document_hash, status=PDF_FAILED):
+    sentry.captureException()
+    current_app.logger.exception("Failed to generate PDF {}".format(document_hash))
+    pdf_redis.set(get_pdf_status_key(document_hash), status, ex=PDF_FAILURE_EXPIRY)
+
+
+def start_pdf(document_hash, task, *args):
+    """
+    Queues a task generating a PDF unless one is already pending (or recently failed).
+    """
+    status_key = get_pdf_status_key(document_hash)
+    if pdf_redis.set(status_key, PDF_PENDING, nx=True, ex=current_app.config['LATEX_COMPILE_TIMEOUT'] * 2):
+        task.apply_async(args, queue=current_app.config['PDF_CELERY_QUEUE'])
+
+
+def compile_latex(document):
+    """
+    Compiles a LaTeX document with the configured format directory and timeout.
+
+    :param document: LaTeX document
+    :return: PDF File Object
+    """
+    compiler = LatexCompiler(format_directory=current_app.config['LATEX_FORMAT_DIRECTORY'],
+                             timeout=current_app.config['LATEX_COMPILE_TIMEOUT'])
+    return compiler.compile(document)
+
+
+@celery.task
+def compile_latex_pdf(document):
+    """
+    Compiles a LaTeX document and caches the PDF by the document's hash.
+
+    :param document: LaTeX document
+    :return: hash of the document
+    """
+    document_hash = hash_document(document)
+    if not pdf_redis.exists(get_pdf_key(document_hash)):
+        try:
+            pdf = compile_latex(document)
+        except PDFCreationException:
+            pdf_failed(document_hash)
+            raise
+        cache_pdf(document_hash, pdf)
+    return document_hash
+
+
+def request_latex_pdf(document):
+    """
+    Returns the cached PDF of a LaTeX document. If it is not cached, compiling it is started
+    in the background (once, however many times it is requested meanwhile).
+
+    :param document: LaTeX document
+    :return: (hash of the document, PDF File Object or None)
+    """
+    document_hash = hash_document(document)
+    pdf = get_cached_pdf(document_hash)
+    if pdf is None:
+        start_pdf(document_hash, compile_latex_pdf, document)
+    return document_hash, pdf
+
+
+def pdf_response(document_hash, pdf, filename, as_attachment=True):
+    """
+    Returns the PDF if it is ready (or an error if generating it failed); otherwise a 202 handle to poll
+    (the same url) until it is.
+    Browsers get a page that reloads itself, other clients get JSON.
+
+    :param document_hash: hash of the document
+    :param pdf: PDF File Object or None (see request_latex_pdf)
+    :param filename: name the PDF is downloaded as
+    :param as_attachment: whether the PDF is downloaded rather than displayed
+    """
+    if pdf is not None:
+        return send_file(io.BytesIO(pdf),
+                         mimetype='application/pdf',
+                         as_attachment=as_attachment,
+                         download_name=filename)
+    status = get_pdf_status(document_hash)
+    if status == PDF_FAILED:
+        return jsonify({'error': 'Failed to generate the PDF.'}), 500
+    if status == PDF_INVALID:
+        return jsonify({'error': 'The PDF cannot be generated from what was requested.'}), 400
+
+    if flask_request.accept_mimetypes.best == 'application/json':
+        response = jsonify({'status': PDF_PENDING, 'poll': flask_request.url})
+    else:
+        response = current_app.response_class(
+            '<html><head><meta http-equiv="refresh" content="{interval}"></head>'
+            '<body>Generating {filename}&hellip;</body></html>'.format(interval=PDF_POLL_INTERVAL,
+                                                                     filename=escape(filename)),
+            mimetype='text/html')
+    response.status_code = 202
+    response.headers['Retry-After'] = PDF_POLL_INTERVAL
+    return response
+
+
+def get_weasyprint_config():
+    """
+    Returns this process's WeasyPrint font configuration and the parsed LETTER_STYLESHEETS,
+    loaded on first use and shared by every letter rendered afterwards.
+
+    :return: (FontConfiguration, list of CSS)
+    """
+    key = os.getpid()
+    config = _weasyprint_configs.get(key)
+    if config is None:
+        with _weasyprint_configs_lock:
+            config = _weasyprint_configs.get(key)
+            if config is None:
+                font_config = FontConfiguration()
+                stylesheets = [CSS(filename=path, font_config=font_config)
+                               for path in current_app.config['LETTER_STYLESHEETS']]
+                config = _weasyprint_configs[key] = (font_config, stylesheets)
+    return config
+
+
+def _pdf_request_context():
+    """
+    flask_weasyprint resolves urls (e.g. the /static images in letters) through the request being handled.
+    PDF workers only have an application context, so they render within a request for BASE_URL.
+    """
+    if has_request_context():
+        return nullcontext()
+    return current_app.test_request_context(base_url=current_app.config['BASE_URL'])
+
+
 def generate_pdf(pdf_data):
     """
     Generate a PDF from a string of data.
     :param pdf_data: String of data to input into PDF.
     :return: PDF File object
     """
-
-    html = HTML(string=pdf_data)
-    f = html.write_pdf()
+    with _pdf_request_context():
+        font_config, stylesheets = get_weasyprint_config()
+        html = HTML(string=pdf_data)
+        f = html.write_pdf(stylesheets=stylesheets, font_config=font_config)
 
     return f
 
 
-def generate_pdf_flask_response(pdf_data):
+@celery.task
+def render_html_pdf(document):
     """
-    Return a Flask response object with a PDF as an attachment.
-    :param pdf_data: String of data to input into PDF.
-    :return: Flask Response
+    Renders an HTML document (a letter) and caches the PDF by the document's hash.
+
+    :param document: HTML document
+    :return: hash of the document
+    :raises PDFCreationException: if the document could not be rendered
     """
-    html = HTML(string=pdf_data)
+    document_hash = hash_document(document)
+    if not pdf_redis.exists(get_pdf_key(document_hash)):
+        try:
+            pdf = generate_pdf(document)
+        except Exception as e:
+            pdf_failed(document_hash)
+            raise PDFCreationException(status_code=1, stderr=str(e).encode()) from e
+        cache_pdf(document_hash, pdf)
+    return document_hash
 
-    return render_pdf(html)
+
+def request_html_pdf(document):
+    """
+    Returns the cached PDF of an HTML document. If it is not cached, rendering it is started
+    in the background (once, however many times it is requested meanwhile).
+
+    :param document: HTML document
+    :return: (hash of the document, PDF File Object or None)
+    """
+    document_hash = hash_document(document)
+    pdf = get_cached_pdf(document_hash)
+    if pdf is None:
+        start_pdf(document_hash, render_html_pdf, document)
+    return document_hash, pdf
 
 
 def generate_envelope(template_name, data):
@@ -88,22 +343,42 @@ def generate_envelope(template_name, data):
     :param data: Data to be filled in to the LaTeX template (Dict())
     :return: LaTeX document
     """
-    environment = jinja2.Environment(loader=jinja2.FileSystemLoader(current_app.config['LATEX_TEMPLATE_DIRECTORY']),
-                                     **LATEX_TEMPLATE_CONFIG)
-    document = environment.get_template(template_name + '.tex').render(**data)
+    document = get_latex_template(template_name).render(**data)
 
     return document
 
 
-def generate_envelope_pdf(document):
+def get_latex_template(template_name):
     """
-    Generate a PDF envelope.
-    :param document: LaTeX document.
-    :return: PDF File Object
+    Load a LaTeX template, to render any number of documents from.
+
+    :param template_name: The LaTeX template to be loaded.
+    :return: jinja2.Template
     """
-    compiler = LatexCompiler()
+    environment = jinja2.Environment(loader=jinja2.FileSystemLoader(current_app.config['LATEX_TEMPLATE_DIRECTORY']),
+                                     **LATEX_TEMPLATE_CONFIG)
+    return environment.get_template(template_name + '.tex')
 
-    return compiler.compile(document)
+
+def combine_latex_documents(documents):
+    """
+    Combine LaTeX documents sharing a preamble (e.g. rendered from the same template) into one
+    document, each starting on a new page, so they are compiled (and printed) together.
+
+    :param documents: LaTeX documents
+    :return: LaTeX document
+    """
+    preamble = None
+    bodies = []
+    for document in documents:
+        begin = document.index(LATEX_BEGIN_DOCUMENT)
+        end = document.rindex(LATEX_END_DOCUMENT)
+        if preamble is None:
+            preamble = document[:begin]
+        elif document[:begin] != preamble:
+            raise ValueError("Only documents with the same preamble can be combined.")
+        bodies.append(document[begin + len(LATEX_BEGIN_DOCUMENT):end])
+    return preamble + LATEX_BEGIN_DOCUMENT + '\n\\newpage\n'.join(bodies) + LATEX_END_DOCUMENT + '\n'
 
 
 def escape_latex_characters(line):
@@ -1,12 +1,12 @@
 from functools import wraps
 
-from flask import abort, request, redirect
+from flask import abort, g, has_request_context, request, redirect
 from flask_login import current_user, login_url
-from sqlalchemy.orm.exc import NoResultFound
-from app import login_manager, sentry
+from app import db, login_manager
 from app.constants import permission
 from app.models import (
     Users,
+    UserRequests,
     Responses,
     Files,
     Notes,
@@ -63,23 +63,52 @@ def has_super():
 
 def is_allowed(user: Users, request_id: str, permission: int):
     """
+    Checks to see if the user has the specified permission on a request.
 
-    :param user:
-    :param request_id:
-    :param permissions:
-    :return:
+    :param user: Users object (or the anonymous current_user)
+    :param request_id: FOIL request ID
+    :param permission: permission value from app.constants.permission
+    :return: Boolean
+    """
+    permissions = get_user_request_permissions(user, request_id)
+    return permissions is not None and bool(permissions & permission)
+
+
+def get_user_request_permissions(user: Users, request_id: str):
     """
-    try:
-        user_request = user.user_requests.filter_by(request_id=request_id).one()
-        return True if user_request.has_permission(permission) else False
+    Returns the permissions bitmask a user holds on a request.
+
+    The bitmask is loaded with a single query the first time it is needed and memoized
+    for the rest of the Flask request, so any number of is_allowed checks for the same
+    user and request are evaluated as in-memory bit tests. Outside of a Flask request
+    (e.g. in Celery tasks, which share one application context) it is always loaded.
 
-    except NoResultFound:
-        sentry.captureException()
-        return False
+    :param user: Users object (or the anonymous current_user)
+    :param request_id: FOIL request ID
+    :return: permissions bitmask or None if the user is not associated with the request
+    """
+    guid = getattr(user, 'guid', None)
+    if guid is None:
+        return None
 
-    except AttributeError:
-        sentry.captureException()
-        return False
+    cache = g.setdefault('user_request_permissions', {}) if has_request_context() else {}
+    key = (guid, request_id)
+    if key not in cache:
+        cache[key] = db.session.query(UserRequests.permissions).filter(
+            UserRequests.user_guid == guid,
+            UserRequests.request_id == request_id
+        ).scalar()
+    return cache[key]
+
+
+def clear_permissions_cache():
+    """
+    Clears the memoized permissions bitmasks (see get_user_request_permissions).
+
+    Called before every Flask request and whenever a UserRequests entry is created, edited, or removed.
+    """
+    if has_request_context():
+        g.pop('user_request_permissions', None)
 
 
 def get_permission(permission_type: str, response_type: Responses):
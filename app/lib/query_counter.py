@@ -0,0 +1,169 @@
+"""
+    app.lib.query_counter
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    synopsis: Counts and times the SQL statements issued while handling a Flask request and flags
+    identical statements that are repeated often enough to suggest an N+1 query pattern.
+
+    Enabled with the SQL_QUERY_COUNTER_ENABLED setting. Each response then carries the
+    X-Query-Count and X-Query-Time headers and a summary line is written to the application log.
+
+"""
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from flask import current_app, g, has_request_context, request as flask_request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Stack of QueryStats objects recording outside of a Flask request (see count_queries)
+_recorders = []
+_listening = False
+
+
+class QueryBudgetExceededException(AssertionError):
+    def __init__(self, stats, max_queries):
+        """
+        Exception used when a block of code issues more queries than its budget allows.
+
+        :param stats: QueryStats recorded for the block
+        :param max_queries: Maximum number of queries allowed
+        """
+        super(QueryBudgetExceededException, self).__init__(
+            "Expected at most {max_queries} queries, {count} were issued:\n{statements}".format(
+                max_queries=max_queries,
+                count=stats.count,
+                statements="\n".join(
+                    "{}x {}".format(times, statement) for statement, times in stats.statements.most_common()
+                )
+            )
+        )
+
+
+class QueryStats(object):
+    """
+    Running totals for the SQL statements issued within a single unit of work.
+
+    count - number of statements executed
+    duration - total time spent executing statements (seconds)
+    statements - Counter of statement text to the number of times it was executed
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.statements = Counter()
+
+    def record(self, statement, duration):
+        self.count += 1
+        self.duration += duration
+        self.statements[statement] += 1
+
+    def duplicates(self, threshold):
+        """
+        Return the statements that were executed at least 'threshold' times, most frequent first.
+
+        :param threshold: minimum number of executions for a statement to be flagged
+        :return: list of (statement, times executed) tuples
+        """
+        return [(statement, times) for statement, times in self.statements.most_common() if times >= threshold]
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start_time', []).append(time.time())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration = time.time() - conn.info['query_start_time'].pop()
+    for stats in _recorders:
+        stats.record(statement, duration)
+    if has_request_context() and getattr(g, 'query_stats', None) is not None:
+        g.query_stats.record(statement, duration)
+
+
+def _handle_error(exception_context):
+    # a failed statement never reaches after_cursor_execute, so its start time is discarded here
+    conn = exception_context.connection
+    if conn is not None and conn.info.get('query_start_time'):
+        conn.info['query_start_time'].pop()
+
+
+def _listen():
+    global _listening
+    if not _listening:
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(Engine, 'handle_error', _handle_error)
+        _listening = True
+
+
+@contextmanager
+def count_queries():
+    """
+    Context manager that yields a QueryStats object recording every SQL statement issued inside the block.
+    """
+    _listen()
+    stats = QueryStats()
+    _recorders.append(stats)
+    try:
+        yield stats
+    finally:
+        _recorders.remove(stats)
+
+
+@contextmanager
+def query_budget(max_queries):
+    """
+    Context manager that raises a QueryBudgetExceededException if the block issues more than 'max_queries'
+    SQL statements.
+
+    Ex:
+        with query_budget(10):
+            client.get('/request/view/FOIL-2019-002-00001')
+
+    :param max_queries: maximum number of statements allowed
+    """
+    with count_queries() as stats:
+        yield stats
+    if stats.count > max_queries:
+        raise QueryBudgetExceededException(stats, max_queries)
+
+
+def init_app(app):
+    """
+    Register the query counter with the Flask application if SQL_QUERY_COUNTER_ENABLED is set.
+
+    :param app: Flask application
+    """
+    if not app.config['SQL_QUERY_COUNTER_ENABLED']:
+        return
+
+    _listen()
+
+    @app.before_request
+    def start_query_stats():
+        g.query_stats = QueryStats()
+
+    @app.after_request
+    def report_query_stats(response):
+        stats = getattr(g, 'query_stats', None)
+        if stats is None:
+            return response
+        g.query_stats = None
+        response.headers['X-Query-Count'] = str(stats.count)
+        response.headers['X-Query-Time'] = '{:.1f}'.format(stats.duration * 1000)
+        current_app.logger.info("{method} {path}: {count} queries in {duration:.1f}ms".format(
+            method=flask_request.method,
+            path=flask_request.path,
+            count=stats.count,
+            duration=stats.duration * 1000
+        ))
+        duplicates = stats.duplicates(current_app.config['SQL_QUERY_DUPLICATE_THRESHOLD'])
+        if duplicates:
+            current_app.logger.warning("Possible N+1 queries in {method} {path}:\n{statements}".format(
+                method=flask_request.method,
+                path=flask_request.path,
+                statements="\n".join("{}x {}".format(times, statement) for statement, times in duplicates)
+            ))
+        return response
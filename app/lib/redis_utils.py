@@ -5,25 +5,23 @@ try:
 except ImportError:
     import pickle
 
-from app import upload_redis as redis
-from app.lib.file_utils import (
-    os_get_hash,
-    os_get_mime_type
-)
+from app import upload_redis as redis, fragment_redis
+from app.lib.file_utils import os_get_file_metadata
 
 
 # Redis File Utilities
-def redis_set_file_metadata(request_or_response_id, filepath, is_update=False):
+def redis_set_file_metadata(request_or_response_id, filepath, is_update=False, metadata=None):
     """
     Stores a file's size, mime type, and hash.
+
+    :param metadata: the file's (size, mime type, hash) if already known
+        (e.g. computed while the file was written), otherwise they are
+        computed in a single read of the file
     """
+    size, mime_type, hash_ = metadata or os_get_file_metadata(filepath)
     redis.set(
         _get_file_metadata_key(request_or_response_id, filepath, is_update),
-        ':'.join((
-            str(os.path.getsize(filepath)),
-            os_get_mime_type(filepath),
-            os_get_hash(filepath)
-        ))
+        ':'.join((str(size), mime_type, hash_))
     )
 
 
@@ -53,3 +51,51 @@ def _get_file_metadata_key(request_or_response_id, filepath, is_update):
     return '|'.join((str(request_or_response_id),
                      os.path.basename(filepath),
                      'update' if is_update else 'new'))
+
+
+# Redis Response Fragment Utilities
+def redis_get_response_fragments_generation(request_id):
+    """
+    Returns the current generation of the cached response fragments of a request.
+    Fragments are stored under their generation so bumping it invalidates all of them at once.
+    """
+    return int(fragment_redis.get(_get_response_fragments_generation_key(request_id)) or 0)
+
+
+def redis_get_response_fragments(request_id, generation, fragment_keys):
+    """
+    Returns a list containing the cached html (str) or None for each of the fragment keys.
+    """
+    if not fragment_keys:
+        return []
+    return [fragment.decode() if fragment is not None else None
+            for fragment in fragment_redis.mget(
+                [_get_response_fragment_key(request_id, generation, key) for key in fragment_keys])]
+
+
+def redis_set_response_fragments(request_id, generation, fragments, timeout):
+    """
+    Stores rendered html fragments.
+
+    :param fragments: dictionary of fragment keys to html
+    :param timeout: seconds until the fragments expire
+    """
+    pipe = fragment_redis.pipeline()
+    for key, fragment in fragments.items():
+        pipe.set(_get_response_fragment_key(request_id, generation, key), fragment, ex=timeout)
+    pipe.execute()
+
+
+def redis_invalidate_response_fragments(request_id):
+    """
+    Invalidates all cached response fragments of a request.
+    """
+    fragment_redis.incr(_get_response_fragments_generation_key(request_id))
+
+
+def _get_response_fragments_generation_key(request_id):
+    return 'response_fragments|{}'.format(request_id)
+
+
+def _get_response_fragment_key(request_id, generation, fragment_key):
+    return 'response_fragment|{}|{}|{}'.format(request_id, generation, fragment_key)
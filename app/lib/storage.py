@@ -0,0 +1,257 @@
+"""
+    app.lib.storage
+    ~~~~~~~~~~~~~~~
+
+    synopsis: Storage backends for uploaded files.
+
+    Every place that stores, serves, moves or deletes an uploaded file goes through
+    the backend returned by get_storage() instead of branching on the
+    USE_VOLUME_STORAGE / USE_SFTP / USE_AZURE_STORAGE settings.
+
+    Paths are the same absolute paths used elsewhere (e.g. UPLOAD_DIRECTORY/<FOIL-ID>/<filename>);
+    the Azure backend uses them as blob names.
+
+"""
+import mimetypes
+import os
+import shutil
+from io import BytesIO
+from urllib.parse import quote, urljoin
+
+from flask import abort, current_app, redirect, send_file, send_from_directory
+from werkzeug.security import safe_join
+
+from app.lib import file_utils as fu
+
+
+class StorageBackend(object):
+    """
+    Interface for a place uploaded files are kept.
+
+    put - store a local file (the local file is consumed)
+    stream - iterate over the contents of a stored file in blocks
+    exists - whether a file is stored at a path
+    move - move a stored file to another path
+    delete - remove a stored file
+    url - a url the file can be downloaded from directly, if the backend has one
+    send_file - a response serving a stored file (file_hash, the file's sha1, lets backends verify copies)
+    """
+    name = None
+
+    def put(self, local_path, path):
+        raise NotImplementedError
+
+    def stream(self, path, block_size=fu.INGEST_BLOCK_SIZE):
+        raise NotImplementedError
+
+    def exists(self, path):
+        raise NotImplementedError
+
+    def move(self, path, new_path):
+        raise NotImplementedError
+
+    def delete(self, path):
+        raise NotImplementedError
+
+    def url(self, path):
+        return None
+
+    def send_file(self, directory, filename, file_hash=None, **kwargs):
+        raise NotImplementedError
+
+
+class VolumeStorage(StorageBackend):
+    """
+    Files kept on a locally mounted volume.
+    """
+    name = 'volume'
+
+    def put(self, local_path, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.move(local_path, path)
+
+    def stream(self, path, block_size=fu.INGEST_BLOCK_SIZE):
+        with open(path, 'rb') as fp:
+            for block in iter(lambda: fp.read(block_size), b''):
+                yield block
+
+    def exists(self, path):
+        return os.path.exists(path)
+
+    def move(self, path, new_path):
+        os.makedirs(os.path.dirname(new_path), exist_ok=True)
+        shutil.move(path, new_path)
+
+    def delete(self, path):
+        os.remove(path)
+
+    def send_file(self, directory, filename, file_hash=None, **kwargs):
+        if current_app.config['FILE_SERVING_OFFLOAD']:
+            return offload_send_file(directory, filename, **kwargs)
+        return send_from_directory(directory, filename, **kwargs)
+
+
+class SFTPStorage(StorageBackend):
+    """
+    Files kept on the SFTP server (using the worker's pooled sessions, see file_utils.sftp_ctx).
+    """
+    name = 'sftp'
+
+    def put(self, local_path, path):
+        with fu.sftp_ctx() as sftp:
+            fu._sftp_makedirs(sftp, os.path.dirname(path))
+            sftp.put(local_path, path)
+        os.remove(local_path)
+
+    def stream(self, path, block_size=fu.INGEST_BLOCK_SIZE):
+        with fu.sftp_ctx() as sftp:
+            with sftp.open(path, 'rb') as fp:
+                fp.prefetch()
+                for block in iter(lambda: fp.read(block_size), b''):
+                    yield block
+
+    def exists(self, path):
+        with fu.sftp_ctx() as sftp:
+            return fu._sftp_exists(sftp, path)
+
+    def move(self, path, new_path):
+        with fu.sftp_ctx() as sftp:
+            fu._sftp_makedirs(sftp, os.path.dirname(new_path))
+            sftp.rename(path, new_path)
+
+    def delete(self, path):
+        with fu.sftp_ctx() as sftp:
+            sftp.remove(path)
+
+    def send_file(self, directory, filename, file_hash=None, **kwargs):
+        localpath = fu._get_file_serving_path(directory, filename, file_hash)
+        # served from the local cache without an SFTP session when possible
+        if not fu._touch(localpath):
+            with fu.sftp_ctx() as sftp:
+                fu._sftp_get_cached_file(sftp, os.path.join(directory, filename), localpath, file_hash)
+        return send_from_directory(*os.path.split(localpath), **kwargs)
+
+
+class AzureStorage(StorageBackend):
+    """
+    Files kept as blobs in AZURE_STORAGE_CONTAINER.
+    """
+    name = 'azure'
+
+    def put(self, local_path, path):
+        fu.azure_upload(local_path, path)
+
+    def stream(self, path, block_size=fu.INGEST_BLOCK_SIZE):
+        downloader = fu.create_azure_blob_client(path).download_blob(
+            max_concurrency=current_app.config['AZURE_STORAGE_MAX_CONCURRENCY'])
+        for block in downloader.chunks():
+            yield block
+
+    def exists(self, path):
+        return fu.azure_exists(path)
+
+    def move(self, path, new_path):
+        fu.azure_copy(path, new_path)
+        fu.azure_delete(path)
+
+    def delete(self, path):
+        fu.azure_delete(path)
+
+    def url(self, path):
+        return fu.azure_generate_blob_url(path)
+
+    def send_file(self, directory, filename, file_hash=None, **kwargs):
+        return redirect(self.url(os.path.join(directory, filename)))
+
+
+class MemoryStorage(StorageBackend):
+    """
+    Files kept in a dictionary, for tests and benchmarks.
+    """
+    name = 'memory'
+
+    def __init__(self):
+        self.files = {}
+
+    def put(self, local_path, path):
+        with open(local_path, 'rb') as fp:
+            self.files[path] = fp.read()
+        os.remove(local_path)
+
+    def stream(self, path, block_size=fu.INGEST_BLOCK_SIZE):
+        data = self.files[path]
+        for start in range(0, len(data), block_size):
+            yield data[start:start + block_size]
+
+    def exists(self, path):
+        return path in self.files
+
+    def move(self, path, new_path):
+        self.files[new_path] = self.files.pop(path)
+
+    def delete(self, path):
+        del self.files[path]
+
+    def send_file(self, directory, filename, file_hash=None, **kwargs):
+        kwargs.setdefault('download_name', filename)
+        return send_file(BytesIO(self.files[os.path.join(directory, filename)]), **kwargs)
+
+
+def offload_send_file(directory, filename, as_attachment=False, **kwargs):
+    """
+    Returns an empty response telling the web server to send the file itself
+    (see FILE_SERVING_OFFLOAD), so the file is neither copied nor streamed through the app.
+
+    :param directory: directory of the file (within UPLOAD_DIRECTORY)
+    :param filename: name of the file
+    :param as_attachment: whether to send a Content-Disposition: attachment header
+    """
+    path = safe_join(directory, filename)
+    if path is None:
+        abort(404)  # the filename escapes the directory
+    response = current_app.response_class(
+        mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+    if current_app.config['FILE_SERVING_OFFLOAD'] == 'nginx':
+        response.headers['X-Accel-Redirect'] = quote(urljoin(
+            current_app.config['FILE_SERVING_ACCEL_PREFIX'],
+            os.path.relpath(path, current_app.config['UPLOAD_DIRECTORY'])))
+    else:
+        response.headers['X-Sendfile'] = path
+    if as_attachment:
+        try:
+            filename.encode('latin-1')
+        except UnicodeEncodeError:
+            response.headers['Content-Disposition'] = "attachment; filename*=UTF-8''{}".format(quote(filename))
+        else:
+            response.headers.set('Content-Disposition', 'attachment', filename=filename)
+    return response
+
+
+STORAGE_BACKENDS = {
+    backend.name: backend for backend in (VolumeStorage, SFTPStorage, AzureStorage, MemoryStorage)
+}
+
+
+def get_storage_backend_name(config):
+    """
+    Returns the name of the configured storage backend.
+    STORAGE_BACKEND takes precedence over the USE_AZURE_STORAGE and USE_SFTP settings.
+    """
+    if config.get('STORAGE_BACKEND'):
+        return config['STORAGE_BACKEND']
+    if config['USE_AZURE_STORAGE']:
+        return AzureStorage.name
+    if config['USE_SFTP']:
+        return SFTPStorage.name
+    return VolumeStorage.name
+
+
+def get_storage():
+    """
+    Returns the application's StorageBackend (created once per application).
+    """
+    storage = current_app.extensions.get('storage')
+    if storage is None:
+        storage = STORAGE_BACKENDS[get_storage_backend_name(current_app.config)]()
+        current_app.extensions['storage'] = storage
+    return storage
@@ -66,6 +66,7 @@ class PDFCreationException(Exception):
         :param stdout: STDOUT output
         :param stderr: STDERR output
         """
+        self.status_code = status_code
         super(PDFCreationException, self).__init__(
             "Failed to create PDF: \n\nStatus Code: {status_code}\n\nSTDOUT:\n{stdout}\n\nSTDERR:\n{stderr}".format(
                 status_code=status_code, stdout=str(stdout, 'utf-8'), stderr=str(stderr, 'utf-8'))
@@ -2,7 +2,9 @@
 Models for OpenRecords database
 """
 import csv
+import hashlib
 import json
+import zlib
 from datetime import datetime
 from urllib.parse import urljoin
 from uuid import uuid4
@@ -11,10 +13,11 @@ from elasticsearch.helpers import bulk
 from flask import current_app, session
 from flask_login import UserMixin, AnonymousUserMixin, current_user
 from functools import reduce
+from itertools import chain
 from operator import ior
-from sqlalchemy import desc
-from sqlalchemy.dialects.postgresql import ARRAY, JSONB
-from sqlalchemy.orm import column_property
+from sqlalchemy import desc, event
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB, insert as postgresql_insert
+from sqlalchemy.orm import Session, column_property
 from sqlalchemy.orm.exc import MultipleResultsFound
 from warnings import warn
 
@@ -164,6 +167,8 @@ class Agencies(db.Model):
     name - a string containing the name of the agency
     next_request_number - a sequence containing the next number for the request starting at 1, each agency has its own
                           request number sequence
+    request_number_year - the year next_request_number counts requests for; the counter starts again at 1 when a
+                          request number is allocated for a later year
     default_email - a string containing the default email of the agency regarding general inquiries about requests
     appeal_email - a string containing the appeal email for users regarding the agency closing or denying requests
     is_active - a boolean field denoting whether an agency is currently using the OpenRecords system to serve FOIL
@@ -189,6 +194,7 @@ class Agencies(db.Model):
     _next_request_number = db.Column(
         db.Integer(), db.Sequence("request_seq"), name="next_request_number"
     )
+    request_number_year = db.Column(db.Integer())
     default_email = db.Column(db.String(254))
     appeals_email = db.Column(db.String(254))
     is_active = db.Column(db.Boolean(), default=False)
@@ -244,15 +250,11 @@ class Agencies(db.Model):
 
     @property
     def next_request_number(self):
-        from app.lib.db_utils import update_object
-
-        num = self._next_request_number
-        update_object(
-            {"_next_request_number": self._next_request_number + 1},
-            Agencies,
-            self.formatted_parent_ein,
-        )
-        return num
+        """
+        The next request number of the agency. Use app.request.utils.allocate_request_number
+        to claim a request number.
+        """
+        return self._next_request_number
 
     @next_request_number.setter
     def next_request_number(self, value):
@@ -411,13 +413,41 @@ class Users(UserMixin, db.Model):
         """
         return self.is_nyc_employee
 
+    @property
+    def agency_memberships(self):
+        """
+        Returns the user's agency memberships keyed by agency ein:
+            {ein: {'is_agency_admin': bool, 'is_agency_active': bool, 'is_read_only': bool, 'is_primary_agency': bool}}
+
+        The memberships are loaded with a single query and kept on this object, which lives for a single
+        Flask request. They are discarded whenever AgencyUsers rows are flushed (see _clear_agency_memberships)
+        and whenever the user is expired, e.g. on commit or rollback (see _expire_agency_memberships).
+        :return: Dictionary
+        """
+        if getattr(self, "_agency_memberships", None) is None:
+            self._agency_memberships = {
+                agency_ein: {
+                    "is_agency_admin": is_agency_admin,
+                    "is_agency_active": is_agency_active,
+                    "is_read_only": is_read_only,
+                    "is_primary_agency": is_primary_agency,
+                }
+                for agency_ein, is_agency_admin, is_agency_active, is_read_only, is_primary_agency in db.session.query(
+                    AgencyUsers.agency_ein,
+                    AgencyUsers.is_agency_admin,
+                    AgencyUsers.is_agency_active,
+                    AgencyUsers.is_read_only,
+                    AgencyUsers.is_primary_agency,
+                ).filter(AgencyUsers.user_guid == self.guid)
+            }
+        return self._agency_memberships
+
     @property
     def get_agencies(self):
         """
         Returns a list of the agency ein's the user belongs to.
         """
-        agencies = AgencyUsers.query.filter_by(user_guid=self.guid).all()
-        return [agency.agency_ein for agency in agencies]
+        return list(self.agency_memberships)
 
     @property
     def default_agency_ein(self):
@@ -425,16 +455,9 @@ class Users(UserMixin, db.Model):
         Return the Users default agency ein.
         :return: String
         """
-        agency = (
-            AgencyUsers.query.join(Users)
-            .filter(
-                AgencyUsers.is_primary_agency == True,
-                AgencyUsers.user_guid == self.guid,
-            )
-            .one_or_none()
-        )
-        if agency is not None:
-            return agency.agency_ein
+        for ein, membership in self.agency_memberships.items():
+            if membership["is_primary_agency"]:
+                return ein
         return None
 
     @property
@@ -444,9 +467,9 @@ class Users(UserMixin, db.Model):
         If the user is admin for multiple agencies it will return the first one.
         :return: Agency ein
         """
-        for agency in AgencyUsers.query.filter_by(user_guid=self.guid):
-            if self.is_agency_admin(agency.agency_ein):
-                return agency.agency_ein
+        for ein, membership in self.agency_memberships.items():
+            if membership["is_agency_admin"]:
+                return ein
 
     @property
     def default_agency(self):
@@ -484,10 +507,10 @@ class Users(UserMixin, db.Model):
         Determine if a user is an admin for at least one agency.
         :return: Boolean
         """
-        for agency in self.agency_users.all():
-            if agency.is_agency_admin:
-                return True
-        return False
+        return any(
+            membership["is_agency_admin"]
+            for membership in self.agency_memberships.values()
+        )
 
     @property
     def has_agency_active(self):
@@ -495,10 +518,10 @@ class Users(UserMixin, db.Model):
         Determine if a user is active for at least one agency.
         :return: Boolean
         """
-        for agency in self.agency_users.all():
-            if agency.is_agency_active:
-                return True
-        return False
+        return any(
+            membership["is_agency_active"]
+            for membership in self.agency_memberships.values()
+        )
 
     def is_agency_admin(self, ein=None):
         """
@@ -508,10 +531,7 @@ class Users(UserMixin, db.Model):
         """
         if ein is None:
             ein = self.default_agency_ein
-        for agency in self.agency_users.all():
-            if agency.agency_ein == ein:
-                return agency.is_agency_admin
-        return False
+        return self.agency_memberships.get(ein, {}).get("is_agency_admin", False)
 
     def is_agency_active(self, ein=None):
         """
@@ -521,11 +541,7 @@ class Users(UserMixin, db.Model):
         """
         if ein is None:
             ein = self.default_agency_ein
-        for agency in self.agency_users.all():
-            if agency.agency_ein == ein:
-                return agency.is_agency_active
-        return False
-
+        return self.agency_memberships.get(ein, {}).get("is_agency_active", False)
 
     def is_agency_read_only(self, ein=None):
         """
@@ -535,10 +551,7 @@ class Users(UserMixin, db.Model):
         """
         if ein is None:
             ein = self.default_agency_ein
-        for agency in self.agency_users.all():
-            if agency.agency_ein == ein:
-                return agency.is_read_only
-        return False
+        return self.agency_memberships.get(ein, {}).get("is_read_only", False)
 
     def agencies_for_forms(self):
         agencies = self.agencies.with_entities(Agencies.ein, Agencies._name).all()
@@ -746,6 +759,33 @@ class AgencyUsers(db.Model):
     is_read_only = db.Column(db.Boolean, default=False, server_default="false", nullable=False)
 
 
+@event.listens_for(Session, "after_flush")
+def _clear_agency_memberships(session, flush_context):
+    """
+    Discard the memoized agency memberships (see Users.agency_memberships) of
+    any user whose AgencyUsers rows were added, changed, or deleted.
+    """
+    guids = set(
+        obj.user_guid
+        for obj in chain(session.new, session.dirty, session.deleted)
+        if isinstance(obj, AgencyUsers)
+    )
+    if guids:
+        for obj in session.identity_map.values():
+            if isinstance(obj, Users) and obj.guid in guids:
+                obj._agency_memberships = None
+
+
+@event.listens_for(Users, "expire")
+def _expire_agency_memberships(target, attrs):
+    """
+    Discard a user's memoized agency memberships (see Users.agency_memberships) along with the
+    rest of its state, i.e. on every commit and rollback, so changes made by bulk statements or
+    other processes are picked up.
+    """
+    target._agency_memberships = None
+
+
 class Requests(db.Model):
     """
     Define the Requests class with the following columns and relationships:
@@ -1091,6 +1131,7 @@ class Events(db.Model):
 
     __table_args__ = (
         db.ForeignKeyConstraint([user_guid], [Users.guid], onupdate="CASCADE"),
+        db.Index("ix_events_request_id_timestamp_id", request_id, timestamp, id),
     )
 
     response = db.relationship("Responses", backref="events")
@@ -1123,7 +1164,8 @@ class Events(db.Model):
     @property
     def affected_user(self):
         if self.new_value is not None and "user_guid" in self.new_value:
-            return Users.query.filter_by(guid=self.new_value["user_guid"]).one()
+            # Query.get is served from the identity map when the user is already loaded
+            return Users.query.get(self.new_value["user_guid"])
 
     class RowContent(object):
         def __init__(
@@ -1698,6 +1740,43 @@ class Instructions(Responses):
         return self.content
 
 
+class EmailBodies(db.Model):
+    """
+    Define the EmailBodies class with the following columns and relationships:
+
+    hash - a string containing the sha256 of the body, the primary key of EmailBodies
+    data - the zlib-compressed body
+
+    Identical bodies (boilerplate notifications, status digests) are stored once and
+    referenced by every email sent with them.
+    """
+
+    __tablename__ = "email_bodies"
+    hash = db.Column(db.String(64), primary_key=True)
+    data = db.Column(db.LargeBinary, nullable=False)
+
+    @property
+    def text(self):
+        return zlib.decompress(self.data).decode("utf-8")
+
+    @staticmethod
+    def store(body):
+        """
+        Stores a body, if it is not stored already.
+
+        :param body: string containing the body of an email
+        :return: hash of the stored body
+        """
+        encoded = body.encode("utf-8")
+        hash_ = hashlib.sha256(encoded).hexdigest()
+        db.session.execute(
+            postgresql_insert(EmailBodies.__table__)
+            .values(hash=hash_, data=zlib.compress(encoded))
+            .on_conflict_do_nothing(index_elements=["hash"])
+        )
+        return hash_
+
+
 class Emails(Responses):
     """
     Define the Emails class with the following columns and relationships:
@@ -1707,7 +1786,9 @@ class Emails(Responses):
     cc - a string containing who is cc'd in an email
     bcc -  a string containing who is bcc'd in an email
     subject - a string containing the subject of an email
-    email_content - a string containing the content of an email
+    body_hash - a string containing the hash of the content of the email (foreign key to EmailBodies)
+
+    body - a string containing the content of an email (stored in EmailBodies)
     """
 
     __tablename__ = response_type.EMAIL
@@ -1717,7 +1798,7 @@ class Emails(Responses):
     cc = db.Column(db.String)
     bcc = db.Column(db.String)
     subject = db.Column(db.String(5000))
-    body = db.Column(db.String)
+    body_hash = db.Column(db.String(64), db.ForeignKey(EmailBodies.hash), index=True)
 
     def __init__(
         self,
@@ -1738,6 +1819,17 @@ class Emails(Responses):
         self.subject = subject
         self.body = body
 
+    @property
+    def body(self):
+        if self.body_hash is None:
+            return None
+        # from the session's identity map when the body was already loaded
+        return EmailBodies.query.get(self.body_hash).text
+
+    @body.setter
+    def body(self, body):
+        self.body_hash = EmailBodies.store(body) if body is not None else None
+
     @property
     def preview(self):
         return self.subject
@@ -2007,6 +2099,10 @@ class CommunicationMethods(db.Model):
         nullable=True,
     )
 
+    __table_args__ = (
+        db.Index("ix_communication_methods_method_id", method_id),
+    )
+
     def __init__(self, response_id, method_id, method_type):
         self.response_id = response_id
         self.method_id = method_id
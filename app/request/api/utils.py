@@ -1,7 +1,13 @@
+from datetime import datetime
+
+from flask import abort
 from flask_login import current_user
+from sqlalchemy import exists
 
+from app.constants import response_privacy, response_type
 from app.lib.db_utils import create_object
-from app.models import Events
+from app.lib.permission_utils import get_user_request_permissions
+from app.models import CommunicationMethods, Events, Responses
 
 
 def create_request_info_event(request_id, type_, previous_value, new_value):
@@ -17,4 +23,100 @@ def create_request_info_event(request_id, type_, previous_value, new_value):
                    type_=type_,
                    previous_value=previous_value,
                    new_value=new_value)
-    create_object(event)
\ No newline at end of file
+    create_object(event)
+
+EVENTS_CURSOR_TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+CSRF_TOKEN_PLACEHOLDER = '__csrf_token__'
+
+
+def format_events_cursor(event):
+    """
+    Create the keyset cursor pointing after an event in the request history.
+    :param event: last Events object of a page of events
+    :return: cursor string ("<timestamp>|<id>")
+    """
+    return '{}|{}'.format(event.timestamp.strftime(EVENTS_CURSOR_TIMESTAMP_FORMAT), event.id)
+
+
+def parse_events_cursor(cursor):
+    """
+    Parse a keyset cursor created by format_events_cursor.
+    Aborts with a 400 if the cursor is malformed.
+    :param cursor: cursor string ("<timestamp>|<id>")
+    :return: tuple of (timestamp, event id)
+    """
+    try:
+        timestamp, id_ = cursor.split('|')
+        return datetime.strptime(timestamp, EVENTS_CURSOR_TIMESTAMP_FORMAT), int(id_)
+    except ValueError:
+        abort(400, 'Invalid cursor.')
+
+
+def get_request_responses_query(current_request, user):
+    """
+    Build the query for the responses of a request that are visible to a user.
+
+    Emails and letters that are the communication method of another response are excluded with a
+    correlated NOT EXISTS subquery against communication_methods, so the cost of the query does not
+    grow with the size of that table.
+
+    :param current_request: Requests object
+    :param user: user viewing the responses (current_user)
+    :return: Query of Responses (unordered)
+    """
+    query = Responses.query.filter(
+        Responses.request_id == current_request.id,
+        ~exists().where(CommunicationMethods.method_id == Responses.id),
+        Responses.type != response_type.EMAIL,
+        Responses.deleted == False
+    )
+
+    if user.is_agency and \
+            (user in current_request.agency_users or
+             user.is_agency_read_only(current_request.agency.ein)):
+        # If the user is an agency user assigned to the request, all responses can be retrieved.
+        return query
+    elif user == current_request.requester:
+        # If the user is the requester, then only responses that are "Release and Private" or "Release and Public"
+        # can be retrieved.
+        return query.filter(
+            Responses.privacy.in_([response_privacy.RELEASE_AND_PRIVATE, response_privacy.RELEASE_AND_PUBLIC])
+        )
+    # If the user is not an agency user assigned to the request or the requester, then only responses that are
+    # "Release and Public" whose release date is not in the future can be retrieved.
+    return query.filter(
+        Responses.privacy.in_([response_privacy.RELEASE_AND_PUBLIC]),
+        Responses.release_date.isnot(None),
+        Responses.release_date < datetime.utcnow()
+    )
+
+
+def get_response_fragment_key(current_request, response, start, row_count, user):
+    """
+    Build the cache key for the rendered row and modal of a response (see redis_utils.redis_get_response_fragments).
+
+    The key covers everything the templates depend on besides the response itself: its position on the page,
+    the request status, and the viewer's role and permissions bitmask. Notes are also rendered differently
+    for the user who created them.
+
+    :param current_request: Requests object the response belongs to
+    :param response: Responses object
+    :param start: index of the first response on the page
+    :param row_count: position of the response on the page (starting at 1)
+    :param user: user viewing the response (current_user)
+    :return: cache key string
+    """
+    viewer = [
+        'agency' if user.is_agency else 'public',
+        str(get_user_request_permissions(user, current_request.id) or 0),
+    ]
+    if response.type == response_type.NOTE:
+        viewer.append('creator' if user == response.creator else 'viewer')
+    return ':'.join([
+        str(response.id),
+        response.date_modified.strftime(EVENTS_CURSOR_TIMESTAMP_FORMAT),
+        str(start),
+        str(row_count),
+        current_request.status,
+    ] + viewer)
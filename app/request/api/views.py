@@ -4,15 +4,16 @@
    :synopsis: Handles the API request URL endpoints for the OpenRecords application
 """
 
-from datetime import datetime
-
 from flask import (
+    current_app,
     jsonify,
     render_template,
     request as flask_request,
 )
 from flask_login import current_user, login_required
-from sqlalchemy import desc
+from flask_wtf.csrf import generate_csrf
+from sqlalchemy import desc, func, tuple_
+from sqlalchemy.orm import joinedload
 
 from app.constants import RESPONSES_INCREMENT, EVENTS_INCREMENT
 from app.constants import (
@@ -23,15 +24,27 @@ from app.constants import (
     request_status,
 )
 from app.lib.db_utils import update_object
+from app.lib.redis_utils import (
+    redis_get_response_fragments,
+    redis_get_response_fragments_generation,
+    redis_set_response_fragments
+)
 from app.lib.permission_utils import (
     is_allowed,
     get_permission
 )
 from app.lib.utils import eval_request_bool
-from app.models import CommunicationMethods, Requests, Responses, Events
+from app.models import Requests, Responses, Events, Users
 from app.permissions.utils import get_permissions_as_list
 from app.request.api import request_api_blueprint
-from app.request.api.utils import create_request_info_event
+from app.request.api.utils import (
+    CSRF_TOKEN_PLACEHOLDER,
+    create_request_info_event,
+    format_events_cursor,
+    get_request_responses_query,
+    get_response_fragment_key,
+    parse_events_cursor
+)
 
 
 @request_api_blueprint.route('/edit_privacy', methods=['GET', 'POST'])
@@ -110,23 +123,45 @@ def get_request_events():
     Returns a set of events (id, type, and template),
     ordered by date descending, and starting from a specific index.
 
+    Events are paginated with a keyset cursor on (timestamp, id) so loading more
+    history only reads the rows that are returned.
+
     Request parameters:
-    - start: (int) starting index
+    - start: (int) starting index (used to number rows; also used as an offset when no cursor is supplied)
+    - cursor: (optional) the 'next_cursor' value returned with the previous set of events
     - request_id: FOIL request id
     - with_template: (default: False) include html rows for each event
     """
     start = int(flask_request.args['start'])
+    cursor = flask_request.args.get('cursor')
 
     current_request = Requests.query.filter_by(id=flask_request.args['request_id']).one()
 
-    events = Events.query.filter(
+    events_query = Events.query.filter(
         Events.request_id == current_request.id,
         Events.type.in_(event_type.FOR_REQUEST_HISTORY)
+    )
+    total = events_query.with_entities(func.count(Events.id)).scalar()
+
+    if cursor:
+        timestamp, id_ = parse_events_cursor(cursor)
+        events_query = events_query.filter(tuple_(Events.timestamp, Events.id) < tuple_(timestamp, id_))
+    else:
+        events_query = events_query.offset(start)
+    events = events_query.options(
+        joinedload(Events.user)
     ).order_by(
-        desc(Events.timestamp)
-    ).all()
-    total = len(events)
-    events = events[start: start + EVENTS_INCREMENT]
+        desc(Events.timestamp),
+        desc(Events.id)
+    ).limit(EVENTS_INCREMENT).all()
+
+    # Load the users affected by these events in one query so Events.affected_user is served from the identity map.
+    affected_user_guids = set(event.new_value['user_guid'] for event in events
+                              if event.new_value is not None and 'user_guid' in event.new_value)
+    if affected_user_guids:
+        Users.query.filter(Users.guid.in_(affected_user_guids)).all()
+
+    next_cursor = format_events_cursor(events[-1]) if len(events) == EVENTS_INCREMENT else None
 
     template_path = 'request/events/'
     event_jsons = []
@@ -195,7 +230,7 @@ def get_request_events():
 
         event_jsons.append(json)
 
-    return jsonify(events=event_jsons, total=total)
+    return jsonify(events=event_jsons, total=total, next_cursor=next_cursor)
 
 
 @request_api_blueprint.route('/responses', methods=['GET'])
@@ -212,125 +247,121 @@ def get_request_responses():
 
     current_request = Requests.query.filter_by(id=flask_request.args['request_id']).one()
 
-    if current_user.is_agency and \
-            (current_user in current_request.agency_users or
-             current_user.is_agency_read_only(current_request.agency.ein)):
-        # If the user is an agency user assigned to the request, all responses can be retrieved.
-        responses = Responses.query.filter(
-            Responses.request_id == current_request.id,
-            ~Responses.id.in_([cm.method_id for cm in CommunicationMethods.query.all()]),
-            Responses.type != response_type.EMAIL,
-            Responses.deleted == False
-        ).order_by(
-            desc(Responses.date_modified)
-        ).all()
-    elif current_user == current_request.requester:
-        # If the user is the requester, then only responses that are "Release and Private" or "Release and Public"
-        # can be retrieved.
-        responses = Responses.query.filter(
-            Responses.request_id == current_request.id,
-            ~Responses.id.in_([cm.method_id for cm in CommunicationMethods.query.all()]),
-            Responses.type != response_type.EMAIL,
-            Responses.deleted == False,
-            Responses.privacy.in_([response_privacy.RELEASE_AND_PRIVATE, response_privacy.RELEASE_AND_PUBLIC])
-        ).order_by(
-            desc(Responses.date_modified)
-        ).all()
+    responses_query = get_request_responses_query(current_request, current_user)
+    total = responses_query.with_entities(func.count(Responses.id)).scalar()
+    responses = responses_query.order_by(
+        desc(Responses.date_modified),
+        desc(Responses.id)
+    ).offset(start).limit(RESPONSES_INCREMENT).all()
+
+    with_template = eval_request_bool(flask_request.args.get('with_template'))
+    use_fragment_cache = with_template and current_app.config['RESPONSE_FRAGMENT_CACHE_ENABLED']
+
+    # Rendered rows and modals are cached per response, row position, and viewer permissions.
+    fragment_keys = []
+    cached_fragments = []
+    if use_fragment_cache:
+        fragment_keys = [get_response_fragment_key(current_request, response, start, row_count, current_user)
+                         for row_count, response in enumerate(responses, start=1)]
+        generation = redis_get_response_fragments_generation(current_request.id)
+        cached_fragments = redis_get_response_fragments(current_request.id, generation, fragment_keys)
 
-    else:
-        # If the user is not an agency user assigned to the request or the requester, then only responses that are
-        # "Release and Public" whose release date is not in the future can be retrieved.
-        responses = Responses.query.filter(
-            Responses.request_id == current_request.id,
-            ~Responses.id.in_([cm.method_id for cm in CommunicationMethods.query.all()]),
-            Responses.type != response_type.EMAIL,
-            Responses.deleted == False,
-            Responses.privacy.in_([response_privacy.RELEASE_AND_PUBLIC]),
-            Responses.release_date.isnot(None),
-            Responses.release_date < datetime.utcnow()
-        ).order_by(
-            desc(Responses.date_modified)
-        ).all()
-
-    total = len(responses)
-    responses = responses[start: start + RESPONSES_INCREMENT]
-    template_path = 'request/responses/'
     response_jsons = []
-    row_count = 0
-    for response in responses:
+    rendered_fragments = {}
+    for row_count, response in enumerate(responses, start=1):
         json = {
             'id': response.id,
             'type': response.type
         }
-        if eval_request_bool(flask_request.args.get('with_template')):
-            row_count += 1
-            row = render_template(
-                template_path + 'row.html',
-                response=response,
-                row_num=start + row_count,
-                row_html_id='response-row-{}'.format(str(row_count)),
-                response_type=response_type,
-                determination_type=determination_type,
-                show_preview=not (response.type == response_type.DETERMINATION and
-                                  (response.dtype == determination_type.ACKNOWLEDGMENT or
-                                   response.dtype == determination_type.REOPENING))
-            )
-            modal = render_template(
-                template_path + 'modal.html',
-                response=response,
-                requires_workflow=response.type in response_type.EMAIL_WORKFLOW_TYPES,
-                modal_body=render_template(
-                    "{}modal_body/{}.html".format(
-                        template_path, response.type
-                    ),
-                    response=response,
-                    modal_html_id="response-modal-body-{}".format(str(row_count)),
-                    privacies=[response_privacy.RELEASE_AND_PUBLIC,
-                               response_privacy.RELEASE_AND_PRIVATE,
-                               response_privacy.PRIVATE],
-                    determination_type=determination_type,
-                    request_status=request_status,
-                    edit_response_privacy_permission=is_allowed(user=current_user,
-                                                                request_id=response.request_id,
-                                                                permission=get_permission(
-                                                                    permission_type='privacy',
-                                                                    response_type=type(
-                                                                        response))),
-                    edit_response_permission=is_allowed(user=current_user,
-                                                        request_id=response.request_id,
-                                                        permission=get_permission(permission_type='edit',
-                                                                                  response_type=type(
-                                                                                      response))),
-                    delete_response_permission=is_allowed(user=current_user,
-                                                          request_id=response.request_id,
-                                                          permission=get_permission(permission_type='delete',
-                                                                                    response_type=type(response))),
-                    is_editable=response.is_editable,
-                    current_request=current_request
-
-                ),
-                response_type=response_type,
-                determination_type=determination_type,
-                request_status=request_status,
-                edit_response_permission=is_allowed(user=current_user,
-                                                    request_id=response.request_id,
-                                                    permission=get_permission(permission_type='edit',
-                                                                              response_type=type(response))),
-                delete_response_permission=is_allowed(user=current_user,
-                                                      request_id=response.request_id,
-                                                      permission=get_permission(permission_type='delete',
-                                                                                response_type=type(response))),
-                edit_response_privacy_permission=is_allowed(user=current_user,
-                                                            request_id=response.request_id,
-                                                            permission=get_permission(
-                                                                permission_type='privacy',
-                                                                response_type=type(
-                                                                    response))),
-                is_editable=response.is_editable,
-                current_request=current_request
-            )
-            json['template'] = row + modal
+        if with_template:
+            if use_fragment_cache and cached_fragments[row_count - 1] is not None:
+                template = cached_fragments[row_count - 1]
+            else:
+                template = _render_response_template(response, start, row_count, current_request)
+                if use_fragment_cache:
+                    rendered_fragments[fragment_keys[row_count - 1]] = template
+            json['template'] = template.replace(CSRF_TOKEN_PLACEHOLDER, generate_csrf())
 
         response_jsons.append(json)
 
+    if rendered_fragments:
+        redis_set_response_fragments(current_request.id,
+                                     generation,
+                                     rendered_fragments,
+                                     current_app.config['RESPONSE_FRAGMENT_CACHE_TIMEOUT'])
+
     return jsonify(responses=response_jsons, total=total)
+
+
+def _render_response_template(response, start, row_count, current_request):
+    """
+    Render the row and modal html for a response on the view request page.
+
+    The CSRF token is rendered as CSRF_TOKEN_PLACEHOLDER so the html can be cached and shared
+    between sessions; the caller substitutes the token of the current session.
+
+    :param response: Responses object
+    :param start: index of the first response on the page
+    :param row_count: position of the response on the page (starting at 1)
+    :param current_request: Requests object the response belongs to
+    :return: html string
+    """
+    template_path = 'request/responses/'
+    # Permission checks are bit tests against the memoized bitmask (see get_user_request_permissions)
+    edit_response_permission = is_allowed(user=current_user,
+                                          request_id=response.request_id,
+                                          permission=get_permission(permission_type='edit',
+                                                                    response_type=type(response)))
+    delete_response_permission = is_allowed(user=current_user,
+                                            request_id=response.request_id,
+                                            permission=get_permission(permission_type='delete',
+                                                                      response_type=type(response)))
+    edit_response_privacy_permission = is_allowed(user=current_user,
+                                                  request_id=response.request_id,
+                                                  permission=get_permission(permission_type='privacy',
+                                                                            response_type=type(response)))
+    row = render_template(
+        template_path + 'row.html',
+        response=response,
+        row_num=start + row_count,
+        row_html_id='response-row-{}'.format(str(row_count)),
+        response_type=response_type,
+        determination_type=determination_type,
+        show_preview=not (response.type == response_type.DETERMINATION and
+                          (response.dtype == determination_type.ACKNOWLEDGMENT or
+                           response.dtype == determination_type.REOPENING))
+    )
+    modal = render_template(
+        template_path + 'modal.html',
+        response=response,
+        requires_workflow=response.type in response_type.EMAIL_WORKFLOW_TYPES,
+        modal_body=render_template(
+            "{}modal_body/{}.html".format(
+                template_path, response.type
+            ),
+            response=response,
+            modal_html_id="response-modal-body-{}".format(str(row_count)),
+            privacies=[response_privacy.RELEASE_AND_PUBLIC,
+                       response_privacy.RELEASE_AND_PRIVATE,
+                       response_privacy.PRIVATE],
+            determination_type=determination_type,
+            request_status=request_status,
+            edit_response_privacy_permission=edit_response_privacy_permission,
+            edit_response_permission=edit_response_permission,
+            delete_response_permission=delete_response_permission,
+            is_editable=response.is_editable,
+            current_request=current_request,
+            csrf_token=lambda: CSRF_TOKEN_PLACEHOLDER
+
+        ),
+        response_type=response_type,
+        determination_type=determination_type,
+        request_status=request_status,
+        edit_response_permission=edit_response_permission,
+        delete_response_permission=delete_response_permission,
+        edit_response_privacy_permission=edit_response_privacy_permission,
+        is_editable=response.is_editable,
+        current_request=current_request,
+        csrf_token=lambda: CSRF_TOKEN_PLACEHOLDER
+    )
+    return row + modal
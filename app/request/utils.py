@@ -11,6 +11,7 @@ import os
 import uuid
 from datetime import datetime
 from tempfile import NamedTemporaryFile
+from threading import Lock
 from urllib.parse import urljoin
 
 from flask import (
@@ -20,10 +21,11 @@ from flask import (
     escape
 )
 from flask_login import current_user
+from sqlalchemy import case
 from werkzeug.utils import secure_filename
 
 import app.lib.file_utils as fu
-from app import upload_redis, sentry
+from app import db, upload_redis, sentry
 from app.constants import (
     event_type,
     role_name as role,
@@ -36,13 +38,15 @@ from app.constants.response_privacy import (
     PRIVATE
 )
 from app.constants.submission_methods import DIRECT_INPUT
-from app.lib.db_utils import create_object, update_object
+from app.lib.db_utils import create_object
 from app.lib.email_utils import (
     get_assigned_users_emails,
     send_contact_email
 )
+from app.lib.permission_utils import clear_permissions_cache
 from app.lib.user_information import create_mailing_address
 from app.lib.redis_utils import redis_set_file_metadata
+from app.lib.storage import get_storage
 from app.lib.date_utils import (
     get_following_date,
     get_due_date,
@@ -74,6 +78,10 @@ from app.upload.utils import (
     get_upload_key
 )
 
+# Request numbers reserved by this worker, keyed by parent agency ein (see allocate_request_number)
+_request_number_blocks = {}
+_request_number_lock = Lock()
+
 
 def create_request(title,
                    description,
@@ -186,13 +194,11 @@ def create_request(title,
         ))
 
     if upload_path is not None:
-        # Store file metadata
-        file_mimetype = fu.get_mime_type(upload_path)
-        file_size = fu.getsize(upload_path)
-        file_hash = fu.get_hash(upload_path)
+        # Store file metadata (the quarantined upload is always local)
+        file_size, file_mimetype, file_hash = fu.os_get_file_metadata(upload_path)
 
         # 7. Move file to upload directory
-        upload_path = _move_validated_upload(request_id, upload_path)
+        upload_path = _move_validated_upload(request_id, upload_path, (file_size, file_mimetype, file_hash))
         # 8. Create response object
         filename = os.path.basename(upload_path)
         response = Files(request_id,
@@ -247,6 +253,7 @@ def create_request(title,
                                 permissions=Roles.query.filter_by(
                                     name=role_name).first().permissions)
     create_object(user_request)
+    clear_permissions_cache()
     create_object(Events(
         request_id,
         guid_for_event,
@@ -359,30 +366,24 @@ def _quarantine_upload_no_id(upload_file):
         return fp.name
 
 
-def _move_validated_upload(request_id, tmp_path):
+def _move_validated_upload(request_id, tmp_path, metadata=None):
     """
     Move an approved upload to the upload directory.
 
     :param request_id: the id of the request associated with the upload
     :param tmp_path: the temporary file path to the upload
         generated by app.request.utils._quarantine_upload_no_id()
+    :param metadata: the upload's (size, mime type, hash), if already computed
     """
     dst_dir = os.path.join(
         current_app.config['UPLOAD_DIRECTORY'],
         request_id)
-    if not fu.exists(dst_dir):
-        fu.mkdir(dst_dir)
     valid_name = os.path.basename(tmp_path).split('.', 1)[1]  # remove 'tmp' prefix
     valid_path = os.path.join(dst_dir, valid_name)
     # store file metadata in redis
-    redis_set_file_metadata(request_id, tmp_path)
+    redis_set_file_metadata(request_id, tmp_path, metadata=metadata)
 
-    # Move file to data directory if volume storage is enabled
-    if current_app.config['USE_VOLUME_STORAGE']:
-        fu.move(tmp_path, valid_path)
-    # Upload file to Azure if Azure storage is enabled
-    elif current_app.config['USE_AZURE_STORAGE']:
-        fu.azure_upload(tmp_path, valid_path)
+    get_storage().put(tmp_path, valid_path)
 
     upload_redis.set(
         get_upload_key(request_id, valid_name),
@@ -400,22 +401,75 @@ def generate_request_id(agency_ein):
     if agency_ein:
         agency = Agencies.query.filter_by(
             ein=agency_ein).one()  # This is the actual agency (including sub-agencies)
-        next_request_number = Agencies.query.filter_by(
-            ein=agency.formatted_parent_ein).one().next_request_number  # Parent agencies handle the request counting, not sub-agencies
-        agency_ein = agency.parent_ein
-        request_id = "FOIL-{0:s}-{1!s}-{2:05d}".format(
-            datetime.utcnow().strftime("%Y"), agency_ein, int(next_request_number))
-        if Requests.query.filter_by(id=request_id).one_or_none():
-            update_object(
-                {'next_request_number': next_request_number + 1},
-                Agencies,
-                agency.ein
-            )
-            request_id = generate_request_id(agency.ein)
+        year = datetime.utcnow().year
+        next_request_number = allocate_request_number(
+            agency.formatted_parent_ein, year)  # Parent agencies handle the request counting, not sub-agencies
+        request_id = "FOIL-{0:d}-{1!s}-{2:05d}".format(
+            year, agency.parent_ein, next_request_number)
         return request_id
     return None
 
 
+def allocate_request_number(parent_ein, year):
+    """
+    Allocates the next request number of a parent agency.
+
+    Numbers are reserved from agencies.next_request_number in blocks of REQUEST_NUMBER_BLOCK_SIZE
+    and handed out from memory until the block is used up, so most requests do not touch the
+    agencies table at all. Blocks are only valid for the year they were reserved in since the
+    counter starts again at 1 for each year (see _reserve_request_numbers).
+
+    A block size greater than 1 means numbers reserved by a worker that is restarted are never used.
+
+    :param parent_ein: ein of the parent agency (formatted with a leading 0)
+    :param year: year the request number will be used for
+    :return: request number
+    """
+    with _request_number_lock:
+        block = _request_number_blocks.get(parent_ein)
+        if block is None or block['year'] != year or block['next'] >= block['end']:
+            block_size = current_app.config['REQUEST_NUMBER_BLOCK_SIZE']
+            start = _reserve_request_numbers(parent_ein, year, block_size)
+            block = {'year': year, 'next': start, 'end': start + block_size}
+            _request_number_blocks[parent_ein] = block
+        request_number = block['next']
+        block['next'] += 1
+    return request_number
+
+
+def _reserve_request_numbers(parent_ein, year, count):
+    """
+    Atomically reserves 'count' consecutive request numbers of a year for a parent agency with a
+    single UPDATE ... RETURNING statement. Concurrent reservations are serialized by the row lock
+    instead of retrying on request id collisions.
+
+    The counter belongs to agencies.request_number_year; the first reservation for a later year
+    starts it again at 1 in the same statement, so numbers are never handed out twice for a year
+    whenever (and in whichever timezone) the year changes.
+
+    :param parent_ein: ein of the parent agency (formatted with a leading 0)
+    :param year: year the request numbers will be used for
+    :param count: number of request numbers to reserve
+    :return: the first reserved request number
+    """
+    agencies = Agencies.__table__
+    next_request_number = db.session.execute(
+        agencies.update().where(
+            agencies.c.ein == parent_ein
+        ).values(
+            next_request_number=case(
+                (agencies.c.request_number_year == year, agencies.c.next_request_number),
+                else_=1
+            ) + count,
+            request_number_year=year
+        ).returning(
+            agencies.c.next_request_number
+        )
+    ).scalar()
+    db.session.commit()
+    return next_request_number - count
+
+
 def generate_email_template(template_name, **kwargs):
     """
     Generate HTML for rich-text emails.
@@ -542,6 +596,7 @@ def _create_agency_user_requests(request_id, agency_admins, guid_for_event):
                                     permissions=Roles.query.filter_by(
                                         name=role.AGENCY_ADMIN).first().permissions)
         create_object(user_request)
+        clear_permissions_cache()
         create_object(Events(
             request_id,
             guid_for_event,
@@ -295,29 +295,20 @@ def view(request_id):
     }
 
     # Build permissions dictionary for checking on the front-end.
+    # The current user's permissions bitmask is fetched once and each check is a bit test.
     for key, val in permissions.items():
-        if (
-            current_user.is_anonymous
-            or not current_request.user_requests.filter_by(
-                user_guid=current_user.guid
-            ).first()
-        ):
-            permissions[key] = False
-        else:
-            permissions[key] = (
-                is_allowed(current_user, request_id, val)
-                if not current_user.is_anonymous
-                else False
-            )
+        permissions[key] = is_allowed(current_user, request_id, val)
 
     # Build dictionary of current permissions for all assigned users.
     assigned_user_permissions = {}
-    for u in assigned_users:
-        assigned_user_permissions[u.guid] = (
-            UserRequests.query.filter_by(request_id=request_id, user_guid=u.guid)
-            .one()
-            .get_permission_choice_indices()
-        )
+    if assigned_users:
+        for user_request in UserRequests.query.filter(
+            UserRequests.request_id == request_id,
+            UserRequests.user_guid.in_([u.guid for u in assigned_users]),
+        ):
+            assigned_user_permissions[
+                user_request.user_guid
+            ] = user_request.get_permission_choice_indices()
 
     point_of_contact = get_current_point_of_contact(request_id)
     if point_of_contact:
@@ -6,6 +6,7 @@
 
 """
 import json
+import uuid
 from datetime import datetime
 from urllib.parse import urljoin, urlencode
 from lxml.html.clean import clean_html
@@ -29,7 +30,7 @@ from sqlalchemy.orm import joinedload
 from werkzeug.utils import secure_filename
 
 import app.lib.file_utils as fu
-from app import email_redis, calendar, sentry
+from app import celery, email_redis, pdf_redis, calendar, sentry
 from app.auth.utils import find_user_by_email
 from app.constants import (
     event_type,
@@ -50,6 +51,7 @@ from app.constants import (
     permission,
     TINYMCE_EDITABLE_P_TAG
 )
+from app.constants.pdf import EnvelopeDict
 from app.constants.request_date import RELEASE_PUBLIC_DAYS
 from app.constants.response_privacy import PRIVATE, RELEASE_AND_PUBLIC, RELEASE_AND_PRIVATE
 from app.lib.date_utils import (
@@ -63,12 +65,26 @@ from app.lib.date_utils import (
 from app.lib.db_utils import create_object, update_object, delete_object
 from app.lib.email_utils import send_email, get_assigned_users_emails
 from app.lib.pdf import (
-    generate_pdf,
+    PDF_INVALID,
+    cache_pdf,
+    combine_latex_documents,
+    compile_latex,
+    compile_latex_pdf,
+    escape_latex_characters,
     generate_envelope,
-    generate_envelope_pdf
+    get_cached_pdf,
+    get_latex_template,
+    pdf_failed,
+    render_html_pdf,
+    start_pdf
 )
-from app.lib.redis_utils import redis_get_file_metadata, redis_delete_file_metadata
-from app.lib.utils import eval_request_bool, UserRequestException, DuplicateFileException
+from app.lib.redis_utils import (
+    redis_get_file_metadata,
+    redis_delete_file_metadata,
+    redis_invalidate_response_fragments
+)
+from app.lib.storage import get_storage
+from app.lib.utils import eval_request_bool, UserRequestException, DuplicateFileException, PDFCreationException
 from app.models import (
     CommunicationMethods,
     Events,
@@ -111,9 +127,7 @@ def add_file(request_id, filename, title, privacy, is_dataset, dataset_descripti
         size, mime_type, hash_ = redis_get_file_metadata(request_id, path)
         redis_delete_file_metadata(request_id, path)
     except AttributeError:
-        size = fu.getsize(path)
-        mime_type = fu.get_mime_type(path)
-        hash_ = fu.get_hash(path)
+        size, mime_type, hash_ = fu.get_file_metadata(path)
         sentry.captureException()
 
     try:
@@ -228,23 +242,13 @@ def add_acknowledgment(request_id, info, days, date, tz_name, content, method, l
             letter_id = _add_letter(request_id, letter_template.title, content,
                                     event_type.ACKNOWLEDGMENT_LETTER_CREATED)
             _create_communication_method(response.id, letter_id, response_type.LETTER)
-            letter = generate_pdf(content)
-            email_template = os.path.join(current_app.config['EMAIL_TEMPLATE_DIR'],
-                                          EMAIL_TEMPLATE_FOR_EVENT[event_type.ACKNOWLEDGMENT_LETTER_CREATED])
-            email_content = render_template(email_template,
-                                            request_id=request_id,
-                                            agency_name=request.agency.name,
-                                            user=current_user
-                                            )
-            email_id = safely_send_and_add_email(request_id,
-                                                 email_content,
-                                                 'Request {} Acknowledged - Letter'.format(request_id),
-                                                 to=get_assigned_users_emails(request_id),
-                                                 attachment=letter,
-                                                 filename=secure_filename(
-                                                     '{}_acknowledgment_letter.pdf'.format(request_id)),
-                                                 mimetype='application/pdf')
-            _create_communication_method(response.id, email_id, response_type.EMAIL)
+            _email_letter(request_id,
+                          response.id,
+                          request.agency.name,
+                          content,
+                          event_type.ACKNOWLEDGMENT_LETTER_CREATED,
+                          'Request {} Acknowledged - Letter'.format(request_id),
+                          secure_filename('{}_acknowledgment_letter.pdf'.format(request_id)))
         else:
             email_id = _send_response_email(request_id,
                                             privacy,
@@ -323,22 +327,13 @@ def add_denial(request_id, reason_ids, content, method, letter_template_id):
             letter_template = LetterTemplates.query.filter_by(id=letter_template_id).one()
             letter_id = _add_letter(request_id, letter_template.title, content, event_type.DENIAL_LETTER_CREATED)
             _create_communication_method(response.id, letter_id, response_type.LETTER)
-            letter = generate_pdf(content)
-            email_template = os.path.join(current_app.config['EMAIL_TEMPLATE_DIR'],
-                                          EMAIL_TEMPLATE_FOR_EVENT[event_type.DENIAL_LETTER_CREATED])
-            email_content = render_template(email_template,
-                                            request_id=request_id,
-                                            agency_name=request.agency.name,
-                                            user=current_user
-                                            )
-            email_id = safely_send_and_add_email(request_id,
-                                                 email_content,
-                                                 'Request {} Closed'.format(request_id),
-                                                 to=get_assigned_users_emails(request_id),
-                                                 attachment=letter,
-                                                 filename=secure_filename('{}_denial_letter.pdf'.format(request_id)),
-                                                 mimetype='application/pdf')
-            _create_communication_method(response.id, email_id, response_type.EMAIL)
+            _email_letter(request_id,
+                          response.id,
+                          request.agency.name,
+                          content,
+                          event_type.DENIAL_LETTER_CREATED,
+                          'Request {} Closed'.format(request_id),
+                          secure_filename('{}_denial_letter.pdf'.format(request_id)))
         else:
             email_id = _send_response_email(request_id,
                                             RELEASE_AND_PUBLIC,
@@ -422,22 +417,13 @@ def add_closing(request_id, reason_ids, content, method, letter_template_id):
             letter_template = LetterTemplates.query.filter_by(id=letter_template_id).one()
             letter_id = _add_letter(request_id, letter_template.title, content, event_type.CLOSING_LETTER_CREATED)
             _create_communication_method(response.id, letter_id, response_type.LETTER)
-            letter = generate_pdf(content)
-            email_template = os.path.join(current_app.config['EMAIL_TEMPLATE_DIR'],
-                                          EMAIL_TEMPLATE_FOR_EVENT[event_type.CLOSING_LETTER_CREATED])
-            email_content = render_template(email_template,
-                                            request_id=request_id,
-                                            agency_name=request.agency.name,
-                                            user=current_user
-                                            )
-            email_id = safely_send_and_add_email(request_id,
-                                                 email_content,
-                                                 'Request {} Closed'.format(request_id),
-                                                 to=get_assigned_users_emails(request_id),
-                                                 attachment=letter,
-                                                 filename=secure_filename('{}_closing_letter.pdf'.format(request_id)),
-                                                 mimetype='application/pdf')
-            _create_communication_method(response.id, email_id, response_type.EMAIL)
+            _email_letter(request_id,
+                          response.id,
+                          request.agency.name,
+                          content,
+                          event_type.CLOSING_LETTER_CREATED,
+                          'Request {} Closed'.format(request_id),
+                          secure_filename('{}_closing_letter.pdf'.format(request_id)))
         else:
             email_id = _send_response_email(request_id,
                                             RELEASE_AND_PUBLIC,
@@ -623,25 +609,13 @@ def add_reopening(request_id, date, tz_name, content, reason, method, letter_tem
 
             _create_communication_method(response.id, letter_id, response_type.LETTER)
 
-            letter = generate_pdf(content)
-
-            email_template = os.path.join(current_app.config['EMAIL_TEMPLATE_DIR'],
-                                          EMAIL_TEMPLATE_FOR_EVENT[event_type.REOPENING_LETTER_CREATED])
-
-            email_content = render_template(email_template,
-                                            request_id=request_id,
-                                            agency_name=request.agency.name,
-                                            user=current_user
-                                            )
-            email_id = safely_send_and_add_email(request_id,
-                                                 email_content,
-                                                 'Request {} Reopened - Letter'.format(request_id),
-                                                 to=get_assigned_users_emails(request_id),
-                                                 attachment=letter,
-                                                 filename=secure_filename(
-                                                     '{}_reopening_letter.pdf'.format(request_id)),
-                                                 mimetype='application/pdf')
-            _create_communication_method(response.id, email_id, response_type.EMAIL)
+            _email_letter(request_id,
+                          response.id,
+                          request.agency.name,
+                          content,
+                          event_type.REOPENING_LETTER_CREATED,
+                          'Request {} Reopened - Letter'.format(request_id),
+                          secure_filename('{}_reopening_letter.pdf'.format(request_id)))
 
 
 def add_extension(request_id, length, reason, custom_due_date, tz_name, content, method, letter_template_id):
@@ -694,22 +668,13 @@ def add_extension(request_id, length, reason, custom_due_date, tz_name, content,
         letter_template = LetterTemplates.query.filter_by(id=letter_template_id).one()
         letter_id = _add_letter(request_id, letter_template.title, content, event_type.EXTENSION_LETTER_CREATED)
         _create_communication_method(response.id, letter_id, response_type.LETTER)
-        letter = generate_pdf(content)
-        email_template = os.path.join(current_app.config['EMAIL_TEMPLATE_DIR'],
-                                      EMAIL_TEMPLATE_FOR_EVENT[event_type.EXTENSION_LETTER_CREATED])
-        email_content = render_template(email_template,
-                                        request_id=request_id,
-                                        agency_name=request.agency.name,
-                                        user=current_user
-                                        )
-        email_id = safely_send_and_add_email(request_id,
-                                             email_content,
-                                             'Request {} Extended - Letter'.format(request_id),
-                                             to=get_assigned_users_emails(request_id),
-                                             attachment=letter,
-                                             filename=secure_filename('{}_extension_letter.pdf'.format(request_id)),
-                                             mimetype='application/pdf')
-        _create_communication_method(response.id, email_id, response_type.EMAIL)
+        _email_letter(request_id,
+                      response.id,
+                      request.agency.name,
+                      content,
+                      event_type.EXTENSION_LETTER_CREATED,
+                      'Request {} Extended - Letter'.format(request_id),
+                      secure_filename('{}_extension_letter.pdf'.format(request_id)))
     else:
         email_id = _send_response_email(request_id,
                                         privacy,
@@ -794,25 +759,17 @@ def add_response_letter(request_id, content, letter_template_id):
     request = Requests.query.options(joinedload(Requests.agency)).filter_by(id=request_id).one()
     letter_template = LetterTemplates.query.filter_by(id=letter_template_id).one()
     letter_title = letter_template.title
-    letter = generate_pdf(content)
     letter_id = _add_letter(request_id, letter_title, content, event_type.RESPONSE_LETTER_CREATED)
-    email_template = os.path.join(current_app.config['EMAIL_TEMPLATE_DIR'],
-                                  EMAIL_TEMPLATE_FOR_EVENT[event_type.RESPONSE_LETTER_CREATED])
-    email_content = render_template(email_template,
-                                    request_id=request_id,
-                                    agency_name=request.agency.name,
-                                    user=current_user)
-    email_id = safely_send_and_add_email(request_id,
-                                         email_content,
-                                         "{} Letter Added to {}".format(letter_title, request_id),
-                                         to=get_assigned_users_emails(request_id),
-                                         attachment=letter,
-                                         filename=secure_filename('{}_{}_letter.pdf'.format(letter_title, request_id)),
-                                         mimetype='application/pdf')
-    _create_communication_method(letter_id, email_id, response_type.EMAIL)
+    _email_letter(request_id,
+                  letter_id,
+                  request.agency.name,
+                  content,
+                  event_type.RESPONSE_LETTER_CREATED,
+                  "{} Letter Added to {}".format(letter_title, request_id),
+                  secure_filename('{}_{}_letter.pdf'.format(letter_title, request_id)))
 
 
-def _add_email(request_id, subject, email_content, to=None, cc=None, bcc=None):
+def _add_email(request_id, subject, email_content, to=None, cc=None, bcc=None, user=current_user):
     """
     Create and store the email object for the specified request.
     Store the email metadata into the Emails table.
@@ -824,6 +781,7 @@ def _add_email(request_id, subject, email_content, to=None, cc=None, bcc=None):
     :param to: list of person(s) email is being sent to
     :param cc: list of person(s) email is being cc'ed to
     :param bcc: list of person(s) email is being bcc'ed
+    :param user: user the email notification event is recorded for
 
     """
     to = ','.join([email.replace('{', '').replace('}', '') for email in to]) if to else None
@@ -840,7 +798,7 @@ def _add_email(request_id, subject, email_content, to=None, cc=None, bcc=None):
         body=email_content
     )
     create_object(response)
-    create_response_event(event_type.EMAIL_NOTIFICATION_SENT, response)
+    create_response_event(event_type.EMAIL_NOTIFICATION_SENT, response, user=user)
     return response.id
 
 
@@ -878,11 +836,7 @@ def add_envelope(request_id, template_id, envelope_data):
     """
     request = Requests.query.options(joinedload(Requests.agency)).filter_by(id=request_id).one()
 
-    template = '{agency_ein}/{template_name}'.format(agency_ein=request.agency.ein,
-                                                     template_name=EnvelopeTemplates.query.filter_by(
-                                                         id=template_id).one().template_name)
-
-    latex = generate_envelope(template, envelope_data)
+    latex = generate_envelope(_get_envelope_template(request.agency.ein, template_id), envelope_data)
 
     response = Envelopes(
         request_id,
@@ -891,7 +845,6 @@ def add_envelope(request_id, template_id, envelope_data):
     )
     create_object(response)
     create_response_event(event_type.ENVELOPE_CREATED, response)
-    envelope = generate_envelope_pdf(latex)
     email_template = os.path.join(current_app.config['EMAIL_TEMPLATE_DIR'],
                                   EMAIL_TEMPLATE_FOR_EVENT[event_type.ENVELOPE_CREATED])
     email_content = render_template(email_template,
@@ -899,14 +852,208 @@ def add_envelope(request_id, template_id, envelope_data):
                                     agency_name=request.agency.name,
                                     user=current_user
                                     )
-    email_id = safely_send_and_add_email(request_id,
-                                         email_content,
-                                         'Request {} Envelope Generated'.format(request_id),
-                                         to=get_assigned_users_emails(request_id),
-                                         attachment=envelope,
-                                         filename=secure_filename('{}_envelope.pdf'.format(request_id)),
-                                         mimetype='application/pdf')
-    _create_communication_method(response.id, email_id, response_type.EMAIL)
+    # the envelope is compiled, and its notification recorded and emailed, by a PDF worker
+    email_envelope.apply_async((request_id,
+                                response.id,
+                                current_user.guid,
+                                'Request {} Envelope Generated'.format(request_id),
+                                email_content,
+                                latex,
+                                secure_filename('{}_envelope.pdf'.format(request_id))),
+                               queue=current_app.config['PDF_CELERY_QUEUE'])
+
+
+def _get_envelope_template(agency_ein, template_id):
+    return '{agency_ein}/{template_name}'.format(agency_ein=agency_ein,
+                                                 template_name=EnvelopeTemplates.query.filter_by(
+                                                     id=template_id).one().template_name)
+
+
+def get_envelope_data(request_id, recipient_name, organization, address_one, address_two, city, state, zipcode):
+    """
+    Return the data filled in to an envelope, upper-cased with LaTeX characters escaped.
+
+    :param request_id: FOIL Request Unique Identifier (String)
+    :return: EnvelopeDict
+    """
+    envelope_data = EnvelopeDict()
+    envelope_data['request_id'] = request_id
+    envelope_data['recipient_name'] = escape_latex_characters(str(recipient_name).upper())
+    envelope_data['organization'] = escape_latex_characters(str(organization).upper())
+    envelope_data['organization'] = " ".join(
+        ['\\seqsplit{{{}}}'.format(i) for i in envelope_data['organization'].split()])
+    envelope_data['street_address'] = '{} {}'.format(
+        escape_latex_characters(str(address_one).upper()),
+        escape_latex_characters(str(address_two).upper()))
+    envelope_data['city'] = escape_latex_characters(str(city).upper())
+    envelope_data['state'] = escape_latex_characters(str(state).upper())
+    envelope_data['zipcode'] = escape_latex_characters(str(zipcode).upper())
+    return envelope_data
+
+
+def get_envelope_batch_key(batch_id):
+    return '|'.join(('pdf', 'envelope_batch', batch_id))
+
+
+def start_envelope_batch(request_ids, template_id, agency_ein):
+    """
+    Start compiling the envelopes for a mailing in the background. The batch is recorded as belonging to
+    the requests' agency, so only its users can download the envelopes.
+
+    :param request_ids: FOIL request IDs (all of the same agency)
+    :param template_id: ID of the template to use to generate the envelopes (String)
+    :param agency_ein: agency ein of the requests
+    :return: ID of the batch (what its PDF is cached under)
+    """
+    batch_id = uuid.uuid4().hex
+    pdf_redis.set(get_envelope_batch_key(batch_id), agency_ein, ex=current_app.config['PDF_CACHE_EXPIRY'])
+    start_pdf(batch_id, compile_envelope_batch, batch_id, sorted(request_ids), template_id)
+    return batch_id
+
+
+def get_envelope_batch_agency(batch_id):
+    """
+    Returns the agency ein a batch of envelopes was generated for, or None if there is no such batch.
+    """
+    agency_ein = pdf_redis.get(get_envelope_batch_key(batch_id))
+    return agency_ein.decode() if agency_ein is not None else None
+
+
+@celery.task
+def compile_envelope_batch(batch_id, request_ids, template_id):
+    """
+    Generates and compiles the envelopes of a mailing and caches the PDF by the batch's ID.
+
+    :param batch_id: ID of the batch (see start_envelope_batch)
+    :param request_ids: FOIL request IDs (all of the same agency)
+    :param template_id: ID of the template to use to generate the envelopes (String)
+    """
+    try:
+        document = generate_envelope_batch(request_ids, template_id)
+    except ValueError:
+        pdf_failed(batch_id, status=PDF_INVALID)
+        return
+    try:
+        pdf = compile_latex(document)
+    except Exception:
+        pdf_failed(batch_id)
+        raise
+    cache_pdf(batch_id, pdf)
+
+
+def generate_envelope_batch(request_ids, template_id):
+    """
+    Generate one LaTeX document with an envelope (a page) for each request, addressed to its requester,
+    so a mailing is compiled once instead of once per envelope.
+
+    :param request_ids: FOIL request IDs (all of the same agency)
+    :param template_id: ID of the template to use to generate the envelopes (String)
+    :return: LaTeX document
+    """
+    requests = Requests.query.options(
+        joinedload(Requests.requester)
+    ).filter(Requests.id.in_(request_ids)).order_by(Requests.id).all()
+    template = get_latex_template(_get_envelope_template(requests[0].agency_ein, template_id))
+    documents = []
+    for request in requests:
+        requester = request.requester
+        mailing_address = requester.mailing_address or {}
+        documents.append(template.render(**get_envelope_data(
+            request.id,
+            requester.name,
+            requester.organization or '',
+            mailing_address.get('address_one') or '',
+            mailing_address.get('address_two') or '',
+            mailing_address.get('city') or '',
+            mailing_address.get('state') or '',
+            mailing_address.get('zip') or '')))
+    return combine_latex_documents(documents)
+
+
+def _email_letter(request_id, response_id, agency_name, letter_content, letter_event_type, subject, filename):
+    """
+    Have a PDF worker render a letter, then record its notification email and send it with the letter attached,
+    so the request is not held up rendering the PDF.
+
+    :param request_id: FOIL request ID
+    :param response_id: id of the response the letter is for
+    :param agency_name: name of the request's agency
+    :param letter_content: HTML of the letter
+    :param letter_event_type: event type of the letter (selects the email template)
+    :param subject: subject of the email
+    :param filename: name of the attached PDF
+    """
+    email_template = os.path.join(current_app.config['EMAIL_TEMPLATE_DIR'],
+                                  EMAIL_TEMPLATE_FOR_EVENT[letter_event_type])
+    email_content = render_template(email_template,
+                                    request_id=request_id,
+                                    agency_name=agency_name,
+                                    user=current_user)
+    email_letter.apply_async((request_id, response_id, current_user.guid, subject, email_content, letter_content,
+                              filename),
+                             queue=current_app.config['PDF_CELERY_QUEUE'])
+
+
+@celery.task(autoretry_for=(PDFCreationException,), retry_kwargs={'max_retries': 3}, retry_backoff=True)
+def email_envelope(request_id, response_id, user_guid, subject, email_content, latex, filename):
+    """
+    Compiles an envelope (or takes it from the PDF cache), then records and sends its notification email
+    with the envelope attached. Nothing is recorded unless the envelope compiles.
+
+    :param request_id: FOIL request ID
+    :param response_id: id of the Envelopes response
+    :param user_guid: guid of the user who generated the envelope
+    :param subject: subject of the email
+    :param email_content: HTML of the email
+    :param latex: LaTeX of the envelope
+    :param filename: name of the attached PDF
+    """
+    pdf = get_cached_pdf(compile_latex_pdf(latex))
+    _send_pdf_email(request_id, response_id, user_guid, subject, email_content, pdf, filename)
+
+
+@celery.task(autoretry_for=(PDFCreationException,), retry_kwargs={'max_retries': 3}, retry_backoff=True)
+def email_letter(request_id, response_id, user_guid, subject, email_content, letter_content, filename):
+    """
+    Renders a letter (or takes it from the PDF cache), then records and sends its notification email
+    with the letter attached. Nothing is recorded unless the letter renders.
+
+    :param request_id: FOIL request ID
+    :param response_id: id of the response the letter is for
+    :param user_guid: guid of the user who created the letter
+    :param subject: subject of the email
+    :param email_content: HTML of the email
+    :param letter_content: HTML of the letter
+    :param filename: name of the attached PDF
+    """
+    pdf = get_cached_pdf(render_html_pdf(letter_content))
+    _send_pdf_email(request_id, response_id, user_guid, subject, email_content, pdf, filename)
+
+
+def _send_pdf_email(request_id, response_id, user_guid, subject, email_content, pdf, filename):
+    """
+    Records a notification email for a response (with its event and communication method) and sends it
+    with a PDF attached.
+
+    :param request_id: FOIL request ID
+    :param response_id: id of the response the email is about
+    :param user_guid: guid of the user the email is recorded for
+    :param subject: subject of the email
+    :param email_content: HTML of the email
+    :param pdf: PDF File Object
+    :param filename: name of the attached PDF
+    """
+    to = get_assigned_users_emails(request_id)
+    email_id = _add_email(request_id, subject, email_content, to=to,
+                          user=Users.query.filter_by(guid=user_guid).one())
+    _create_communication_method(response_id, email_id, response_type.EMAIL)
+    send_email(subject,
+               to=to,
+               email_content=email_content,
+               email_id=email_id,
+               attachment=pdf,
+               filename=filename,
+               mimetype='application/pdf')
 
 
 def add_sms():
@@ -2593,14 +2740,21 @@ def safely_send_and_add_email(request_id,
         request_id: FOIL request ID
         email_content: string of HTML email content that can be used as a message template
         subject: subject of the email (current is for TESTING purposes)
-        template: path of the HTML template to be passed into and rendered in send_email
+        template: path of the HTML template rendered (once) with kwargs when email_content is not given
         to: list of person(s) email is being sent to
         bcc: list of person(s) email is being bcc'ed
         reply_to: reply-to address
     """
     try:
-        send_email(subject, to=to, bcc=bcc, reply_to=reply_to, template=template, email_content=email_content, **kwargs)
-        return _add_email(request_id, subject, email_content, to=to, bcc=bcc)
+        assert to or bcc or kwargs.get('cc')
+        if email_content is None:
+            # the same html is sent and stored in the Emails record
+            email_content = render_template(template + '.html', **kwargs)
+        # the message is sent by the Emails row's id, so its body is not also queued
+        email_id = _add_email(request_id, subject, email_content, to=to, bcc=bcc)
+        send_email(subject, to=to, bcc=bcc, reply_to=reply_to, template=template, email_content=email_content,
+                   email_id=email_id, **kwargs)
+        return email_id
     except AssertionError:
         sentry.captureException()
         current_app.logger.exception('Must include: To, CC, or BCC')
@@ -2627,6 +2781,8 @@ def create_response_event(events_type, response, previous_value=None, user=curre
                    new_value=response.val_for_events)
     # store event object
     create_object(event)
+    # the new response (and any status change) alters the rendered responses of the request
+    redis_invalidate_response_fragments(response.request_id)
 
 
 def _create_communication_method(response_id, method_id, method_type):
@@ -2785,6 +2941,7 @@ class ResponseEditor(metaclass=ABCMeta):
         update_object(data,
                       type(self.response),
                       self.response.id)
+        redis_invalidate_response_fragments(self.response.request_id)
 
     def get_response_release_date(self):
         return {
@@ -2872,9 +3029,7 @@ class RespFileEditor(ResponseEditor):
                             filepath,
                             is_update=True)
                     except AttributeError:
-                        size = fu.getsize(filepath)
-                        mime_type = fu.get_mime_type(filepath)
-                        hash_ = fu.get_hash(filepath)
+                        size, mime_type, hash_ = fu.get_file_metadata(filepath)
                         sentry.captureException()
                     self.set_data_values('size',
                                          self.response.size,
@@ -2910,23 +3065,13 @@ class RespFileEditor(ResponseEditor):
             self.response.request_id,
             new_filename
         )
-        if current_app.config['USE_VOLUME_STORAGE']:
-            fu.remove(
-                os.path.join(
-                    upload_path,
-                    self.response.name
-                )
-            )
-            complete_upload.delay(self.response.request_id, quarantine_path, new_filename)
-        elif current_app.config['USE_AZURE_STORAGE']:
-            fu.azure_delete(
-                os.path.join(
-                    upload_path,
-                    self.response.name
-                )
+        get_storage().delete(
+            os.path.join(
+                upload_path,
+                self.response.name
             )
-            complete_upload.delay(self.response.request_id, quarantine_path, new_filename)
-
+        )
+        complete_upload.delay(self.response.request_id, quarantine_path, new_filename)
 
     def handle_response_token(self, file_changed):
         """
@@ -3013,32 +3158,16 @@ class RespFileEditor(ResponseEditor):
             DELETED_FILE_DIRNAME,
             str(self.response.id)
         )
-        if current_app.config['USE_VOLUME_STORAGE']:
-            if not fu.exists(dir_deleted):
-                fu.makedirs(dir_deleted)
-            fu.rename(
-                os.path.join(
-                    upload_path,
-                    self.response.name
-                ),
-                os.path.join(
-                    dir_deleted,
-                    self.response.name
-                )
-            )
-        elif current_app.config['USE_AZURE_STORAGE']:
-            deleted_filename = os.path.join(
+        get_storage().move(
+            os.path.join(
+                upload_path,
+                self.response.name
+            ),
+            os.path.join(
                 dir_deleted,
                 self.response.name
             )
-            current_blob_name = os.path.join(upload_path, self.response.name)
-            fu.azure_copy(current_blob_name, deleted_filename)
-            fu.azure_delete(
-                os.path.join(
-                    upload_path,
-                    self.response.name
-                )
-            )
+        )
 
 
 class RespNoteEditor(ResponseEditor):
@@ -5,10 +5,6 @@
 """
 import os
 
-import io
-
-import app.lib.file_utils as fu
-
 from datetime import datetime
 
 from flask import (
@@ -18,17 +14,18 @@ from flask import (
     redirect,
     jsonify,
     current_app,
-    after_this_request,
-    abort,
-    send_file
+    abort
 )
 from flask_login import current_user, login_url
+from sqlalchemy import or_
+from sqlalchemy.orm import joinedload
 
 from app import login_manager, sentry
 from app.constants import permission, request_date
-from app.constants.pdf import EnvelopeDict
+from app.constants.pdf import MAX_ENVELOPE_BATCH_SIZE
 from app.constants.response_type import FILE, LETTER, EMAIL
 from app.constants.response_privacy import PRIVATE, RELEASE_AND_PRIVATE
+from app.lib.storage import AzureStorage, get_storage
 from app.lib.utils import UserRequestException
 from app.lib.date_utils import get_holidays_date_list
 from app.lib.db_utils import delete_object
@@ -37,9 +34,11 @@ from app.lib.permission_utils import (
     is_allowed
 )
 from app.lib.pdf import (
-    generate_pdf_flask_response,
-    generate_envelope_pdf,
-    escape_latex_characters
+    get_cached_pdf,
+    get_pdf_status,
+    pdf_response,
+    request_html_pdf,
+    request_latex_pdf
 )
 from app.response import response
 from app.models import (
@@ -53,7 +52,8 @@ from app.models import (
     Instructions,
     Links,
     Letters,
-    Envelopes
+    Envelopes,
+    EnvelopeTemplates
 )
 from app.response.utils import (
     add_note,
@@ -68,8 +68,11 @@ from app.response.utils import (
     add_response_letter,
     add_instruction,
     add_envelope,
+    get_envelope_batch_agency,
+    get_envelope_data,
     get_file_links,
     process_upload_data,
+    start_envelope_batch,
     send_file_email,
     process_email_template_request,
     process_letter_template_request,
@@ -491,26 +494,86 @@ def response_generate_envelope():
     Create an Envelope for the Request.
     :return: redirect to view request page
     """
-    envelope_data = EnvelopeDict()
     request_id = flask_request.form.get('request_id')
     template = flask_request.form.get('template')
-    envelope_data['request_id'] = request_id
-    envelope_data['recipient_name'] = escape_latex_characters(str(flask_request.form.get('recipient_name')).upper())
-    envelope_data['organization'] = escape_latex_characters(str(flask_request.form.get('organization')).upper())
-    envelope_data['organization'] = " ".join(
-        ['\\seqsplit{{{}}}'.format(i) for i in envelope_data['organization'].split()])
-    envelope_data['street_address'] = '{} {}'.format(
-        escape_latex_characters(str(flask_request.form.get('address_one')).upper()),
-        escape_latex_characters(str(flask_request.form.get('address_two')).upper()))
-    envelope_data['city'] = escape_latex_characters(str(flask_request.form.get('city')).upper())
-    envelope_data['state'] = escape_latex_characters(str(flask_request.form.get('state')).upper())
-    envelope_data['zipcode'] = escape_latex_characters(str(flask_request.form.get('zipcode')).upper())
+    envelope_data = get_envelope_data(request_id,
+                                      flask_request.form.get('recipient_name'),
+                                      flask_request.form.get('organization'),
+                                      flask_request.form.get('address_one'),
+                                      flask_request.form.get('address_two'),
+                                      flask_request.form.get('city'),
+                                      flask_request.form.get('state'),
+                                      flask_request.form.get('zipcode'))
 
     add_envelope(request_id, template, envelope_data)
 
     return redirect(url_for('request.view', request_id=request_id))
 
 
+@response.route('/envelope/batch', methods=['POST'])
+def response_generate_envelope_batch():
+    """
+    Generate the envelopes for a mailing: one PDF with an envelope for each request, addressed to its requester,
+    compiled in the background.
+
+    Request Parameters:
+    - request_id: FOIL request ID (repeated for each request, all of the same agency)
+    - template: ID of the envelope template
+
+    :return: redirect to the batch's PDF (polled until it is compiled)
+    """
+    if not (current_user.is_authenticated and current_user.is_agency):
+        return jsonify({'error': 'unauthorized'}), 403
+    request_ids = flask_request.form.getlist('request_id')
+    template = flask_request.form.get('template')
+    if not request_ids or not template:
+        return jsonify({'error': 'request_id and template are required'}), 400
+    if len(request_ids) > MAX_ENVELOPE_BATCH_SIZE:
+        return jsonify({'error': 'at most {} envelopes can be generated at once'.format(MAX_ENVELOPE_BATCH_SIZE)}), 400
+
+    requests = Requests.query.options(
+        joinedload(Requests.agency_users)
+    ).filter(Requests.id.in_(request_ids)).all()
+    if len(requests) != len(set(request_ids)):
+        return jsonify({'error': 'request not found'}), 404
+    agency_eins = set(request.agency_ein for request in requests)
+    if len(agency_eins) != 1:
+        return jsonify({'error': 'requests must belong to the same agency'}), 400
+    if any(current_user not in request.agency_users for request in requests):
+        return jsonify({'error': 'unauthorized'}), 403
+    agency_ein = agency_eins.pop()
+    if not template.isdigit() or EnvelopeTemplates.query.filter(
+            EnvelopeTemplates.id == template,
+            or_(EnvelopeTemplates.agency_ein == agency_ein, EnvelopeTemplates.agency_ein.is_(None))
+    ).one_or_none() is None:
+        return jsonify({'error': 'invalid envelope template'}), 400
+
+    batch_id = start_envelope_batch(list(set(request_ids)), template, agency_ein)
+    return redirect(url_for('response.response_get_envelope_batch', batch_id=batch_id))
+
+
+@response.route('/envelope/batch/<batch_id>')
+def response_get_envelope_batch(batch_id):
+    """
+    Return the PDF of a batch of envelopes as an attachment, or a handle to poll while it is compiled.
+    Only users of the agency the batch was generated for can download it.
+
+    :param batch_id: ID of the batch
+    :return: PDF Attachment.
+    """
+    if not (current_user.is_authenticated and current_user.is_agency):
+        return jsonify({'error': 'unauthorized'}), 403
+    agency_ein = get_envelope_batch_agency(batch_id)
+    if agency_ein is None:
+        return jsonify({'error': 'envelopes not found, please generate them again'}), 404
+    if not current_user.is_agency_active(agency_ein):
+        return jsonify({'error': 'unauthorized'}), 403
+    pdf = get_cached_pdf(batch_id)
+    if pdf is None and get_pdf_status(batch_id) is None:
+        return jsonify({'error': 'envelopes not found, please generate them again'}), 404
+    return pdf_response(batch_id, pdf, 'envelopes.pdf')
+
+
 @response.route('/email', methods=['POST'])
 def response_email():
     """
@@ -722,23 +785,15 @@ def get_response_content(response_id):
             response_.name
         )
         filepath = os.path.join(*filepath_parts)
-        serving_path = os.path.join(
-            current_app.config['UPLOAD_SERVING_DIRECTORY'],
-            response_.request_id,
-            response_.name
-        )
         token = flask_request.args.get('token')
-        if current_app.config['USE_VOLUME_STORAGE'] and not fu.exists(filepath):
+        storage = get_storage()
+        # (blobs are served through a redirect, so Azure is not asked first)
+        if storage.name != AzureStorage.name and not storage.exists(filepath):
             return abort(403)
 
         if response_.is_public:
             # then we just serve the file, anyone can view it
-            @after_this_request
-            def remove(resp):
-                if current_app.config['USE_VOLUME_STORAGE']:
-                    os.remove(serving_path)
-                return resp
-            return fu.send_file(*filepath_parts, as_attachment=True)
+            return storage.send_file(*filepath_parts, file_hash=response_.hash, as_attachment=True)
         else:
             # check presence of token in url
             if token is not None:
@@ -746,13 +801,7 @@ def get_response_content(response_id):
                     token=token, response_id=response_id).first()
                 if resptok is not None:
                     if response_.privacy != PRIVATE:
-                        @after_this_request
-                        def remove(resp):
-                            if current_app.config['USE_VOLUME_STORAGE']:
-                                os.remove(serving_path)
-                            return resp
-
-                        return fu.send_file(*filepath_parts, as_attachment=True)
+                        return storage.send_file(*filepath_parts, file_hash=response_.hash, as_attachment=True)
                     else:
                         delete_object(resptok)
 
@@ -766,13 +815,7 @@ def get_response_content(response_id):
                             request_id=response_.request_id,
                             user_guid=current_user.guid
                         ).first() is not None):
-                    @after_this_request
-                    def remove(resp):
-                        if current_app.config['USE_VOLUME_STORAGE']:
-                            os.remove(serving_path)
-                        return resp
-
-                    return fu.send_file(*filepath_parts, as_attachment=True)
+                    return storage.send_file(*filepath_parts, file_hash=response_.hash, as_attachment=True)
                 # user does not have permission to view file
                 return abort(403)
             else:
@@ -830,14 +873,10 @@ def response_get_envelope(request_id, response_id):
             return jsonify({'error': 'unauthorized'}), 403
         envelope = Envelopes.query.filter_by(id=response_id).one()
 
-        f = generate_envelope_pdf(envelope.latex)
+        # compiled by a PDF worker; until it is ready the client polls this url
+        document_hash, pdf = request_latex_pdf(envelope.latex)
 
-        return send_file(
-            io.BytesIO(f),
-            mimetype='application/pdf',
-            as_attachment=True,
-            download_name='{request_id}_envelope.pdf'.format(request_id=request_id)
-        )
+        return pdf_response(document_hash, pdf, '{request_id}_envelope.pdf'.format(request_id=request_id))
 
 
 @response.route('/letter/<request_id>', methods=['POST'])
@@ -879,5 +918,9 @@ def response_get_letter(request_id, response_id):
             cm = CommunicationMethods.query.filter_by(response_id=response_id, method_type=LETTER).one()
             letter = Letters.query.filter_by(id=cm.method_id).one()
 
-        return generate_pdf_flask_response(letter.content)
+        # rendered by a PDF worker; until it is ready the client polls this url
+        document_hash, pdf = request_html_pdf(letter.content)
+
+        return pdf_response(document_hash, pdf, '{request_id}_letter.pdf'.format(request_id=request_id),
+                            as_attachment=False)
     return jsonify({'error': 'unauthorized'}), 403
@@ -6,6 +6,7 @@ $(function() {
     var index = 0;
     var indexIncrement = 5;
     var total = 0;
+    var nextCursor = null;
     var request_id = $.trim($("#request-id").text());
     var navButtons = $("#history-nav-buttons");
     var prevButton = navButtons.find(".prev");
@@ -30,6 +31,7 @@ $(function() {
         success: function (data) {
             events = data.events;
             total = data.total;
+            nextCursor = data.next_cursor;
             if (events.length > indexIncrement) {  // if there are enough events to merit pagination
                 navButtons.show();
                 prevButton.attr("disabled", true);
@@ -74,12 +76,14 @@ $(function() {
             url: "/request/api/v1.0/events",
             data: {
                 start: events.length,
+                cursor: nextCursor,
                 request_id: request_id,
                 with_template: true
             },
             success: function(data) {
                 // append to events
                 events = events.concat(data.events);
+                nextCursor = data.next_cursor;
                 if (index + indexIncrement >= total) {
                     nextButton.attr("disabled", true);
                 }
@@ -51,13 +51,41 @@ function bindFileUpload(target,
                 }
             }
         },
-        chunkfail: function (e, data) {
-            // remove existing partial upload
-            deleteUpload(request_id, encodeName(data.files[0].name), false, true);
-            // Re-enable 'next' button
-            if (for_update) {
-                $(nextButton).attr('disabled', false);
+        maxRetries: 5,
+        retryTimeout: 1000,  // ms, multiplied by the number of retries
+        fail: function (e, data) {
+            // resume an interrupted chunked upload from the last byte received by the server
+            var fu = $(this).data("blueimp-fileupload") || $(this).data("fileupload");
+            var retries = data.context.data("retries") || 0;
+            var giveUp = function () {
+                // remove existing partial upload
+                deleteUpload(request_id, encodeName(data.files[0].name), false, true);
+                // Re-enable 'next' button
+                if (for_update) {
+                    $(nextButton).attr('disabled', false);
+                }
+                $.blueimp.fileupload.prototype.options.fail.call(fu.element[0], e, data);
+            };
+            if (data.errorThrown === "abort" || data.context[0].abortChunkSend ||
+                data.files[0].size <= fu.options.maxChunkSize || retries >= fu.options.maxRetries) {
+                giveUp();
+                return;
             }
+            data.context.data("retries", retries + 1);
+            setTimeout(function () {
+                $.ajax({
+                    type: "HEAD",
+                    url: "/upload/" + request_id,
+                    data: {
+                        filename: data.files[0].name,
+                        update: for_update
+                    }
+                }).done(function (result, textStatus, jqXHR) {
+                    data.uploadedBytes = parseInt(jqXHR.getResponseHeader("Upload-Offset"), 10) || 0;
+                    data.data = null;
+                    data.submit();
+                }).fail(giveUp);
+            }, fu.options.retryTimeout * (retries + 1));
         }
     }).bind("fileuploaddone", function (e, data) {
         // blueimp says that this will only be called on a successful upload
@@ -67,9 +95,7 @@ function bindFileUpload(target,
             // start polling status endpoint after scanner startup
             var idVal = encodeName(file.name);
             data.result.files[0].identifier = idVal;
-            setTimeout(
-                pollUploadStatus.bind(null, file.name, idVal, request_id, for_update, nextButton),
-                4000);  // McAfee Scanner minimum 3+ second startup
+            watchUploadStatus(file.name, idVal, request_id, for_update, nextButton);
         }
         else {
             // Re-enable 'next' button
@@ -134,51 +160,159 @@ function encodeName(name) {
     return window.btoa(name).replace(/=/g, "");
 }
 
-function pollUploadStatus(upload_filename, htmlId, request_id, for_update, nextButton) {
+var uploadStatusWatchers = {};  // pending uploads per request, see watchUploadStatus
+
+function watchUploadStatus(upload_filename, htmlId, request_id, for_update, nextButton) {
+    /*
+    Waits for an upload to be scanned, then updates the download template.
+
+    Status changes for every pending upload of a request are pushed over
+    one server-sent event stream, which the server closes once they have
+    all finished. If the stream cannot be opened (or the browser has no
+    EventSource), the batch status endpoint is polled every 2 seconds instead.
+     */
+    var watcherKey = request_id + "|" + Boolean(for_update);
+    var watcher = uploadStatusWatchers[watcherKey];
+    if (watcher === undefined) {
+        watcher = uploadStatusWatchers[watcherKey] = {
+            request_id: request_id,
+            for_update: for_update,
+            pending: {},
+            source: null,
+            polling: !window.EventSource,
+            timer: null
+        };
+    }
+    watcher.pending[upload_filename] = function (status, verdict) {
+        return handleUploadStatus(status, htmlId, request_id, for_update, nextButton, verdict);
+    };
+
+    if (watcher.polling) {
+        if (watcher.timer === null) {
+            watcher.timer = setTimeout(pollUploadStatuses.bind(null, watcher), 2000);
+        }
+    }
+    else {
+        // reopen the stream so the current status of the new upload is sent
+        streamUploadStatuses(watcher);
+    }
+}
+
+function streamUploadStatuses(watcher) {
+    /*
+    Opens the upload status stream for every pending upload of a request.
+    The stream always starts with the current status of each upload, so a
+    connection that fails before sending anything means the stream is not
+    available and the watcher falls back to polling.
+     */
+    if (watcher.source !== null) {
+        watcher.source.close();
+    }
+    var params = {
+        request_id: watcher.request_id,
+        for_update: Boolean(watcher.for_update),
+        filename: Object.keys(watcher.pending)
+    };
+    var source = watcher.source = new EventSource("/upload/status/stream?" + $.param(params, true));
+    var received = false;
+    source.onmessage = function (e) {
+        received = true;
+        var change = JSON.parse(e.data);
+        updateWatchedUpload(watcher, change.filename, change.status, change.verdict);
+    };
+    source.onerror = function () {
+        if (source.readyState !== EventSource.CLOSED && received) {
+            // the server closed the stream after its timeout, EventSource reconnects on its own
+            received = false;
+            return;
+        }
+        source.close();
+        watcher.source = null;
+        watcher.polling = true;
+        if (!$.isEmptyObject(watcher.pending) && watcher.timer === null) {
+            watcher.timer = setTimeout(pollUploadStatuses.bind(null, watcher), 2000);
+        }
+    };
+}
+
+function updateWatchedUpload(watcher, upload_filename, status, verdict) {
+    /*
+    Pass a status change (and the scan verdict of a failed upload) to the
+    pending upload's handler and stop watching the request once none of its
+    uploads are pending.
+     */
+    var handler = watcher.pending[upload_filename];
+    if (handler !== undefined && handler(status, verdict)) {
+        delete watcher.pending[upload_filename];
+        if ($.isEmptyObject(watcher.pending) && watcher.source !== null) {
+            watcher.source.close();
+            watcher.source = null;
+        }
+    }
+}
+
+function pollUploadStatuses(watcher) {
     /*
-    Sends a request to the upload status endpoint
-    every 2 seconds until it receives a message indicating
-    the upload has completed or until it receives an error
-    message, then updates the download template.
+    Sends one request to the batch upload status endpoint for every
+    pending upload of a request, every 2 seconds until none are pending.
      */
+    watcher.timer = null;
+    if ($.isEmptyObject(watcher.pending)) {
+        return;
+    }
     $.ajax({
         type: "GET",
-        url: "/upload/status",
+        url: "/upload/status/batch",
+        traditional: true,
         data: {
-            request_id: request_id,
-            filename: upload_filename,
-            for_update: for_update
+            request_id: watcher.request_id,
+            filename: Object.keys(watcher.pending),
+            for_update: Boolean(watcher.for_update)
         },
         dataType: "json",
-        success: function(response) {
-            var tr = $("#".concat(htmlId));
-            if (response.error) {
-                // Reveal error message
-                tr.find(".error-post-fileupload").removeClass("hidden");
-                tr.find(".error-post-fileupload-msg").text("Error processing file.");  // scanning, really
-                tr.find(".processing-upload").remove();
-                setRemoveBtn(request_id, tr.find(".remove-post-fileupload"),
-                    false);  // file already deleted
-            }
-            else if (response.status != "ready") {
-                setTimeout(pollUploadStatus.bind(
-                    null, upload_filename, htmlId, request_id, for_update, nextButton
-                ), 2000);
-            }
-            else {
-                // Reveal full template
-                tr.find(".fileupload-input-fields").removeClass("hidden");
-                tr.find(".processing-upload").remove();
-                setRemoveBtn(request_id, tr.find(".remove-post-fileupload"), true, for_update);
-                if (for_update) {
-                    // Enable 'next' button
-                    $(nextButton).attr('disabled', false)
-                }
+        success: function (response) {
+            $.each(response.statuses, function (upload_filename, status) {
+                updateWatchedUpload(watcher, upload_filename, status, response.verdicts[upload_filename]);
+            });
+        },
+        complete: function () {
+            if (!$.isEmptyObject(watcher.pending) && watcher.timer === null) {
+                watcher.timer = setTimeout(pollUploadStatuses.bind(null, watcher), 2000);
             }
         }
     });
 }
 
+function handleUploadStatus(status, htmlId, request_id, for_update, nextButton, verdict) {
+    /*
+    Updates the download template for an upload status.
+    Returns whether the upload is finished (ready or failed).
+     */
+    var tr = $("#".concat(htmlId));
+    if (status === null || status === "error") {
+        // Reveal error message
+        tr.find(".error-post-fileupload").removeClass("hidden");
+        tr.find(".error-post-fileupload-msg").text(verdict === "infected" ?
+            "This file contains a virus and was removed." : "Error processing file.");
+        tr.find(".processing-upload").remove();
+        setRemoveBtn(request_id, tr.find(".remove-post-fileupload"),
+            false);  // file already deleted
+        return true;
+    }
+    else if (status !== "ready") {
+        return false;
+    }
+    // Reveal full template
+    tr.find(".fileupload-input-fields").removeClass("hidden");
+    tr.find(".processing-upload").remove();
+    setRemoveBtn(request_id, tr.find(".remove-post-fileupload"), true, for_update);
+    if (for_update) {
+        // Enable 'next' button
+        $(nextButton).attr('disabled', false)
+    }
+    return true;
+}
+
 function deleteUpload(request_id,
                       filecode,
                       updated_only,
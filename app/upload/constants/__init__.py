@@ -4,9 +4,23 @@
 """
 
 CONTENT_RANGE_HEADER = 'Content-Range'
+UPLOAD_OFFSET_HEADER = 'Upload-Offset'
+UPLOAD_LENGTH_HEADER = 'Upload-Length'
+
+UPLOAD_MANIFEST_EXPIRY = 86400  # 1 day; incomplete uploads can be resumed until then
 
 MAX_CHUNKSIZE = 512000  # 512 kb
 
+UPLOAD_STATUS_STREAM_KEEPALIVE = 15  # seconds between keepalive comments on the upload status stream
+UPLOAD_STATUS_STREAM_RETRY = 2000  # ms an EventSource waits before reconnecting
+
+SCAN_QUEUE_KEY = 'scan_queue'
+SCAN_QUEUE_PROCESSING_KEY = 'scan_queue_processing'  # files being scanned, removed once their verdict is recorded
+SCAN_QUEUE_LOCK_KEY = 'scan_queue_lock'
+SCAN_RETRY_DELAY = 30  # seconds before files are scanned again when the scanner was unavailable
+SCAN_MAX_ATTEMPTS = 3  # scans of a file while the scanner is unavailable before the upload fails
+SCAN_STATS_KEY = 'scan_stats'
+
 ALLOWED_MIMETYPES = [
     'video/x-msvideo',
     'image/x-ms-bmp',
@@ -0,0 +1,3 @@
+CLEAN = "clean"
+INFECTED = "infected"
+FAILED = "failed"
@@ -0,0 +1,177 @@
+"""
+ .. module:: upload.scanner
+
+    :synopsis: Virus scanners for uploaded files
+
+    Each scanner takes a batch of file paths and returns a verdict
+    (see app.upload.constants.scan_verdict) for each one, removing infected files.
+
+    - 'uvscan': McAfee Virus Scan, run once per batch
+    - 'clamd': a long-lived ClamAV daemon (signatures are loaded once), over its socket protocol
+    - 'stand-in': detects the EICAR test file in-process, for tests and development
+"""
+
+import os
+import socket
+import subprocess
+
+from flask import current_app
+
+from app.upload.constants import scan_verdict
+
+# https://www.eicar.org/download-anti-malware-testfile/
+EICAR_SIGNATURE = b'X5O!P%@AP[4\\PZX54(P^)7CC)7}$EICAR-STANDARD-ANTIVIRUS-TEST-FILE!$H+H*'
+SCAN_BLOCK_SIZE = 1048576  # 1 mb
+
+
+class ScannerUnavailableException(Exception):
+    def __init__(self, scanner, reason):
+        super(ScannerUnavailableException, self).__init__(
+            "Virus scanner '{}' is unavailable: {}".format(scanner, reason))
+
+
+class Scanner(object):
+    name = None
+
+    def scan(self, paths):
+        """
+        Scans files for viruses, removing any infected file.
+
+        :param paths: paths of the files to scan
+        :return: dict of path to verdict
+        """
+        raise NotImplementedError
+
+
+class UvscanScanner(Scanner):
+    name = 'uvscan'
+    options = [
+        '--analyze',  # Use heuristic analysis to find possible new viruses
+        '--atime-preserve',  # Preserve the file's last-accessed time and date
+        '--delete'  # Automatically delete the infected file
+    ]
+
+    def scan(self, paths):
+        subprocess.call(['uvscan'] + self.options + list(paths))  # TODO: redirect output to logfile
+        # if a file was removed, it was infected
+        return {
+            path: scan_verdict.CLEAN if os.path.exists(path) else scan_verdict.INFECTED
+            for path in paths
+        }
+
+
+class ClamdScanner(Scanner):
+    """
+    Scans files with clamd, which must be able to read the quarantine directory.
+    A batch is sent as one IDSESSION (one connection, one command per file).
+
+    :param address: path of clamd's unix socket, or 'host:port' for its TCP socket
+    :param timeout: seconds to wait for clamd
+    """
+    name = 'clamd'
+
+    def __init__(self, address, timeout):
+        self.address = address
+        self.timeout = timeout
+
+    def _connect(self):
+        try:
+            if ':' in self.address:
+                host, port = self.address.rsplit(':', 1)
+                return socket.create_connection((host, int(port)), self.timeout)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.address)
+            return sock
+        except OSError as e:
+            raise ScannerUnavailableException(self.name, e)
+
+    def scan(self, paths):
+        paths = list(paths)
+        sock = self._connect()
+        try:
+            sock.sendall(b'zIDSESSION\0')
+            for path in paths:
+                sock.sendall(b'zSCAN ' + path.encode() + b'\0')
+            replies = self._read_replies(sock, len(paths))
+            sock.sendall(b'zEND\0')
+        except OSError as e:
+            raise ScannerUnavailableException(self.name, e)
+        finally:
+            sock.close()
+
+        verdicts = {}
+        for reply in replies:
+            # "<id>: <path>: OK", "<id>: <path>: <signature> FOUND" or "<id>: <path>: <message> ERROR"
+            # other replies (e.g. "UNKNOWN COMMAND") carry no id; their files are left out and so fail
+            id_, _, result = reply.partition(': ')
+            if not id_.isdigit() or not 0 < int(id_) <= len(paths):
+                current_app.logger.error("Unexpected reply from clamd: {}".format(reply))
+                continue
+            path = paths[int(id_) - 1]
+            if result.endswith(' FOUND'):
+                verdicts[path] = scan_verdict.INFECTED
+                if os.path.exists(path):
+                    os.remove(path)
+            elif result.endswith(': OK'):
+                verdicts[path] = scan_verdict.CLEAN
+            else:
+                verdicts[path] = scan_verdict.FAILED
+        return {path: verdicts.get(path, scan_verdict.FAILED) for path in paths}
+
+    @staticmethod
+    def _read_replies(sock, count):
+        buffer = b''
+        replies = []
+        while len(replies) < count:
+            data = sock.recv(4096)
+            if not data:
+                raise ConnectionError("clamd closed the connection")
+            buffer += data
+            *complete, buffer = buffer.split(b'\0')
+            replies.extend(reply.decode() for reply in complete)
+        return replies
+
+
+class StandInScanner(Scanner):
+    """
+    Flags files containing the EICAR test signature.
+    """
+    name = 'stand-in'
+
+    def scan(self, paths):
+        verdicts = {}
+        for path in paths:
+            if self._is_infected(path):
+                os.remove(path)
+                verdicts[path] = scan_verdict.INFECTED
+            else:
+                verdicts[path] = scan_verdict.CLEAN
+        return verdicts
+
+    @staticmethod
+    def _is_infected(path):
+        tail = b''
+        with open(path, 'rb') as fp:
+            for block in iter(lambda: fp.read(SCAN_BLOCK_SIZE), b''):
+                if EICAR_SIGNATURE in tail + block:
+                    return True
+                tail = block[-len(EICAR_SIGNATURE):]
+        return False
+
+
+def get_scanner():
+    """
+    Returns the scanner selected by VIRUS_SCANNER (created once per application).
+    """
+    scanner = current_app.extensions.get('virus_scanner')
+    if scanner is None:
+        name = current_app.config['VIRUS_SCANNER']
+        if name == ClamdScanner.name:
+            scanner = ClamdScanner(current_app.config['CLAMD_SOCKET'], current_app.config['VIRUS_SCAN_TIMEOUT'])
+        elif name == StandInScanner.name:
+            scanner = StandInScanner()
+        else:
+            scanner = UvscanScanner()
+        current_app.extensions['virus_scanner'] = scanner
+    return scanner
@@ -4,9 +4,9 @@
     :synopsis: Helper functions for uploads
 """
 
+import json
 import os
-import magic
-import subprocess
+import time
 
 import app.lib.file_utils as fu
 
@@ -17,18 +17,27 @@ from app import (
     sentry
 )
 from app.lib.redis_utils import redis_set_file_metadata
+from app.lib.storage import get_storage
 from app.constants import UPDATED_FILE_DIRNAME
 from app.upload.constants import (
     ALLOWED_MIMETYPES,
-    MAX_CHUNKSIZE,
+    SCAN_MAX_ATTEMPTS,
+    SCAN_QUEUE_KEY,
+    SCAN_QUEUE_LOCK_KEY,
+    SCAN_QUEUE_PROCESSING_KEY,
+    SCAN_RETRY_DELAY,
+    SCAN_STATS_KEY,
+    UPLOAD_MANIFEST_EXPIRY,
+    scan_verdict,
     upload_status,
 )
+from app.upload.scanner import ScannerUnavailableException, get_scanner
 from app.models import Files
 
 
 def parse_content_range(header):
     """
-    Extracts the starting byte position and resource length.
+    Extracts the first and last byte positions and resource length.
 
     Content-Range = "Content-Range" ":" content-range-spec
 
@@ -41,10 +50,108 @@ def parse_content_range(header):
     instance-length         = 1*DIGIT
 
     :param header: the rhs of the content-range header
-    :return: the first-byte-pos and instance-length
+    :return: the first-byte-pos, last-byte-pos, and instance-length
     """
     bytes_ = header.split(' ')[1]
-    return int(bytes_.split('-')[0]), int(bytes_.split('/')[1])
+    range_, size = bytes_.split('/')
+    start, end = range_.split('-')
+    return int(start), int(end), int(size)
+
+
+def write_upload_chunk(filepath, start, data):
+    """
+    Writes a chunk of an upload at its byte position.
+
+    Chunks are written with positional writes so they can arrive
+    in any order and from parallel requests.
+
+    :param filepath: path to the quarantined file
+    :param start: first byte position of the chunk
+    :param data: chunk contents (bytes)
+    """
+    fd = os.open(filepath, os.O_WRONLY | os.O_CREAT)
+    try:
+        os.pwrite(fd, data, start)
+    finally:
+        os.close(fd)
+
+
+def record_upload_chunk(upload_key, start, length, size):
+    """
+    Records a written chunk in the upload's manifest.
+
+    The manifest is a redis hash of byte ranges to chunk lengths,
+    along with the total upload size. A chunk that is sent again
+    (e.g. after a dropped connection), possibly with a different length,
+    overlaps the ranges already recorded, so the upload is only complete
+    once the recorded ranges cover every byte (see get_upload_offset).
+
+    :param upload_key: the upload key (see get_upload_key)
+    :param start: first byte position of the chunk
+    :param length: number of bytes in the chunk
+    :param size: total size of the upload
+    :return: whether this chunk completed the upload
+    :raises UploadSizeMismatchException: if the chunk does not belong to an upload of the recorded size
+    """
+    manifest_key = get_upload_manifest_key(upload_key)
+    pipe = redis.pipeline()
+    pipe.hsetnx(manifest_key, 'size', size)
+    pipe.hget(manifest_key, 'size')
+    _, recorded_size = pipe.execute()
+    if int(recorded_size) != size or start + length > size:
+        raise UploadSizeMismatchException(upload_key)
+
+    pipe = redis.pipeline()
+    pipe.hset(manifest_key, '{}-{}'.format(start, start + length), length)
+    pipe.expire(manifest_key, UPLOAD_MANIFEST_EXPIRY)
+    pipe.execute()
+
+    offset, _ = get_upload_offset(upload_key)
+    # only the request that first sees every byte covered completes the upload
+    return offset == size and bool(redis.hsetnx(manifest_key, 'complete', 1))
+
+
+def get_upload_offset(upload_key):
+    """
+    Returns the number of contiguous bytes received from the start of an upload
+    and the total upload size (None if the upload has not started).
+    A client resumes an interrupted upload from this offset.
+
+    :param upload_key: the upload key (see get_upload_key)
+    :return: (offset, size)
+    """
+    manifest = {
+        field.decode(): int(value)
+        for field, value in redis.hgetall(get_upload_manifest_key(upload_key)).items()
+    }
+    size = manifest.pop('size', None)
+    manifest.pop('complete', None)
+    offset = 0
+    for start, length in sorted((int(field.split('-')[0]), length) for field, length in manifest.items()):
+        if start > offset:
+            break
+        offset = max(offset, start + length)
+    return offset, size
+
+
+def get_upload_manifest_size(upload_key):
+    """
+    Returns the total upload size recorded in an upload's manifest or None.
+    """
+    size = redis.hget(get_upload_manifest_key(upload_key), 'size')
+    return int(size) if size is not None else None
+
+
+def delete_upload_manifest(upload_key):
+    redis.delete(get_upload_manifest_key(upload_key))
+
+
+def get_upload_manifest_key(upload_key):
+    """
+    Since this key is stored alongside the upload key in upload_redis,
+    a pipe is used to avoid any key conflicts.
+    """
+    return '|'.join((upload_key, 'manifest'))
 
 
 def upload_exists(request_id, filename, response_id=None):
@@ -82,17 +189,9 @@ def is_valid_file_type(obj):
     :return: (whether the mime type is allowed or not,
         the mime type)
     """
-    buffer = obj.stream.read(MAX_CHUNKSIZE)
-    # 1. Check using default
-    mime_type = magic.from_buffer(buffer, mime=True)
+    # Check using default mime database
+    mime_type = fu.get_magic().from_buffer(fu.read_mime_header(obj.stream))
     is_valid = mime_type in ALLOWED_MIMETYPES
-    if is_valid and current_app.config['MAGIC_FILE']:
-        # 3. Check using custom
-        m = magic.Magic(
-            magic_file=current_app.config['MAGIC_FILE'],
-            mime=True)
-        m.from_buffer(buffer)
-        is_valid = mime_type in ALLOWED_MIMETYPES
     obj.stream.seek(0)
     return is_valid, mime_type
 
@@ -118,6 +217,68 @@ def get_upload_key(request_id, upload_filename, for_update=False):
                      'update' if for_update else 'new'))
 
 
+def set_upload_status(request_id, upload_filename, for_update, status):
+    """
+    Sets the status of an upload (see upload_status) and publishes the change
+    to the request's upload status channel (see upload.views.status_stream).
+
+    :param status: the new status, or None to remove the upload's status
+        (i.e. the upload failed or was infected)
+    """
+    key = get_upload_key(request_id, upload_filename, for_update)
+    pipe = redis.pipeline()
+    if status is None:
+        pipe.delete(key)
+    else:
+        pipe.set(key, status)
+    pipe.publish(get_upload_status_channel(request_id), json.dumps({
+        'filename': upload_filename,
+        'for_update': for_update,
+        'status': status,
+    }))
+    pipe.execute()
+
+
+def get_upload_statuses(request_id, upload_filenames, for_update=False):
+    """
+    Returns the status of each upload (None if not found) with a single MGET.
+
+    :return: dict of upload filename to status
+    """
+    if not upload_filenames:
+        return {}
+    statuses = redis.mget([get_upload_key(request_id, filename, for_update) for filename in upload_filenames])
+    return {
+        filename: status.decode('utf-8') if status is not None else None
+        for filename, status in zip(upload_filenames, statuses)
+    }
+
+
+def get_upload_status_channel(request_id):
+    """
+    Returns the redis pub/sub channel upload status changes for a request are published to.
+    """
+    return '|'.join(('upload_status', request_id))
+
+
+class ScanFailedException(Exception):
+    """
+    Raise when scanner could not scan a file.
+    """
+    def __init__(self, filename):
+        super(ScanFailedException, self).__init__(
+            "File '{}' could not be scanned.".format(filename))
+
+
+class UploadSizeMismatchException(Exception):
+    """
+    Raise when a chunk does not match the size recorded for its upload.
+    """
+    def __init__(self, upload_key):
+        super(UploadSizeMismatchException, self).__init__(
+            "Chunk does not match the recorded size of upload '{}'.".format(upload_key))
+
+
 class VirusDetectedException(Exception):
     """
     Raise when scanner detects an infected file.
@@ -128,41 +289,187 @@ class VirusDetectedException(Exception):
 
 
 @celery.task
-def scan_upload(request_id, filepath, is_update=False, response_id=None):
+def scan_upload(request_id, filepath, is_update=False, response_id=None, metadata=None):
     """
-    Scans an uploaded file (see scan_file).
-    Updates redis accordingly.
+    Queues an uploaded file to be scanned (see process_scan_queue).
 
     :param request_id: id of request associated with the upload
     :param filepath: path to uploaded and quarantined file
     :param is_update: will the file replace an existing one?
     :param response_id: id of response associated with the upload
+    :param metadata: (size, mime type, hash) of the file if computed while it was written
+        (chunked uploads are read once after the scan instead, since their chunks may have
+        been written by different processes)
     """
     if is_update:
         assert response_id is not None
     else:
         assert response_id is None
 
-    filename = os.path.basename(filepath)
+    set_upload_status(request_id, os.path.basename(filepath), is_update, upload_status.SCANNING)
+    # pushed on the left and taken from the right (see process_scan_queue), so files are scanned in order
+    redis.lpush(SCAN_QUEUE_KEY, json.dumps({
+        'request_id': request_id,
+        'filepath': filepath,
+        'is_update': is_update,
+        'response_id': response_id,
+        'metadata': metadata,
+        'queued': time.time(),
+    }))
+    process_scan_queue.delay()
 
-    key = get_upload_key(request_id, filename, is_update)
-    redis.set(key, upload_status.SCANNING)
 
+@celery.task
+def process_scan_queue():
+    """
+    Scans queued uploads, up to VIRUS_SCAN_BATCH_SIZE files per scanner invocation,
+    until the queue is empty. Only one worker drains the queue at a time.
+    Updates redis accordingly.
+
+    Files are moved to a processing list while they are scanned and only removed from it once
+    their verdict is recorded (or they are queued again), so the files of a worker that stops
+    mid-batch are scanned by the next one.
+    """
+    lock = redis.lock(SCAN_QUEUE_LOCK_KEY, timeout=current_app.config['VIRUS_SCAN_TIMEOUT'] * 2)
+    if not lock.acquire(blocking=False):
+        return  # the worker holding the lock will scan the queued files
+    try:
+        batch_size = current_app.config['VIRUS_SCAN_BATCH_SIZE']
+        while True:
+            # left over by a worker that stopped before finishing its batch
+            entries = redis.lrange(SCAN_QUEUE_PROCESSING_KEY, 0, -1)
+            while len(entries) < batch_size:
+                entry = redis.rpoplpush(SCAN_QUEUE_KEY, SCAN_QUEUE_PROCESSING_KEY)
+                if entry is None:
+                    break
+                entries.append(entry)
+            if not entries:
+                break
+            if _scan_batch(entries):
+                # the scanner is unavailable, scan the queue again later
+                process_scan_queue.apply_async(countdown=SCAN_RETRY_DELAY)
+                return
+            lock.extend(current_app.config['VIRUS_SCAN_TIMEOUT'])
+    finally:
+        lock.release()
+    # files queued after the last batch was taken but before the lock was released
+    if redis.llen(SCAN_QUEUE_KEY):
+        process_scan_queue.delay()
+
+
+def _scan_batch(entries):
+    """
+    Scans a batch of queued files and records their verdicts. While the scanner is unavailable,
+    files are queued again instead, up to SCAN_MAX_ATTEMPTS times.
+
+    :param entries: queued files, as taken from the processing list
+    :return: whether any file was queued again
+    """
+    items = [json.loads(entry.decode()) for entry in entries]
+    start = time.time()
     try:
-        scan_file(filepath)
-    except VirusDetectedException:
+        verdicts = scan_files([item['filepath'] for item in items])
+        scanner_unavailable = False
+    except ScannerUnavailableException:
         sentry.captureException()
-        redis.delete(key)
-    else:
-        # store file metadata in redis
-        redis_set_file_metadata(response_id or request_id, filepath, is_update)
-        redis.set(key, upload_status.READY)
+        verdicts = {}
+        scanner_unavailable = True
+    except Exception:
+        # the files are recorded as failed below rather than left in the processing list
+        sentry.captureException()
+        current_app.logger.exception("Virus scan of {} files failed".format(len(items)))
+        verdicts = {}
+        scanner_unavailable = False
+    duration = time.time() - start
+
+    requeued = False
+    scanned = []
+    for entry, item in zip(entries, items):
+        attempts = item.get('attempts', 0) + 1
+        if scanner_unavailable and attempts < SCAN_MAX_ATTEMPTS:
+            pipe = redis.pipeline()
+            pipe.lpush(SCAN_QUEUE_KEY, json.dumps(dict(item, attempts=attempts)))
+            pipe.lrem(SCAN_QUEUE_PROCESSING_KEY, 1, entry)
+            pipe.execute()
+            requeued = True
+            continue
+        filepath = item['filepath']
+        verdict = verdicts.get(filepath, scan_verdict.FAILED)
+        filename = os.path.basename(filepath)
+        key = get_upload_key(item['request_id'], filename, item['is_update'])
+        redis.set(get_scan_verdict_key(key), verdict, ex=UPLOAD_MANIFEST_EXPIRY)
+        if verdict == scan_verdict.CLEAN:
+            # store file metadata in redis
+            redis_set_file_metadata(item['response_id'] or item['request_id'], filepath, item['is_update'],
+                                    item['metadata'])
+            set_upload_status(item['request_id'], filename, item['is_update'], upload_status.READY)
+        else:
+            if verdict == scan_verdict.INFECTED:
+                sentry.captureMessage(str(VirusDetectedException(filename)))
+            elif os.path.exists(filepath):
+                os.remove(filepath)
+            set_upload_status(item['request_id'], filename, item['is_update'], None)
+        redis.lrem(SCAN_QUEUE_PROCESSING_KEY, 1, entry)
+        scanned.append(item)
+
+    if scanned:
+        pipe = redis.pipeline()
+        pipe.hincrby(SCAN_STATS_KEY, 'batches', 1)
+        pipe.hincrby(SCAN_STATS_KEY, 'files', len(scanned))
+        pipe.hincrbyfloat(SCAN_STATS_KEY, 'scan_seconds', duration)
+        pipe.hincrbyfloat(SCAN_STATS_KEY, 'wait_seconds', sum(start - item['queued'] for item in scanned))
+        pipe.hset(SCAN_STATS_KEY, 'last_batch_size', len(scanned))
+        pipe.hset(SCAN_STATS_KEY, 'last_batch_seconds', duration)
+        pipe.execute()
+    return requeued
+
+
+def get_scan_stats():
+    """
+    Returns the virus scan queue depth and scan latency:
+        queue_depth - files waiting to be scanned
+        batches, files - scanned so far
+        average_wait_seconds - time a file spends in the queue
+        average_scan_seconds - scanner time per file
+        last_batch_size, last_batch_seconds
+    """
+    pipe = redis.pipeline()
+    pipe.llen(SCAN_QUEUE_KEY)
+    pipe.hgetall(SCAN_STATS_KEY)
+    queue_depth, stats = pipe.execute()
+    stats = {field.decode(): float(value) for field, value in stats.items()}
+    files = stats.get('files', 0)
+    return {
+        'queue_depth': queue_depth,
+        'batches': int(stats.get('batches', 0)),
+        'files': int(files),
+        'average_wait_seconds': stats.get('wait_seconds', 0) / files if files else None,
+        'average_scan_seconds': stats.get('scan_seconds', 0) / files if files else None,
+        'last_batch_size': int(stats.get('last_batch_size', 0)),
+        'last_batch_seconds': stats.get('last_batch_seconds'),
+    }
+
+
+def get_scan_verdict(upload_key):
+    """
+    Returns the scan verdict of an upload (see app.upload.constants.scan_verdict) or None.
+    """
+    verdict = redis.get(get_scan_verdict_key(upload_key))
+    return verdict.decode() if verdict is not None else None
+
+
+def get_scan_verdict_key(upload_key):
+    """
+    Since this key is stored alongside the upload key in upload_redis,
+    a pipe is used to avoid any key conflicts.
+    """
+    return '|'.join((upload_key, 'verdict'))
 
 
 @celery.task
 def complete_upload(request_id, quarantine_path, filename):
     """
-    Complete file upload to volume storage or Azure storage.
+    Complete file upload by moving the quarantined file to storage (see app.lib.storage).
 
     :param request_id: id of request associated with the upload
     :param quarantine_path: path to quarantined file
@@ -172,37 +479,31 @@ def complete_upload(request_id, quarantine_path, filename):
         current_app.config['UPLOAD_DIRECTORY'],
         request_id
     )
-    if current_app.config['USE_VOLUME_STORAGE']:
-        if not fu.exists(dst_dir):
-            try:
-                fu.makedirs(dst_dir)
-            except OSError as e:
-                sentry.captureException()
-                # in the time between the call to fu.exists
-                # and fu.makedirs, the directory was created
-                current_app.logger.error("OS Error: {}".format(e.args))
-        fu.move(
-            quarantine_path,
-            os.path.join(dst_dir, filename)
-        )
-    elif current_app.config['USE_AZURE_STORAGE']:
-        fu.azure_upload(quarantine_path, os.path.join(dst_dir, filename))
+    get_storage().put(quarantine_path, os.path.join(dst_dir, filename))
+
+
+def scan_files(filepaths):
+    """
+    Scans files for viruses with the configured scanner (see app.upload.scanner),
+    removing infected files.
+
+    :param filepaths: paths of files to scan
+    :return: dict of path to verdict (see app.upload.constants.scan_verdict)
+    """
+    if not current_app.config['VIRUS_SCAN_ENABLED']:
+        return {filepath: scan_verdict.CLEAN for filepath in filepaths}
+    return get_scanner().scan(filepaths)
+
 
 def scan_file(filepath):
     """
-    Scans a file for viruses using McAfee Virus Scan. If an infected
-    file is detected, removes the file and raises VirusDetectedException.
+    Scans a file for viruses. If an infected file is detected,
+    removes the file and raises VirusDetectedException.
 
     :param filepath: path of file to scan
     """
-    if current_app.config['VIRUS_SCAN_ENABLED']:
-        options = [
-            '--analyze',  # Use heuristic analysis to find possible new viruses
-            '--atime-preserve',  # Preserve the file's last-accessed time and date
-            '--delete'  # Automatically delete the infected file
-        ]
-        cmd = ['uvscan'] + options + [filepath]
-        subprocess.call(cmd)  # TODO: redirect output to logfile
-        # if the file was removed, it was infected
-        if not os.path.exists(filepath):
-            raise VirusDetectedException(os.path.basename(filepath))
+    verdict = scan_files([filepath])[filepath]
+    if verdict == scan_verdict.INFECTED:
+        raise VirusDetectedException(os.path.basename(filepath))
+    if verdict == scan_verdict.FAILED:
+        raise ScanFailedException(os.path.basename(filepath))
@@ -3,14 +3,19 @@
 
     :synopsis: Handles Upload endpoints for NYC OpenRecords
 """
+import json
 import os
+import time
 
 import app.lib.file_utils as fu
 
 from flask import (
+    Response,
     request,
     jsonify,
     current_app,
+    make_response,
+    stream_with_context,
 )
 from flask_login import (
     current_user,
@@ -25,6 +30,7 @@ from app.lib.utils import (
     eval_request_bool,
 )
 from app.lib.permission_utils import is_allowed
+from app.lib.storage import get_storage
 from app.models import (
     Responses,
     Requests
@@ -33,6 +39,10 @@ from app.constants import UPDATED_FILE_DIRNAME
 from app.upload import upload
 from app.upload.constants import (
     CONTENT_RANGE_HEADER,
+    UPLOAD_LENGTH_HEADER,
+    UPLOAD_OFFSET_HEADER,
+    UPLOAD_STATUS_STREAM_KEEPALIVE,
+    UPLOAD_STATUS_STREAM_RETRY,
     upload_status
 )
 from app.upload.utils import (
@@ -41,6 +51,17 @@ from app.upload.utils import (
     scan_upload,
     get_upload_key,
     upload_exists,
+    write_upload_chunk,
+    record_upload_chunk,
+    get_upload_offset,
+    get_upload_manifest_size,
+    delete_upload_manifest,
+    get_scan_stats,
+    get_upload_statuses,
+    get_upload_status_channel,
+    get_scan_verdict,
+    set_upload_status,
+    UploadSizeMismatchException,
 )
 
 
@@ -51,6 +72,10 @@ def post(request_id):
     Create a new upload.
 
     Handles chunked files through the Content-Range header.
+    Chunks are written at their byte positions and recorded in a
+    manifest, so they may be sent in any order, in parallel, or
+    again after an interrupted upload (see HEAD /upload/<request_id>).
+    The file is scanned once every byte has been received.
     For filesize validation and more upload logic, see:
         /static/js/upload/fileupload.js
 
@@ -98,9 +123,15 @@ def post(request_id):
 
                 try:
                     if CONTENT_RANGE_HEADER in request.headers:
-                        start, size = parse_content_range(
+                        start, _, size = parse_content_range(
                             request.headers[CONTENT_RANGE_HEADER])
 
+                        if get_upload_manifest_size(key) not in (None, size):
+                            # a different file is being uploaded under the same name
+                            delete_upload_manifest(key)
+                            if os.path.exists(filepath):
+                                os.remove(filepath)
+
                         # Only validate mime type on first chunk
                         valid_file_type = True
                         file_type = None
@@ -108,26 +139,29 @@ def post(request_id):
                             valid_file_type, file_type = is_valid_file_type(file_)
                             if current_user.is_agency_active(agency_ein):
                                 valid_file_type = True
-                            if os.path.exists(filepath):
-                                # remove existing file (upload 'restarted' for same file)
-                                os.remove(filepath)
 
                         if valid_file_type:
-                            redis.set(key, upload_status.PROCESSING)
-                            with open(filepath, 'ab') as fp:
-                                fp.seek(start)
-                                fp.write(file_.stream.read())
-                            # scan if last chunk written
-                            if os.path.getsize(filepath) == size:
+                            set_upload_status(request_id, filename, is_update, upload_status.PROCESSING)
+                            data = file_.stream.read()
+                            write_upload_chunk(filepath, start, data)
+                            # scan once every chunk has been written
+                            if record_upload_chunk(key, start, len(data), size):
+                                delete_upload_manifest(key)
                                 scan_upload.delay(request_id, filepath, is_update, response_id)
+                        else:
+                            delete_upload_manifest(key)
+                            if os.path.exists(filepath):
+                                os.remove(filepath)
                     else:
                         valid_file_type, file_type = is_valid_file_type(file_)
                         if current_user.is_agency_active(agency_ein):
                             valid_file_type = True
                         if valid_file_type:
-                            redis.set(key, upload_status.PROCESSING)
-                            file_.save(filepath)
-                            scan_upload.delay(request_id, filepath, is_update, response_id)
+                            set_upload_status(request_id, filename, is_update, upload_status.PROCESSING)
+                            with open(filepath, 'wb') as fp:
+                                ingest = fu.ingest_copy(file_.stream, fp)
+                            scan_upload.delay(request_id, filepath, is_update, response_id,
+                                              metadata=ingest.metadata)
                     if not valid_file_type:
                         response = {
                             "files": [{
@@ -144,9 +178,18 @@ def post(request_id):
                                 "size": os.path.getsize(filepath),
                             }]
                         }
+                except UploadSizeMismatchException:
+                    # another file was started under the same name while this one was uploading
+                    set_upload_status(request_id, filename, is_update, upload_status.ERROR)
+                    response = {
+                        "files": [{
+                            "name": filename,
+                            "error": "This file changed while it was being uploaded. Please upload it again."
+                        }]
+                    }
                 except Exception as e:
                     sentry.captureException()
-                    redis.set(key, upload_status.ERROR)
+                    set_upload_status(request_id, filename, is_update, upload_status.ERROR)
                     current_app.logger.exception("Upload for file '{}' failed: {}".format(filename, e))
                     response = {
                         "files": [{
@@ -158,6 +201,39 @@ def post(request_id):
         return jsonify(response), 200
 
 
+@upload.route('/<request_id>', methods=['HEAD'])
+@login_required
+def offset(request_id):
+    """
+    Get the progress of a chunked upload so it can be resumed.
+
+    Request Parameters:
+        - filename
+        - update (bool, optional)
+
+    :returns: empty response with headers
+        Upload-Offset: number of contiguous bytes received from the start of the file
+        Upload-Length: total size of the file (omitted if no chunks have been received)
+    """
+    if not (is_allowed(user=current_user, request_id=request_id, permission=permission.ADD_FILE) or
+            is_allowed(user=current_user, request_id=request_id, permission=permission.EDIT_FILE)):
+        return '', 403
+    try:
+        key = get_upload_key(
+            request_id,
+            secure_filename(request.args['filename']),
+            eval_request_bool(request.args.get('update'))
+        )
+    except KeyError:
+        return '', 422
+    offset_, size = get_upload_offset(key)
+    response = make_response('', 200)
+    response.headers[UPLOAD_OFFSET_HEADER] = str(offset_)
+    if size is not None:
+        response.headers[UPLOAD_LENGTH_HEADER] = str(size)
+    return response
+
+
 @upload.route('/<r_id_type>/<r_id>/<filecode>', methods=['DELETE'])
 @login_required
 def delete(r_id_type, r_id, filecode):
@@ -228,17 +304,15 @@ def delete(r_id_type, r_id, filecode):
             found = False
             if path != '':
                 if quarantined_only:
+                    delete_upload_manifest(get_upload_key(r_id, filename))
+                    delete_upload_manifest(get_upload_key(r_id, filename, True))
                     if os.path.exists(filepath):
                         os.remove(filepath)
                         found = True
                 else:
-                    # Check storage solution and delete file accordingly
-                    if (current_app.config['USE_VOLUME_STORAGE'] or current_app.config['USE_SFTP'])\
-                            and fu.exists(filepath):
-                        fu.remove(filepath)
-                        found = True
-                    elif current_app.config['USE_AZURE_STORAGE'] and fu.azure_exists(filepath):
-                        fu.azure_delete(filepath)
+                    storage = get_storage()
+                    if storage.exists(filepath):
+                        storage.delete(filepath)
                         found = True
             if found:
                 response = {"deleted": filename}
@@ -265,19 +339,22 @@ def status():
     :returns: {
         "status": upload status
     }
+    or, once a file has failed its scan: {
+        "error": ...,
+        "verdict": scan verdict
+    }
     """
     try:
-        status = redis.get(
-            get_upload_key(
-                request.args['request_id'],
-                secure_filename(request.args['filename']),
-                eval_request_bool(request.args.get('for_update'))
-            )
+        key = get_upload_key(
+            request.args['request_id'],
+            secure_filename(request.args['filename']),
+            eval_request_bool(request.args.get('for_update'))
         )
+        status = redis.get(key)
         if status is not None:
             response = {"status": status.decode("utf-8")}
         else:
-            response = {"error": "Upload status not found."}
+            response = {"error": "Upload status not found.", "verdict": get_scan_verdict(key)}
         status_code = 200
     except KeyError:
         sentry.captureException()
@@ -285,3 +362,128 @@ def status():
         status_code = 422
 
     return jsonify(response), status_code
+
+
+@upload.route('/status/batch', methods=['GET'])
+@login_required
+def status_batch():
+    """
+    Check the status of several uploads at once.
+
+    Request Parameters:
+        - request_id
+        - filename (repeated for each upload)
+        - for_update (bool, optional)
+
+    :returns: {
+        "statuses": {
+            filename: upload status (null if not found),
+            ...
+        },
+        "verdicts": {
+            filename: scan verdict of an upload without a status (e.g. "infected"),
+            ...
+        }
+    }
+    """
+    try:
+        request_id = request.args['request_id']
+    except KeyError:
+        return jsonify({}), 422
+    if not (is_allowed(user=current_user, request_id=request_id, permission=permission.ADD_FILE) or
+            is_allowed(user=current_user, request_id=request_id, permission=permission.EDIT_FILE)):
+        return jsonify({}), 403
+    filenames = request.args.getlist('filename')
+    for_update = eval_request_bool(request.args.get('for_update'))
+    statuses = get_upload_statuses(
+        request_id,
+        [secure_filename(filename) for filename in filenames],
+        for_update
+    )
+    return jsonify({
+        "statuses": {
+            filename: statuses[secure_filename(filename)] for filename in filenames
+        },
+        "verdicts": {
+            filename: get_scan_verdict(get_upload_key(request_id, secure_filename(filename), for_update))
+            for filename in filenames if statuses[secure_filename(filename)] is None
+        }
+    }), 200
+
+
+@upload.route('/status/stream', methods=['GET'])
+@login_required
+def status_stream():
+    """
+    Stream upload status changes for a request as server-sent events.
+
+    Each event's data is {"filename": upload filename, "status": upload status (null if not found)},
+    with the scan verdict (see status_batch) of an upload that has no status.
+    The current status of every 'filename' is sent first. The stream is closed once every upload
+    is ready or has failed, or after UPLOAD_STATUS_STREAM_TIMEOUT seconds (EventSource clients
+    reconnect automatically), so it only holds a worker while a scan is pending.
+
+    Request Parameters:
+        - request_id
+        - filename (repeated for each upload)
+        - for_update (bool, optional)
+    """
+    try:
+        request_id = request.args['request_id']
+    except KeyError:
+        return jsonify({}), 422
+    if not (is_allowed(user=current_user, request_id=request_id, permission=permission.ADD_FILE) or
+            is_allowed(user=current_user, request_id=request_id, permission=permission.EDIT_FILE)):
+        return jsonify({}), 403
+    # events name uploads as they were requested
+    filenames = {secure_filename(filename): filename for filename in request.args.getlist('filename')}
+    for_update = eval_request_bool(request.args.get('for_update'))
+    timeout = current_app.config['UPLOAD_STATUS_STREAM_TIMEOUT']
+
+    def event(filename, status_):
+        data = {"filename": filenames[filename], "status": status_}
+        if status_ is None:
+            data["verdict"] = get_scan_verdict(get_upload_key(request_id, filename, for_update))
+        return 'data: {}\n\n'.format(json.dumps(data))
+
+    def events():
+        pubsub = redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(get_upload_status_channel(request_id))
+        try:
+            yield 'retry: {}\n\n'.format(UPLOAD_STATUS_STREAM_RETRY)
+            pending = set(filenames)
+            # sent after subscribing so no change is missed
+            for filename, status_ in get_upload_statuses(request_id, list(filenames), for_update).items():
+                yield event(filename, status_)
+                if status_ in (None, upload_status.READY, upload_status.ERROR):
+                    pending.discard(filename)
+            deadline = time.time() + timeout
+            while pending and time.time() < deadline:
+                message = pubsub.get_message(
+                    timeout=min(UPLOAD_STATUS_STREAM_KEEPALIVE, max(deadline - time.time(), 0)))
+                if message is None:
+                    yield ': keepalive\n\n'
+                    continue
+                change = json.loads(message['data'].decode())
+                if change['for_update'] == for_update and change['filename'] in pending:
+                    yield event(change['filename'], change['status'])
+                    if change['status'] in (None, upload_status.READY, upload_status.ERROR):
+                        pending.discard(change['filename'])
+        finally:
+            pubsub.close()
+
+    return Response(stream_with_context(events()),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@upload.route('/scan/stats', methods=['GET'])
+@login_required
+def scan_stats():
+    """
+    Virus scan queue depth and latency (see app.upload.utils.get_scan_stats).
+    Only available to super users.
+    """
+    if not current_user.is_super:
+        return jsonify({}), 403
+    return jsonify(get_scan_stats()), 200
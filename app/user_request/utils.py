@@ -12,6 +12,7 @@ from flask_login import current_user
 from app.constants import event_type, permission, user_type_request
 from app.lib.db_utils import delete_object, create_object, update_object
 from app.lib.email_utils import get_agency_admin_emails
+from app.lib.permission_utils import clear_permissions_cache
 from app.lib.utils import UserRequestException
 from app.models import (
     Users,
@@ -49,32 +50,25 @@ def add_user_request(request_id, user_guid, permissions, point_of_contact):
         if i in permissions:
             added_permissions.append(val)
 
+    # template context shared by the administrators' and the user's email
+    context = _user_request_email_context(request_id, agency)
+    context.update(
+        name=user.name,
+        added_permissions=[capability.label for capability in added_permissions])
+    subject = 'User Added to Request {}'.format(request_id)
+
     # send email to agency administrators
     safely_send_and_add_email(
         request_id,
-        render_template(
-            'email_templates/email_user_request_added.html',
-            request_id=request_id,
-            name=user.name,
-            agency_name=agency.name,
-            page=urljoin(flask_request.host_url, url_for('request.view', request_id=request_id)),
-            added_permissions=[capability.label for capability in added_permissions],
-            admin=True),
-        'User Added to Request {}'.format(request_id),
+        render_template('email_templates/email_user_request_added.html', admin=True, **context),
+        subject,
         to=agency_admin_emails)
 
     # send email to user being added
     safely_send_and_add_email(
         request_id,
-        render_template(
-            'email_templates/email_user_request_added.html',
-            request_id=request_id,
-            name=user.name,
-            agency_name=agency.name,
-            page=urljoin(flask_request.host_url, url_for('request.view', request_id=request_id)),
-            added_permissions=[capability.label for capability in added_permissions],
-        ),
-        'User Added to Request {}'.format(request_id),
+        render_template('email_templates/email_user_request_added.html', **context),
+        subject,
         to=[user.notification_email or user.email])
 
     if point_of_contact and has_point_of_contact(request_id):
@@ -91,6 +85,7 @@ def add_user_request(request_id, user_guid, permissions, point_of_contact):
 
     if added_permissions:
         user_request.add_permissions([capability.value for capability in added_permissions])
+    clear_permissions_cache()
 
     user_request.request.es_update()
 
@@ -125,34 +120,30 @@ def edit_user_request(request_id, user_guid, permissions, point_of_contact):
         else:
             removed_permissions.append(val)
 
+    # template context shared by the administrators' and the user's email
+    context = _user_request_email_context(request_id, agency)
+    context.update(
+        added_permissions=[capability.label for capability in added_permissions],
+        removed_permissions=[capability.label for capability in removed_permissions])
+    subject = 'User Permissions Edited for Request {}'.format(request_id)
+
     # send email to agency administrators
     tmp = safely_send_and_add_email(
         request_id,
-        render_template(
-            'email_templates/email_user_request_edited.html',
-            request_id=request_id,
-            name=user_request.user.name,
-            agency_name=agency.name,
-            page=urljoin(flask_request.host_url, url_for('request.view', request_id=request_id)),
-            added_permissions=[capability.label for capability in added_permissions],
-            removed_permissions=[capability.label for capability in removed_permissions],
-            admin=True),
-        'User Permissions Edited for Request {}'.format(request_id),
+        render_template('email_templates/email_user_request_edited.html',
+                        name=user_request.user.name,
+                        admin=True,
+                        **context),
+        subject,
         to=agency_admin_emails)
 
     # send email to user being edited
     tmp = safely_send_and_add_email(
         request_id,
-        render_template(
-            'email_templates/email_user_request_edited.html',
-            request_id=request_id,
-            name=' '.join([user_request.user.first_name, user_request.user.last_name]),
-            agency_name=agency.name,
-            page=urljoin(flask_request.host_url, url_for('request.view', request_id=request_id)),
-            added_permissions=[capability.label for capability in added_permissions],
-            removed_permissions=[capability.label for capability in removed_permissions],
-        ),
-        'User Permissions Edited for Request {}'.format(request_id),
+        render_template('email_templates/email_user_request_edited.html',
+                        name=' '.join([user_request.user.first_name, user_request.user.last_name]),
+                        **context),
+        subject,
         to=[user_request.user.notification_email or user_request.user.email])
 
     old_permissions = user_request.permissions
@@ -162,6 +153,7 @@ def edit_user_request(request_id, user_guid, permissions, point_of_contact):
         user_request.add_permissions([capability.value for capability in added_permissions])
     if removed_permissions:
         user_request.remove_permissions([capability.value for capability in removed_permissions])
+    clear_permissions_cache()
 
     determine_point_of_contact_change(request_id, user_request, point_of_contact)
     create_user_request_event(event_type.USER_PERM_CHANGED, user_request, old_permissions, old_point_of_contact)
@@ -185,39 +177,48 @@ def remove_user_request(request_id, user_guid):
     agency = request.agency
     agency_admin_emails = get_agency_admin_emails(agency)
 
+    # template context shared by the administrators' and the user's email
+    context = _user_request_email_context(request_id, agency)
+    context.update(name=' '.join([user_request.user.first_name, user_request.user.last_name]))
+    subject = 'User Removed from Request {}'.format(request_id)
+
     # send email to agency administrators
     tmp = safely_send_and_add_email(
         request_id,
-        render_template(
-            'email_templates/email_user_request_removed.html',
-            request_id=request_id,
-            name=' '.join([user_request.user.first_name, user_request.user.last_name]),
-            agency_name=agency.name,
-            page=urljoin(flask_request.host_url, url_for('request.view', request_id=request_id)),
-            admin=True),
-        'User Removed from Request {}'.format(request_id),
+        render_template('email_templates/email_user_request_removed.html', admin=True, **context),
+        subject,
         to=agency_admin_emails)
 
     # send email to user being removed
     tmp = safely_send_and_add_email(
         request_id,
-        render_template(
-            'email_templates/email_user_request_removed.html',
-            request_id=request_id,
-            name=' '.join([user_request.user.first_name, user_request.user.last_name]),
-            agency_name=agency.name,
-            page=urljoin(flask_request.host_url, url_for('request.view', request_id=request_id))),
-        'User Removed from Request {}'.format(request_id),
+        render_template('email_templates/email_user_request_removed.html', **context),
+        subject,
         to=[user_request.user.email])
     old_permissions = user_request.permissions
     old_point_of_contact = user_request.point_of_contact
 
     create_user_request_event(event_type.USER_REMOVED, user_request, old_permissions, old_point_of_contact)
     delete_object(user_request)
+    clear_permissions_cache()
 
     request.es_update()
 
 
+def _user_request_email_context(request_id, agency):
+    """
+    Template context common to the user request emails.
+
+    :param request_id: FOIL request ID
+    :param agency: Agencies instance of the request
+    """
+    return {
+        'request_id': request_id,
+        'agency_name': agency.name,
+        'page': urljoin(flask_request.host_url, url_for('request.view', request_id=request_id)),
+    }
+
+
 def create_user_request_event(events_type, user_request, old_permissions=None, old_point_of_contact=None,
                               user=current_user):
     """
@@ -1,4 +1,5 @@
 from datetime import timedelta, datetime
+from tempfile import gettempdir
 
 import os, redis
 from dotenv import load_dotenv
@@ -43,11 +44,23 @@ class Config:
                   os.path.join(os.path.abspath(os.path.dirname(__file__)), 'data', 'envelope_templates.csv'))
     LATEX_TEMPLATE_DIRECTORY = (os.environ.get('LATEX_TEMPLATE_DIRECTORY') or
                                 os.path.join(os.path.abspath(os.path.dirname(__file__)), 'app', 'templates', 'latex'))
+    # Preloaded LaTeX format files, built by the PDF workers from each template's preamble
+    LATEX_FORMAT_DIRECTORY = (os.environ.get('LATEX_FORMAT_DIRECTORY') or
+                              os.path.join(gettempdir(), 'openrecords', 'latex_formats'))
+    LATEX_COMPILE_TIMEOUT = int(os.environ.get('LATEX_COMPILE_TIMEOUT', 60))  # seconds
+    # Celery queue PDFs are generated on (run dedicated workers with -Q to keep them warm)
+    PDF_CELERY_QUEUE = os.environ.get('PDF_CELERY_QUEUE', 'celery')
+    # Comma separated stylesheets (e.g. @font-face rules) applied to every letter PDF
+    LETTER_STYLESHEETS = [path for path in os.environ.get('LETTER_STYLESHEETS', '').split(',') if path]
+    # Seconds a generated PDF is cached (by the hash of its document)
+    PDF_CACHE_EXPIRY = int(os.environ.get('PDF_CACHE_EXPIRY', 86400))
     JSON_SCHEMA_DIRECTORY = (os.environ.get('JSON_SCHEMA_DIRECTORY') or
                              os.path.join(os.path.abspath(os.path.dirname(__file__)), 'app', 'constants', 'schemas'))
     LOGIN_IMAGE_PATH = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'app', 'static', 'img', 'login.png')
 
     DUE_SOON_DAYS_THRESHOLD = os.environ.get('DUE_SOON_DAYS_THRESHOLD') or 2
+    # Number of request numbers each worker reserves at once (values > 1 may leave gaps in request ids)
+    REQUEST_NUMBER_BLOCK_SIZE = int(os.environ.get('REQUEST_NUMBER_BLOCK_SIZE', 1))
 
     # SFTP
     USE_SFTP = os.environ.get('USE_SFTP') == "True"
@@ -57,6 +70,11 @@ class Config:
     SFTP_PASSWORD = os.environ.get('SFTP_PASSWORD', '').replace("'", "")
     SFTP_RSA_KEY_FILE = os.environ.get('SFTP_RSA_KEY_FILE')
     SFTP_UPLOAD_DIRECTORY = os.environ.get('SFTP_UPLOAD_DIRECTORY')
+    # Open SFTP sessions kept per worker process, and seconds an unused session is kept open
+    SFTP_POOL_SIZE = int(os.environ.get('SFTP_POOL_SIZE', 4))
+    SFTP_POOL_IDLE_TIMEOUT = int(os.environ.get('SFTP_POOL_IDLE_TIMEOUT', 300))
+    # Bytes of downloaded files kept in UPLOAD_SERVING_DIRECTORY (least recently served are evicted first)
+    SFTP_SERVING_CACHE_SIZE = int(os.environ.get('SFTP_SERVING_CACHE_SIZE', 5 * 1024 ** 3))
 
     # Authentication Settings
     PERMANENT_SESSION_LIFETIME = timedelta(minutes=int(os.environ.get('PERMANENT_SESSION_LIFETIME', 20)))
@@ -98,6 +116,8 @@ class Config:
     SESSION_REDIS_DB = 1
     UPLOAD_REDIS_DB = 2
     EMAIL_REDIS_DB = 3
+    FRAGMENT_REDIS_DB = 4
+    PDF_REDIS_DB = 5
 
     SESSION_REDIS = redis.StrictRedis(db=SESSION_REDIS_DB,
                                       host=REDIS_HOST,
@@ -123,6 +143,9 @@ class Config:
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
     MAIL_SUBJECT_PREFIX = os.environ.get('MAIL_SUBJECT_PREFIX')
     MAIL_SENDER = os.environ.get('MAIL_SENDER')
+    # Messages sent per SMTP connection, and times a message that could not be sent is retried
+    MAIL_BATCH_SIZE = int(os.environ.get('MAIL_BATCH_SIZE', 50))
+    MAIL_MAX_RETRIES = int(os.environ.get('MAIL_MAX_RETRIES', 3))
 
     ERROR_RECIPIENTS = (os.environ.get('ERROR_RECIPIENTS', None) or OPENRECORDS_DL_EMAIL).split(',')
 
@@ -134,6 +157,10 @@ class Config:
     SQLALCHEMY_TRACK_MODIFICATIONS = False  # remove once this becomes the default
     SQLALCHEMY_POOL_SIZE = 1
 
+    # SQL Query Counter (see app.lib.query_counter)
+    SQL_QUERY_COUNTER_ENABLED = os.environ.get('SQL_QUERY_COUNTER_ENABLED') == "True"
+    SQL_QUERY_DUPLICATE_THRESHOLD = int(os.environ.get('SQL_QUERY_DUPLICATE_THRESHOLD', 5))
+
     # Upload Settings
     # TODO: change naming since quarantine is used as a serving directory as well
     UPLOAD_QUARANTINE_DIRECTORY = (os.environ.get('UPLOAD_QUARANTINE_DIRECTORY') or
@@ -143,9 +170,29 @@ class Config:
     UPLOAD_DIRECTORY = (os.environ.get('UPLOAD_DIRECTORY') or
                         os.path.join(os.path.abspath(os.path.dirname(__file__)), 'data/')
                         if not USE_SFTP else SFTP_UPLOAD_DIRECTORY)
+    # Have the web server send files from UPLOAD_DIRECTORY after the app has checked access:
+    # 'nginx' (X-Accel-Redirect to FILE_SERVING_ACCEL_PREFIX, an internal location aliased to UPLOAD_DIRECTORY)
+    # or 'sendfile' (X-Sendfile with the file's path). Unset to stream files from the app.
+    FILE_SERVING_OFFLOAD = os.environ.get('FILE_SERVING_OFFLOAD')
+    FILE_SERVING_ACCEL_PREFIX = os.environ.get('FILE_SERVING_ACCEL_PREFIX', '/protected-uploads/')
+    # Seconds an upload status stream (server-sent events) is kept open while uploads are still being
+    # scanned; it holds a worker meanwhile, so keep this short and below the gunicorn timeout
+    UPLOAD_STATUS_STREAM_TIMEOUT = int(os.environ.get('UPLOAD_STATUS_STREAM_TIMEOUT', 30))
     VIRUS_SCAN_ENABLED = os.environ.get('VIRUS_SCAN_ENABLED') == "True"
+    # Virus scanner: 'uvscan', 'clamd' or 'stand-in' (see app.upload.scanner)
+    VIRUS_SCANNER = os.environ.get('VIRUS_SCANNER', 'uvscan')
+    # clamd's unix socket path or host:port
+    CLAMD_SOCKET = os.environ.get('CLAMD_SOCKET', '/var/run/clamd.scan/clamd.sock')
+    VIRUS_SCAN_BATCH_SIZE = int(os.environ.get('VIRUS_SCAN_BATCH_SIZE', 20))
+    VIRUS_SCAN_TIMEOUT = int(os.environ.get('VIRUS_SCAN_TIMEOUT', 300))  # seconds
     MAGIC_FILE = (os.environ.get('MAGIC_FILE') or
                   os.path.join(os.path.abspath(os.path.dirname(__file__)), 'magic'))
+    # Leading bytes of a file read to detect its mime type
+    MIME_SNIFF_BYTES = int(os.environ.get('MIME_SNIFF_BYTES', 16384))
+
+    # Rendered response rows and modals on the view request page (see request.api.views.get_request_responses)
+    RESPONSE_FRAGMENT_CACHE_ENABLED = os.environ.get('RESPONSE_FRAGMENT_CACHE_ENABLED') == "True"
+    RESPONSE_FRAGMENT_CACHE_TIMEOUT = int(os.environ.get('RESPONSE_FRAGMENT_CACHE_TIMEOUT', 3600))
 
     # ReCaptcha
     RECAPTCHA3_PUBLIC_KEY = os.environ.get("RECAPTCHA_SITE_KEY_V3", "")
@@ -170,6 +217,10 @@ class Config:
     SENTRY_DSN = os.environ.get('SENTRY_DSN')
     USE_SENTRY = os.environ.get('USE_SENTRY') == "True"
 
+    # Storage backend for uploaded files ('volume', 'sftp', 'azure' or 'memory'; see app.lib.storage).
+    # Defaults to the backend selected by USE_AZURE_STORAGE / USE_SFTP, otherwise 'volume'.
+    STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND')
+
     # Azure Settings
     USE_VOLUME_STORAGE = os.environ.get('USE_VOLUME_STORAGE') == "True"
     USE_AZURE_STORAGE = os.environ.get('USE_AZURE_STORAGE') == "True"
@@ -177,6 +228,11 @@ class Config:
     AZURE_STORAGE_CONTAINER = os.environ.get('AZURE_STORAGE_CONTAINER')
     AZURE_STORAGE_ACCOUNT_NAME = os.environ.get('AZURE_STORAGE_ACCOUNT_NAME')
     AZURE_STORAGE_ACCOUNT_KEY = os.environ.get('AZURE_STORAGE_ACCOUNT_KEY')
+    AZURE_STORAGE_CONNECTION_POOL_SIZE = int(os.environ.get('AZURE_STORAGE_CONNECTION_POOL_SIZE', 16))
+    # Files larger than a block are uploaded in blocks, MAX_CONCURRENCY at a time
+    AZURE_STORAGE_MAX_BLOCK_SIZE = int(os.environ.get('AZURE_STORAGE_MAX_BLOCK_SIZE', 8 * 1024 * 1024))
+    AZURE_STORAGE_MAX_CONCURRENCY = int(os.environ.get('AZURE_STORAGE_MAX_CONCURRENCY', 4))
+    AZURE_STORAGE_COPY_TIMEOUT = int(os.environ.get('AZURE_STORAGE_COPY_TIMEOUT', 300))  # seconds
 
     @staticmethod
     def init_app(app):
@@ -203,6 +259,7 @@ class TestingConfig(Config):
     TESTING = True
     WTF_CSRF_ENABLED = False  # TODO: retrieve and pass the token (via header or input value) for testing
     VIRUS_SCAN_ENABLED = True
+    VIRUS_SCANNER = 'stand-in'
     USE_SFTP = False
     UPLOAD_DIRECTORY = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'data_test/')
     MAIL_SERVER = 'localhost'
@@ -212,6 +269,7 @@ class TestingConfig(Config):
     MAIL_SENDER = 'OpenRecords - Pytest Admin <donotreply@records.nyc.gov>'
     SQLALCHEMY_DATABASE_URI = 'postgresql://testuser@127.0.0.1:5432/openrecords_test'
     ELASTICSEARCH_INDEX = "requests_test"
+    SQL_QUERY_COUNTER_ENABLED = True
 
 
 class ProductionConfig(Config):
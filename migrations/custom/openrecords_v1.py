@@ -21,7 +21,6 @@ from io import BytesIO
 from getpass import getpass
 from functools import wraps
 from datetime import datetime
-from tempfile import TemporaryFile
 from contextlib import contextmanager
 
 from nameparser import HumanName
@@ -49,9 +48,7 @@ from app.lib.date_utils import local_to_utc
 from app.lib.file_utils import (
     _sftp_get_size,
     _sftp_get_hash,
-    _sftp_exists,
-    _raise_if_too_big,
-    MaxTransferSizeExceededException
+    _sftp_exists
 )
 
 SHOW_PROGRESSBAR = True
@@ -673,24 +670,21 @@ def _sftp_get_mime_type(sftp, path):
     Script-compatible app.lib.file_utils._sftp_get_mime_type.
 
     The only difference between this and its file_utils counterpart
-    is the substitution of current_app.config['MAGIC_FILE'] with
-    CONFIG.MAGIC_FILE.
+    is the substitution of current_app.config['MAGIC_FILE'] and
+    current_app.config['MIME_SNIFF_BYTES'] with CONFIG.MAGIC_FILE and
+    CONFIG.MIME_SNIFF_BYTES.
 
     """
-    with TemporaryFile() as tmp:
-        try:
-            sftp.getfo(path, tmp, _raise_if_too_big)
-        except MaxTransferSizeExceededException:
-            pass
-        tmp.seek(0)
-        if CONFIG.MAGIC_FILE:
-            # Check using custom mime database file
-            m = magic.Magic(
-                magic_file=CONFIG.MAGIC_FILE,
-                mime=True)
-            mime_type = m.from_buffer(tmp.read())
-        else:
-            mime_type = magic.from_buffer(tmp.read(), mime=True)
+    with sftp.open(path, 'rb') as fp:
+        header = fp.read(CONFIG.MIME_SNIFF_BYTES)
+    if CONFIG.MAGIC_FILE:
+        # Check using custom mime database file
+        m = magic.Magic(
+            magic_file=CONFIG.MAGIC_FILE,
+            mime=True)
+        mime_type = m.from_buffer(header)
+    else:
+        mime_type = magic.from_buffer(header, mime=True)
     return mime_type
 
 
@@ -0,0 +1,22 @@
+"""Add index for paginating request history events
+
+Revision ID: b2f4e6a8c0d1
+Revises: 84a8fa98bdf2
+Create Date: 2026-10-19 10:12:31.402215
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b2f4e6a8c0d1'
+down_revision = '84a8fa98bdf2'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_index('ix_events_request_id_timestamp_id', 'events', ['request_id', 'timestamp', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_events_request_id_timestamp_id', table_name='events')
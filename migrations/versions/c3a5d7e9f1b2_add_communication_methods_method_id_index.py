@@ -0,0 +1,22 @@
+"""Add index on communication_methods.method_id
+
+Revision ID: c3a5d7e9f1b2
+Revises: b2f4e6a8c0d1
+Create Date: 2026-10-19 11:03:54.118930
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c3a5d7e9f1b2'
+down_revision = 'b2f4e6a8c0d1'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_index('ix_communication_methods_method_id', 'communication_methods', ['method_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_communication_methods_method_id', table_name='communication_methods')
@@ -0,0 +1,94 @@
+"""Store email bodies compressed and deduplicated by hash
+
+Revision ID: d4b6f8a0c2e3
+Revises: c3a5d7e9f1b2
+Create Date: 2026-10-19 15:42:10.512377
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'd4b6f8a0c2e3'
+down_revision = 'c3a5d7e9f1b2'
+
+import hashlib
+import zlib
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+BATCH_SIZE = 1000
+
+email_bodies = sa.table(
+    'email_bodies',
+    sa.column('hash', sa.String),
+    sa.column('data', sa.LargeBinary),
+)
+
+
+def upgrade():
+    op.create_table(
+        'email_bodies',
+        sa.Column('hash', sa.String(length=64), nullable=False),
+        sa.Column('data', sa.LargeBinary(), nullable=False),
+        sa.PrimaryKeyConstraint('hash'),
+    )
+    op.add_column('emails', sa.Column('body_hash', sa.String(length=64), nullable=True))
+    op.create_foreign_key('emails_body_hash_fkey', 'emails', 'email_bodies', ['body_hash'], ['hash'])
+
+    # backfill in batches so the whole table is never held in memory
+    conn = op.get_bind()
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            sa.text('SELECT id, body FROM emails WHERE id > :last_id AND body IS NOT NULL ORDER BY id LIMIT :limit'),
+            last_id=last_id,
+            limit=BATCH_SIZE,
+        ).fetchall()
+        if not rows:
+            break
+        bodies = {}
+        hashes = []
+        for id_, body in rows:
+            encoded = body.encode('utf-8')
+            hash_ = hashlib.sha256(encoded).hexdigest()
+            if hash_ not in bodies:
+                bodies[hash_] = zlib.compress(encoded)
+            hashes.append({'email_id': id_, 'body_hash': hash_})
+        conn.execute(
+            postgresql.insert(email_bodies).on_conflict_do_nothing(index_elements=['hash']),
+            [{'hash': hash_, 'data': data} for hash_, data in bodies.items()],
+        )
+        conn.execute(
+            sa.text('UPDATE emails SET body_hash = :body_hash WHERE id = :email_id'),
+            hashes,
+        )
+        last_id = rows[-1][0]
+
+    op.create_index('ix_emails_body_hash', 'emails', ['body_hash'], unique=False)
+    op.drop_column('emails', 'body')
+
+
+def downgrade():
+    op.add_column('emails', sa.Column('body', sa.String(), nullable=True))
+
+    conn = op.get_bind()
+    last_hash = ''
+    while True:
+        rows = conn.execute(
+            sa.text('SELECT hash, data FROM email_bodies WHERE hash > :last_hash ORDER BY hash LIMIT :limit'),
+            last_hash=last_hash,
+            limit=BATCH_SIZE,
+        ).fetchall()
+        if not rows:
+            break
+        conn.execute(
+            sa.text('UPDATE emails SET body = :body WHERE body_hash = :body_hash'),
+            [{'body': zlib.decompress(data).decode('utf-8'), 'body_hash': hash_} for hash_, data in rows],
+        )
+        last_hash = rows[-1][0]
+
+    op.drop_index('ix_emails_body_hash', table_name='emails')
+    op.drop_constraint('emails_body_hash_fkey', 'emails', type_='foreignkey')
+    op.drop_column('emails', 'body_hash')
+    op.drop_table('email_bodies')
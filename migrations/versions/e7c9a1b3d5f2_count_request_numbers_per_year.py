@@ -0,0 +1,24 @@
+"""Count agency request numbers per year
+
+Revision ID: e7c9a1b3d5f2
+Revises: d4b6f8a0c2e3
+Create Date: 2026-10-19 18:20:41.208113
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e7c9a1b3d5f2'
+down_revision = 'd4b6f8a0c2e3'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('agencies', sa.Column('request_number_year', sa.Integer(), nullable=True))
+    # the existing counters count this year's requests
+    op.execute("UPDATE agencies SET request_number_year = date_part('year', timezone('utc', now()))")
+
+
+def downgrade():
+    op.drop_column('agencies', 'request_number_year')
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""Email Throughput Benchmark Module
+
+This module measures how many messages per second are sent to a local stand-in SMTP server
+when every message opens its own connection (the previous send_async_email behaviour) and when
+stored messages are sent in batches over one connection (app.lib.email_utils.deliver_emails).
+Set RUN_BENCHMARKS=True to run it; results are logged (e.g. pytest --log-cli-level=INFO).
+"""
+import logging
+import os
+import time
+
+import pytest
+from flask import Flask
+from flask_mail import Message
+
+from app import mail
+from app.lib.email_utils import deliver_emails, store_email
+from tests.helpers.smtp import SMTPStandIn
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_COUNT = 200
+
+
+def _messages(app: Flask):
+    return [
+        Message('Benchmark {}'.format(i),
+                recipients=['recipient{}@records.nyc.gov'.format(i)],
+                body='Benchmark message',
+                sender=app.config['MAIL_SENDER'])
+        for i in range(MESSAGE_COUNT)
+    ]
+
+
+@pytest.mark.skipif(os.environ.get("RUN_BENCHMARKS") != "True", reason="Benchmarks are only run on demand.")
+def test_email_throughput(app: Flask):
+    """Compare per-message connections with batched delivery."""
+    mail_config = {
+        key: app.config[key] for key in ('MAIL_SERVER', 'MAIL_PORT', 'MAIL_BATCH_SIZE', 'MAIL_SUPPRESS_SEND')
+        if key in app.config
+    }
+    with SMTPStandIn() as server:
+        app.config.update(MAIL_SERVER='localhost', MAIL_PORT=server.port, MAIL_BATCH_SIZE=MESSAGE_COUNT)
+        mail.init_app(app)
+        mail.suppress = False
+
+        start = time.perf_counter()
+        for msg in _messages(app):
+            mail.send(msg)
+        single_seconds = time.perf_counter() - start
+        single_connections = server.connections
+
+        items = [{'id': store_email(msg), 'attempts': 0} for msg in _messages(app)]
+        start = time.perf_counter()
+        sent = deliver_emails(items)
+        batched_seconds = time.perf_counter() - start
+        batched_connections = server.connections - single_connections
+
+        messages = server.messages
+
+    app.config.update(mail_config)
+    mail.init_app(app)
+
+    logger.info("per message: {:8.1f} msg/s ({} connections)  batched: {:8.1f} msg/s ({} connection)".format(
+        MESSAGE_COUNT / max(single_seconds, 1e-9),
+        single_connections,
+        MESSAGE_COUNT / max(batched_seconds, 1e-9),
+        batched_connections
+    ))
+    assert sent == MESSAGE_COUNT
+    assert messages == 2 * MESSAGE_COUNT
+    assert single_connections == MESSAGE_COUNT
+    assert batched_connections == 1
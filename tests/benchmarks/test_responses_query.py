@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""Responses Query Benchmark Module
+
+This module benchmarks the query behind the `/request/api/v1.0/responses` endpoint as the
+`communication_methods` table grows. Set RUN_BENCHMARKS=True to run it; results are logged
+(e.g. pytest --log-cli-level=INFO).
+"""
+import logging
+import os
+import timeit
+from datetime import datetime, timedelta
+
+import pytest
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import desc, func
+
+from app.constants import RESPONSES_INCREMENT, response_privacy, response_type
+from app.models import Agencies, Anonymous, CommunicationMethods, Notes, Requests, Responses
+from app.request.api.utils import get_request_responses_query
+
+logger = logging.getLogger(__name__)
+
+COMMUNICATION_METHODS_SIZES = [0, 10000, 50000]
+FILLER_RESPONSE_ID_START = 1000000
+
+
+def _create_request(db: SQLAlchemy):
+    """Create an agency and a request with a page worth of public notes."""
+    agency = Agencies(ein="0999", parent_ein="999", categories=["Business"], name="Benchmark Agency",
+                      next_request_number=1, default_email="benchmark@records.nyc.gov",
+                      appeals_email="benchmark@records.nyc.gov", is_active=True, agency_features={})
+    request = Requests(id="FOIL-2019-999-00001", title="Benchmark", description="Benchmark",
+                       agency_ein=agency.ein, date_created=datetime.utcnow())
+    db.session.add_all([agency, request])
+    for i in range(RESPONSES_INCREMENT * 2):
+        note = Notes(request.id, response_privacy.RELEASE_AND_PUBLIC, "Note {}".format(i))
+        note.release_date = datetime.utcnow() - timedelta(days=1)
+        db.session.add(note)
+    db.session.commit()
+    return request
+
+
+def _grow_communication_methods(db: SQLAlchemy, request_id: str, start: int, stop: int):
+    """Insert communication method rows (and the email responses they point to) with ids in [start, stop)."""
+    if start >= stop:
+        return
+    db.session.execute(Responses.__table__.insert(), [
+        {"id": id_, "request_id": request_id, "privacy": response_privacy.PRIVATE, "type": response_type.EMAIL,
+         "date_modified": datetime.utcnow(), "deleted": False, "is_editable": False, "is_dataset": False}
+        for id_ in range(start, stop)
+    ])
+    db.session.execute(CommunicationMethods.__table__.insert(), [
+        {"response_id": id_, "method_id": id_, "method_type": response_type.EMAIL}
+        for id_ in range(start, stop)
+    ])
+    db.session.commit()
+
+
+@pytest.mark.skipif(os.environ.get("RUN_BENCHMARKS") != "True", reason="Benchmarks are only run on demand.")
+def test_responses_query_latency_is_flat(db: SQLAlchemy):
+    """Test the responses query latency does not grow with the communication_methods table."""
+    request = _create_request(db)
+    user = Anonymous()
+
+    def run_query():
+        query = get_request_responses_query(request, user)
+        total = query.with_entities(func.count(Responses.id)).scalar()
+        responses = query.order_by(desc(Responses.date_modified)).limit(RESPONSES_INCREMENT).all()
+        assert total == RESPONSES_INCREMENT * 2
+        assert len(responses) == RESPONSES_INCREMENT
+
+    timings = {}
+    size = 0
+    for target_size in COMMUNICATION_METHODS_SIZES:
+        _grow_communication_methods(db, request.id, FILLER_RESPONSE_ID_START + size,
+                                    FILLER_RESPONSE_ID_START + target_size)
+        size = target_size
+        db.session.execute("ANALYZE communication_methods")
+        timings[size] = min(timeit.repeat(run_query, number=5, repeat=3)) / 5
+        logger.info("communication_methods rows: {:>6}  query: {:.2f}ms".format(size, timings[size] * 1000))
+
+    smallest, largest = COMMUNICATION_METHODS_SIZES[0], COMMUNICATION_METHODS_SIZES[-1]
+    assert timings[largest] < timings[smallest] * 3
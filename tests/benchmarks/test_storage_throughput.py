@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""Storage Throughput Benchmark Module
+
+This module measures upload (put), serve (stream) and move throughput for each storage backend
+in app.lib.storage. The SFTP and Azure backends are only measured when the testing configuration
+points at a server (USE_SFTP / USE_AZURE_STORAGE). Set RUN_BENCHMARKS=True to run it; results
+are logged (e.g. pytest --log-cli-level=INFO).
+"""
+import logging
+import os
+import tempfile
+import time
+
+import pytest
+from flask import Flask
+
+from app.lib.storage import STORAGE_BACKENDS, AzureStorage, SFTPStorage
+
+logger = logging.getLogger(__name__)
+
+FILE_SIZES = [1024 * 1024, 32 * 1024 * 1024]  # 1 mb, 32 mb
+BLOCK = os.urandom(1024 * 1024)
+
+
+def _configured(app: Flask, name: str):
+    return {
+        SFTPStorage.name: app.config['USE_SFTP'],
+        AzureStorage.name: app.config['USE_AZURE_STORAGE'],
+    }.get(name, True)
+
+
+def _write_local_file(size: int):
+    """Create a local file of 'size' bytes to upload."""
+    fd, path = tempfile.mkstemp()
+    with os.fdopen(fd, 'wb') as fp:
+        for _ in range(size // len(BLOCK)):
+            fp.write(BLOCK)
+    return path
+
+
+def _mb_per_second(size: int, seconds: float):
+    return size / (1024 * 1024) / max(seconds, 1e-9)
+
+
+@pytest.mark.skipif(os.environ.get("RUN_BENCHMARKS") != "True", reason="Benchmarks are only run on demand.")
+@pytest.mark.parametrize("name", sorted(STORAGE_BACKENDS))
+@pytest.mark.parametrize("size", FILE_SIZES)
+def test_storage_throughput(app: Flask, name: str, size: int):
+    """Measure put, stream and move throughput of a storage backend."""
+    if not _configured(app, name):
+        pytest.skip("{} storage is not configured.".format(name))
+    storage = STORAGE_BACKENDS[name]()
+    directory = os.path.join(app.config['UPLOAD_DIRECTORY'], 'storage-benchmark')
+    path = os.path.join(directory, 'upload-{}'.format(size))
+    moved_path = os.path.join(directory, 'moved', 'upload-{}'.format(size))
+    local_path = _write_local_file(size)
+
+    start = time.perf_counter()
+    storage.put(local_path, path)
+    put_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    streamed = sum(len(block) for block in storage.stream(path))
+    stream_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    storage.move(path, moved_path)
+    move_seconds = time.perf_counter() - start
+
+    storage.delete(moved_path)
+
+    logger.info("{:>6} {:>4} MB  put: {:8.1f} MB/s  stream: {:8.1f} MB/s  move: {:.1f}ms".format(
+        name,
+        size // (1024 * 1024),
+        _mb_per_second(size, put_seconds),
+        _mb_per_second(size, stream_seconds),
+        move_seconds * 1000
+    ))
+    assert streamed == size
+    assert not os.path.exists(local_path)
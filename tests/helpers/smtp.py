@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""SMTP Stand-in Module
+
+A minimal SMTP server for tests and benchmarks. It accepts every message and records
+how many messages and connections it received, without delivering anything.
+"""
+import socketserver
+import threading
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+
+    def _reply(self, line: str):
+        self.wfile.write((line + '\r\n').encode())
+
+    def handle(self):
+        self.server.connections += 1
+        self._reply('220 localhost stand-in SMTP ready')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode(errors='replace').strip().upper()
+            if command.startswith(('HELO', 'EHLO')):
+                self._reply('250 localhost')
+            elif command == 'DATA':
+                self._reply('354 End data with <CR><LF>.<CR><LF>')
+                for data in iter(self.rfile.readline, b''):
+                    if data in (b'.\r\n', b'.\n'):
+                        break
+                with self.server.lock:
+                    self.server.messages += 1
+                self._reply('250 OK')
+            elif command == 'QUIT':
+                self._reply('221 Bye')
+                return
+            else:  # MAIL, RCPT, RSET, NOOP
+                self._reply('250 OK')
+
+
+class SMTPStandIn(socketserver.ThreadingTCPServer):
+    """
+    Usage:
+        with SMTPStandIn() as server:
+            app.config['MAIL_PORT'] = server.port
+            ...
+            server.messages, server.connections
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host: str = 'localhost', port: int = 0):
+        super(SMTPStandIn, self).__init__((host, port), _SMTPHandler)
+        self.lock = threading.Lock()
+        self.messages = 0
+        self.connections = 0
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
@@ -5,8 +5,10 @@ This module contains helper functions for running tests.
 
 """
 import pytest
+from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 
+from app.lib.query_counter import query_budget
 from app.models import Requests
 
 def clear_data(db: SQLAlchemy):
@@ -30,4 +32,18 @@ def create_request():
     Returns:
 
     """
-    pass
\ No newline at end of file
+    pass
+
+
+def get_within_query_budget(client: Flask.test_client, url: str, max_queries: int):
+    """Issue a GET request and fail if handling it runs more than `max_queries` SQL statements.
+    Args:
+        client (Flask.test_client): The test client used to access the endpoint
+        url (str): URL to request
+        max_queries (int): Maximum number of SQL statements the endpoint may issue
+
+    Returns:
+        response (Flask.Response): The response returned by the endpoint
+    """
+    with query_budget(max_queries):
+        return client.get(url)
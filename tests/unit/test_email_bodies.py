@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+"""Test Email Bodies Module
+
+This module contains the tests for the deduplicated, compressed storage of email bodies.
+"""
+from flask_sqlalchemy import SQLAlchemy
+
+from app.models import EmailBodies
+
+
+def test_store_deduplicates(db: SQLAlchemy):
+    """Test an identical body is stored once, compressed."""
+    body = "<p>Your request has been acknowledged.</p>" * 100
+
+    first = EmailBodies.store(body)
+    second = EmailBodies.store(body)
+
+    assert first == second
+    assert EmailBodies.query.filter_by(hash=first).count() == 1
+    stored = EmailBodies.query.get(first)
+    assert len(stored.data) < len(body)
+    assert stored.text == body
+
+
+def test_store_distinct_bodies(db: SQLAlchemy):
+    """Test different bodies are stored under different hashes."""
+    assert EmailBodies.store("<p>Request closed.</p>") != EmailBodies.store("<p>Request denied.</p>")
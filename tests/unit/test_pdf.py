@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""Test PDF Module
+
+This module contains the tests for LaTeX compilation with preloaded format files,
+for combining documents into one compile, for generating PDFs in the background
+(and serving them once they are ready) and for rendering letters on PDF workers.
+"""
+import os
+import shutil
+
+import pytest
+from flask import Flask, has_request_context
+
+import app.response.utils as response_utils
+from app import pdf_redis
+from app.lib.pdf import (
+    PDF_FAILED,
+    PDF_INVALID,
+    PDF_PENDING,
+    LatexCompiler,
+    combine_latex_documents,
+    compile_latex_pdf,
+    get_cached_pdf,
+    get_pdf_key,
+    get_pdf_status,
+    get_pdf_status_key,
+    hash_document,
+    pdf_response,
+    render_html_pdf,
+    request_latex_pdf
+)
+from app.lib.utils import PDFCreationException
+
+DOCUMENT = r"""\documentclass{letter}
+\usepackage{graphicx}
+\pagestyle{empty}
+
+\begin{document}
+    FOIL-2026-001-00001
+\end{document}
+"""
+
+
+LETTER = """<html><body>
+    <img src="/static/img/checkbox.png"> FOIL-2026-001-00001
+</body></html>"""
+
+
+@pytest.mark.skipif(shutil.which("pdflatex") is None, reason="pdflatex is not installed.")
+def test_compile_with_format(app: Flask, tmpdir):
+    """Test a format file is built for the preamble once and used by later compiles."""
+    compiler = LatexCompiler(format_directory=str(tmpdir), timeout=60)
+
+    first = compiler.compile(DOCUMENT)
+    formats = os.listdir(str(tmpdir))
+    second = compiler.compile(DOCUMENT.replace("00001", "00002"))
+
+    assert first.startswith(b"%PDF")
+    assert second.startswith(b"%PDF")
+    assert os.listdir(str(tmpdir)) == formats
+
+
+def test_request_latex_pdf_serves_cached_document(app: Flask, monkeypatch):
+    """Test a compiled document is served from the cache, and a document that differs is compiled."""
+    queued = []
+    monkeypatch.setattr(compile_latex_pdf, "apply_async", lambda args, **kwargs: queued.append(args))
+    monkeypatch.setattr("app.lib.pdf.compile_latex", lambda document: b"%PDF " + document.encode("utf-8"))
+    document = DOCUMENT.replace("FOIL", "FOIL é")
+    other = document.replace("00001", "00002")
+    for key in (document, other):
+        pdf_redis.delete(get_pdf_key(hash_document(key)), get_pdf_status_key(hash_document(key)))
+
+    document_hash = compile_latex_pdf(document)
+
+    assert request_latex_pdf(document) == (document_hash, b"%PDF " + document.encode("utf-8"))
+    other_hash, pdf = request_latex_pdf(other)
+    assert other_hash != document_hash
+    assert pdf is None
+    assert get_cached_pdf(other_hash) is None
+    assert queued == [(other,)]
+
+    for key in (document, other):
+        pdf_redis.delete(get_pdf_key(hash_document(key)), get_pdf_status_key(hash_document(key)))
+
+
+def test_failed_format_is_not_rebuilt(app: Flask, tmpdir, monkeypatch):
+    """Test a preamble that cannot be dumped into a format is compiled without one, and not dumped again."""
+    commands = []
+
+    def run(self, command, cwd):
+        commands.append(command)
+        if "-ini" in command:
+            raise PDFCreationException(status_code=1)
+        with open(os.path.join(cwd, "document.pdf"), "wb") as f:
+            f.write(b"%PDF")
+
+    monkeypatch.setattr(LatexCompiler, "_run", run)
+    compiler = LatexCompiler(format_directory=str(tmpdir), timeout=60)
+
+    compiler.compile(DOCUMENT)
+    compiler.compile(DOCUMENT.replace("00001", "00002"))
+
+    assert len([command for command in commands if "-ini" in command]) == 1
+    assert not any(arg.startswith("-fmt=") for command in commands for arg in command)
+    assert [name for name in os.listdir(str(tmpdir)) if name.endswith(".failed")]
+
+
+def test_timed_out_format_is_built_again(app: Flask, tmpdir, monkeypatch):
+    """Test a preamble whose dump timed out is not remembered as one that cannot be dumped."""
+    commands = []
+
+    def run(self, command, cwd):
+        commands.append(command)
+        if "-ini" in command:
+            raise PDFCreationException(status_code=-1, stderr=b"Timed out")
+        with open(os.path.join(cwd, "document.pdf"), "wb") as f:
+            f.write(b"%PDF")
+
+    monkeypatch.setattr(LatexCompiler, "_run", run)
+    compiler = LatexCompiler(format_directory=str(tmpdir), timeout=60)
+
+    compiler.compile(DOCUMENT)
+    compiler.compile(DOCUMENT)
+
+    assert len([command for command in commands if "-ini" in command]) == 2
+    assert not [name for name in os.listdir(str(tmpdir)) if name.endswith(".failed")]
+
+
+def test_request_latex_pdf_compiles_once(app: Flask, monkeypatch):
+    """Test a document is only queued for compiling once however many times it is requested meanwhile."""
+    queued = []
+    monkeypatch.setattr(compile_latex_pdf, "apply_async", lambda args, **kwargs: queued.append(args))
+    document_hash = hash_document(DOCUMENT)
+    pdf_redis.delete(get_pdf_key(document_hash), get_pdf_status_key(document_hash))
+
+    assert request_latex_pdf(DOCUMENT) == (document_hash, None)
+    assert request_latex_pdf(DOCUMENT) == (document_hash, None)
+    assert queued == [(DOCUMENT,)]
+    assert get_pdf_status(document_hash) == PDF_PENDING
+
+    pdf_redis.delete(get_pdf_key(document_hash), get_pdf_status_key(document_hash))
+
+
+def test_pdf_response(app: Flask):
+    """Test a PDF is served once it is ready, polled while it is generated and reported if it failed."""
+    document_hash = hash_document(DOCUMENT)
+    status_key = get_pdf_status_key(document_hash)
+    with app.test_request_context(headers={"Accept": "application/json"}):
+        response = pdf_response(document_hash, b"%PDF", "envelope.pdf")
+        assert response.status_code == 200
+        assert response.mimetype == "application/pdf"
+
+        pdf_redis.set(status_key, PDF_PENDING)
+        response = pdf_response(document_hash, None, "envelope.pdf")
+        assert response.status_code == 202
+        assert response.headers["Retry-After"]
+        assert response.get_json()["status"] == PDF_PENDING
+
+        pdf_redis.set(status_key, PDF_FAILED)
+        assert pdf_response(document_hash, None, "envelope.pdf")[1] == 500
+
+        pdf_redis.set(status_key, PDF_INVALID)
+        assert pdf_response(document_hash, None, "envelope.pdf")[1] == 400
+
+    pdf_redis.delete(status_key)
+
+
+def test_email_envelope_records_nothing_if_compile_fails(app: Flask, monkeypatch):
+    """Test an envelope's notification email is only recorded and sent once the envelope compiles."""
+    sent = []
+    monkeypatch.setattr(response_utils, "_send_pdf_email", lambda *args: sent.append(args))
+
+    def compile_fails(document):
+        raise PDFCreationException(status_code=1)
+
+    monkeypatch.setattr(response_utils, "compile_latex_pdf", compile_fails)
+    with pytest.raises(PDFCreationException):
+        response_utils.email_envelope("FOIL-2026-001-00001", 1, "guid", "Subject", "<p>Email</p>",
+                                      DOCUMENT, "envelope.pdf")
+    assert sent == []
+
+    monkeypatch.setattr(response_utils, "compile_latex_pdf", lambda document: hash_document(document))
+    monkeypatch.setattr(response_utils, "get_cached_pdf", lambda document_hash: b"%PDF")
+    response_utils.email_envelope("FOIL-2026-001-00001", 1, "guid", "Subject", "<p>Email</p>",
+                                  DOCUMENT, "envelope.pdf")
+    assert sent == [("FOIL-2026-001-00001", 1, "guid", "Subject", "<p>Email</p>", b"%PDF", "envelope.pdf")]
+
+
+def test_email_letter_retries_if_render_fails(app: Flask, monkeypatch):
+    """Test a letter that fails to render is retried and its notification email is not recorded."""
+    sent = []
+    monkeypatch.setattr(response_utils, "_send_pdf_email", lambda *args: sent.append(args))
+
+    def render_fails(document):
+        raise ValueError("Unable to render")
+
+    monkeypatch.setattr("app.lib.pdf.generate_pdf", render_fails)
+    document_hash = hash_document(LETTER)
+    pdf_redis.delete(get_pdf_key(document_hash))
+
+    assert PDFCreationException in response_utils.email_letter.autoretry_for
+    with pytest.raises(PDFCreationException):
+        response_utils.email_letter("FOIL-2026-001-00001", 1, "guid", "Subject", "<p>Email</p>",
+                                    LETTER, "letter.pdf")
+    assert get_pdf_status(document_hash) == PDF_FAILED
+    assert sent == []
+
+    pdf_redis.delete(get_pdf_status_key(document_hash))
+
+
+def test_combine_latex_documents():
+    """Test documents with the same preamble are combined one per page."""
+    documents = [DOCUMENT.replace("00001", "0000{}".format(i)) for i in range(1, 4)]
+
+    combined = combine_latex_documents(documents)
+
+    assert combined.count(r"\documentclass") == 1
+    assert combined.count(r"\begin{document}") == 1
+    assert combined.count(r"\end{document}") == 1
+    assert combined.count(r"\newpage") == 2
+    assert combined.index("00001") < combined.index("00002") < combined.index("00003")
+
+
+def test_combine_latex_documents_different_preambles():
+    """Test documents from different templates are not combined."""
+    with pytest.raises(ValueError):
+        combine_latex_documents([DOCUMENT, DOCUMENT.replace("letter", "article")])
+
+
+def test_render_html_pdf_without_request_context(app: Flask):
+    """Test letters render (static images included) with only an application context, as on a PDF worker."""
+    assert not has_request_context()
+    document_hash = hash_document(LETTER)
+    pdf_redis.delete(get_pdf_key(document_hash))
+
+    assert render_html_pdf(LETTER) == document_hash
+    assert get_cached_pdf(document_hash).startswith(b"%PDF")
+
+    pdf_redis.delete(get_pdf_key(document_hash))
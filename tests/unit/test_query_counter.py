@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""Test Query Counter Module
+
+This module contains the tests for the per-request SQL query counter.
+"""
+import pytest
+from flask import Flask
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.exc import ProgrammingError
+
+from app.lib.query_counter import (
+    QueryBudgetExceededException,
+    QueryStats,
+    count_queries,
+    query_budget
+)
+
+
+def test_query_stats_duplicates():
+    """Test only statements repeated at least `threshold` times are flagged."""
+    stats = QueryStats()
+    for _ in range(3):
+        stats.record("SELECT * FROM users WHERE guid = %(guid)s", 0.001)
+    stats.record("SELECT 1", 0.001)
+
+    assert stats.count == 4
+    assert stats.duplicates(3) == [("SELECT * FROM users WHERE guid = %(guid)s", 3)]
+    assert stats.duplicates(5) == []
+
+
+def test_count_queries(db: SQLAlchemy):
+    """Test statements executed inside the block are counted."""
+    with count_queries() as stats:
+        db.session.execute("SELECT 1")
+        db.session.execute("SELECT 1")
+
+    assert stats.count == 2
+    assert stats.statements["SELECT 1"] == 2
+
+
+def test_failed_statement_is_not_left_timing(db: SQLAlchemy):
+    """Test a statement that raises does not leave its start time on the connection."""
+    connection = db.session.connection()
+    with count_queries():
+        with pytest.raises(ProgrammingError):
+            connection.execute("SELECT * FROM no_such_table")
+
+    assert not connection.info.get("query_start_time")
+
+
+def test_query_budget(db: SQLAlchemy):
+    """Test the query budget raises once it is exceeded."""
+    with query_budget(1):
+        db.session.execute("SELECT 1")
+
+    with pytest.raises(QueryBudgetExceededException):
+        with query_budget(1):
+            db.session.execute("SELECT 1")
+            db.session.execute("SELECT 1")
+
+
+def test_query_count_header(client: Flask.test_client):
+    """Test the query count and time are reported as response headers."""
+    response = client.get("/status")
+    assert "X-Query-Count" in response.headers
+    assert "X-Query-Time" in response.headers
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""Test Scanner Module
+
+This module contains the tests for the stand-in virus scanner used by the testing configuration.
+"""
+import os
+
+from flask import Flask
+
+from app.upload.constants import scan_verdict
+from app.upload.scanner import EICAR_SIGNATURE, ClamdScanner, StandInScanner, get_scanner
+from app.upload.utils import scan_files
+
+
+def test_stand_in_scanner(tmpdir):
+    """Test infected files are reported and removed while clean files are kept."""
+    clean = tmpdir.join("clean.txt")
+    clean.write_binary(b"Nothing to see here.")
+    infected = tmpdir.join("infected.txt")
+    infected.write_binary(os.urandom(2 * 1024 * 1024) + EICAR_SIGNATURE)
+
+    verdicts = StandInScanner().scan([str(clean), str(infected)])
+
+    assert verdicts == {str(clean): scan_verdict.CLEAN, str(infected): scan_verdict.INFECTED}
+    assert clean.exists()
+    assert not infected.exists()
+
+
+def test_scan_files_uses_configured_scanner(app: Flask, tmpdir):
+    """Test the testing configuration scans with the stand-in scanner."""
+    infected = tmpdir.join("infected.txt")
+    infected.write_binary(EICAR_SIGNATURE)
+
+    assert isinstance(get_scanner(), StandInScanner)
+    assert scan_files([str(infected)]) == {str(infected): scan_verdict.INFECTED}
+
+
+class FakeClamdSocket(object):
+    """Replies to an IDSESSION with canned replies."""
+
+    def __init__(self, replies):
+        self.data = b"".join(reply + b"\0" for reply in replies)
+
+    def sendall(self, data):
+        pass
+
+    def recv(self, size):
+        data, self.data = self.data[:size], self.data[size:]
+        return data
+
+    def close(self):
+        pass
+
+
+def test_clamd_unparseable_reply_fails_scan(app: Flask, monkeypatch, tmpdir):
+    """Test files whose clamd reply carries no id are reported as failed rather than raising."""
+    clean = str(tmpdir.join("clean.txt"))
+    other = str(tmpdir.join("other.txt"))
+    replies = [b"1: " + clean.encode() + b": OK", b"UNKNOWN COMMAND"]
+    monkeypatch.setattr(ClamdScanner, "_connect", lambda self: FakeClamdSocket(replies))
+
+    verdicts = ClamdScanner("/var/run/clamd.sock", 10).scan([clean, other])
+
+    assert verdicts == {clean: scan_verdict.CLEAN, other: scan_verdict.FAILED}
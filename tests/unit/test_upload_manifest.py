@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""Test Upload Manifest Module
+
+This module contains the tests for recording the chunks of resumable uploads.
+"""
+import pytest
+from flask import Flask
+
+from app.upload.utils import (
+    UploadSizeMismatchException,
+    delete_upload_manifest,
+    get_upload_offset,
+    record_upload_chunk,
+)
+
+UPLOAD_KEY = "FOIL-TEST-0001|test.txt"
+
+
+@pytest.fixture
+def upload_key(app: Flask):
+    delete_upload_manifest(UPLOAD_KEY)
+    yield UPLOAD_KEY
+    delete_upload_manifest(UPLOAD_KEY)
+
+
+def test_resent_chunks_complete_upload_by_coverage(upload_key):
+    """Test a chunk sent again with a different length neither double counts nor leaves a gap."""
+    assert not record_upload_chunk(upload_key, 0, 4, 10)
+    assert not record_upload_chunk(upload_key, 0, 6, 10)
+    assert not record_upload_chunk(upload_key, 0, 6, 10)
+    assert get_upload_offset(upload_key) == (6, 10)
+    assert record_upload_chunk(upload_key, 4, 6, 10)
+    assert not record_upload_chunk(upload_key, 6, 4, 10)
+
+
+def test_chunk_of_different_size_is_rejected(upload_key):
+    """Test a chunk whose total size differs from the recorded size is not recorded."""
+    record_upload_chunk(upload_key, 0, 4, 10)
+    with pytest.raises(UploadSizeMismatchException):
+        record_upload_chunk(upload_key, 4, 8, 12)
+    with pytest.raises(UploadSizeMismatchException):
+        record_upload_chunk(upload_key, 8, 4, 10)
+    assert get_upload_offset(upload_key) == (4, 10)